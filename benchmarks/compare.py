@@ -0,0 +1,41 @@
+"""
+Compare two benchmark result files
+
+    python -m benchmarks.compare data/benchmarks/before.json data/benchmarks/after.json
+"""
+import argparse
+import json
+
+
+def compare_results(before: dict, after: dict, metric: str = "mean_s") -> list:
+    """rows of (scale, stage, before, after, ratio) for stages present in both runs"""
+    rows = []
+    for scale, stages in after["scales"].items():
+        for stage, stats in stages.items():
+            old = before["scales"].get(scale, {}).get(stage)
+            if old is None or metric not in stats or metric not in old:
+                continue
+            ratio = old[metric] / stats[metric] if stats[metric] else float("inf")
+            rows.append((scale, stage, old[metric], stats[metric], ratio))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--metric", default="mean_s")
+    args = parser.parse_args()
+
+    with open(args.before) as fp:
+        before = json.load(fp)
+    with open(args.after) as fp:
+        after = json.load(fp)
+
+    print(f"{'scale':>6} {'stage':<20} {'before':>12} {'after':>12} {'speedup':>8}")
+    for scale, stage, old, new, ratio in compare_results(before, after, args.metric):
+        print(f"{scale:>6} {stage:<20} {old:>12.6f} {new:>12.6f} {ratio:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,946 @@
+"""
+End-to-end benchmarks on synthetic concert histories
+
+    python -m benchmarks.run --scale 1 --scale 10 --output data/benchmarks/run.json
+
+Each stage is timed separately and the results are written as json so runs can be
+compared with `python -m benchmarks.compare`.
+"""
+import argparse
+import copy
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime as dt
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import (
+    FEATURES,
+    synthetic_raw_programs,
+    synthetic_soloist_lists,
+    synthetic_training_data,
+    synthetic_work_titles,
+)
+from benchmarks.timing import summarize_timings, time_calls
+from nyp.backends import available_backends, get_backend
+from nyp.markov import (
+    AVAILABLE_SUMMARY_FUNCTIONS,
+    BREAK,
+    MINOR,
+    Chain,
+    ChainEnsemble,
+    ChainEnsembleScorer,
+    ScoreVectorCache,
+    categorize_features,
+    truncate_head,
+)
+from nyp.tracing import GenerationTrace
+
+# mirrors nyp.server.DEFAULTS without importing the server (and its model pickle)
+GENERATE_PARAMS = {
+    "break_weight": 1,
+    "weighted_average_exponent": 1.2,
+    "case_weight_exponent": 0.25,
+    "feature_weights": {
+        "work_type": 4.0,
+        "composer_country": 1.0,
+        "composer_birth_century": 1.0,
+        "soloist_type": 2.0,
+        "percent_after_intermission_bin": 4.0,
+    },
+}
+
+CHAIN_CONFIGS = {f: {} for f in FEATURES}
+BASE_CHAIN_CONFIG = {"state_size": 1, "cull_threshold": 0.01}
+
+
+class BenchmarkContext:
+    """shared state handed from one stage to the next"""
+
+    def __init__(self, scale: float, seed: int, n_jobs: int, n_programs: int):
+        self.scale = scale
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.n_programs = n_programs
+        self.data: pd.DataFrame = pd.DataFrame()
+        self.model: ChainEnsemble = None
+        self.scorer: ChainEnsembleScorer = None
+
+
+def make_ensemble() -> ChainEnsemble:
+    return ChainEnsemble(
+        {c: dict(v) for c, v in CHAIN_CONFIGS.items()}, dict(BASE_CHAIN_CONFIG)
+    )
+
+
+def stage_synthesize(ctx: BenchmarkContext) -> dict:
+    start = time.perf_counter()
+    ctx.data = synthetic_training_data(ctx.scale, seed=ctx.seed)
+    stats = summarize_timings([time.perf_counter() - start])
+    stats["n_rows"] = len(ctx.data)
+    stats["n_concerts"] = int(ctx.data.index.get_level_values(0).nunique())
+    stats["n_selections"] = int(ctx.data.index.get_level_values(1).nunique())
+    return stats
+
+
+def stage_chain_fit(ctx: BenchmarkContext) -> dict:
+    """fit each feature's Chain in this process, without the ensemble's Pool"""
+    timings = []
+    for feature in FEATURES:
+        start = time.perf_counter()
+        Chain(ctx.data[feature], **BASE_CHAIN_CONFIG)
+        timings.append(time.perf_counter() - start)
+    return summarize_timings(timings)
+
+
+def reference_pre_process(chain: Chain, data: pd.Series) -> pd.Series:
+    """Chain.pre_process_data as a loop over concerts growing a list of values"""
+    break_values = [BREAK] * chain.state_size
+    raw_values = break_values.copy()
+
+    for i, d in data.groupby(level=0):
+        raw_values += d.values.tolist() + break_values
+
+    values = pd.Series(raw_values)
+
+    if chain.cull:
+        minor_values = chain.find_minor_values(values[values != BREAK].value_counts())
+        values[values.isin(minor_values)] = MINOR
+
+    if chain.train_backwards:
+        values = values[::-1]
+
+    return values
+
+
+def peak_memory(fn: Callable) -> int:
+    """bytes allocated at the peak of a call to fn, as traced by tracemalloc"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def stage_pre_process(ctx: BenchmarkContext) -> dict:
+    """break interpolation and culling of each feature, against the reference loop"""
+    stats: dict = {}
+    for feature in FEATURES:
+        chain = Chain(ctx.data[feature].iloc[:0], **BASE_CHAIN_CONFIG)
+        series = ctx.data[feature]
+        result = time_calls(lambda: chain.pre_process_data(series), repeat=3)
+        result["peak_bytes"] = peak_memory(lambda: chain.pre_process_data(series))
+        reference = time_calls(lambda: reference_pre_process(chain, series))
+        reference["peak_bytes"] = peak_memory(
+            lambda: reference_pre_process(chain, series)
+        )
+        result["reference"] = reference
+        result["matches_reference"] = bool(
+            chain.pre_process_data(series)
+            .astype(object)
+            .equals(reference_pre_process(chain, series))
+        )
+        stats[feature] = result
+    return stats
+
+
+def reference_count_windows(codes: np.ndarray, size: int) -> dict:
+    """counts of each window of `size` codes, walked one at a time"""
+    counts: dict = {}
+    for i in range(len(codes) - size + 1):
+        window = tuple(codes[i : i + size])
+        counts[window] = counts.get(window, 0) + 1
+    return counts
+
+
+def stage_backends(ctx: BenchmarkContext) -> dict:
+    """each available kernel backend (see nyp.backends) against reference forms of its
+    kernels and against the numpy backend's programs, failing on any mismatch, with
+    timings and speedups over the numpy backend"""
+    rng = np.random.RandomState(ctx.seed)
+    feature = FEATURES[0]
+    chain = Chain(ctx.data[feature], **BASE_CHAIN_CONFIG)
+    codes, uniques = pd.factorize(chain.data)
+    size = chain.state_size + 1
+    expected_counts = reference_count_windows(codes, size)
+
+    scorer = ChainEnsembleScorer(ctx.model, backend="numpy")
+    n_rows = len(scorer.selection_ids)
+    scores = tuple(
+        np.where(
+            rng.uniform(size=n_rows) < 0.2, scorer.kernel.zero, rng.uniform(size=n_rows)
+        )
+        for _ in FEATURES
+    )
+    alive = rng.uniform(size=n_rows) < 0.9
+    weights = rng.uniform(size=len(FEATURES))
+    weights /= weights.sum()
+    expected_positions = np.flatnonzero(
+        alive & np.logical_and.reduce([s != scorer.kernel.zero for s in scores])
+    )
+    expected_sum = np.zeros(len(expected_positions))
+    for s, w in zip(scores, weights):
+        expected_sum += s[expected_positions] * w
+    p = rng.uniform(size=n_rows)
+    p /= p.sum()
+    seeds = range(200)
+    expected_draws = [np.random.RandomState(k).choice(n_rows, p=p) for k in seeds]
+
+    np.random.seed(ctx.seed)
+    expected_programs = [
+        scorer.generate_program(random_state=k, **GENERATE_PARAMS)
+        for k in range(ctx.n_programs)
+    ]
+
+    stats: dict = {}
+    for name in available_backends():
+        backend = get_backend(name)
+        out = np.empty(n_rows)
+        gather = np.empty(n_rows)
+        start = time.perf_counter()
+        windows, counts = backend.count_windows(codes, size, len(uniques))
+        backend.scorable_positions(scores, alive, scorer.kernel.zero)
+        backend.weighted_sum(scores, weights, expected_positions, out, gather)
+        backend.sample(p, 0.5)
+        result: dict = {"first_call_s": time.perf_counter() - start}
+
+        checks = {}
+        checks["counts_match_reference"] = {
+            tuple(w): c for w, c in zip(windows.tolist(), counts.tolist())
+        } == expected_counts
+        checks["positions_match_reference"] = bool(
+            np.array_equal(
+                backend.scorable_positions(scores, alive, scorer.kernel.zero),
+                expected_positions,
+            )
+        )
+        checks["sum_matches_reference"] = bool(
+            np.array_equal(
+                backend.weighted_sum(scores, weights, expected_positions, out, gather),
+                expected_sum,
+            )
+        )
+        checks["draws_match_choice"] = [
+            backend.sample(p, np.random.RandomState(k).random_sample()) for k in seeds
+        ] == expected_draws
+        backend_scorer = ChainEnsembleScorer(ctx.model, backend=name)
+        checks["programs_match_numpy"] = [
+            backend_scorer.generate_program(random_state=k, **GENERATE_PARAMS)
+            for k in range(ctx.n_programs)
+        ] == expected_programs
+        failed = [check for check, passed in checks.items() if not passed]
+        if failed:
+            raise AssertionError(f"{name} backend failed: {', '.join(failed)}")
+        result.update(checks)
+
+        result["count_windows"] = time_calls(
+            lambda: backend.count_windows(codes, size, len(uniques)), repeat=20
+        )
+        result["scorable_positions"] = time_calls(
+            lambda: backend.scorable_positions(scores, alive, scorer.kernel.zero),
+            repeat=200,
+        )
+        result["weighted_sum"] = time_calls(
+            lambda: backend.weighted_sum(
+                scores, weights, expected_positions, out, gather
+            ),
+            repeat=200,
+        )
+        result["sample"] = time_calls(lambda: backend.sample(p, 0.5), repeat=200)
+        np.random.seed(ctx.seed)
+        result["generate_program"] = time_calls(
+            lambda: backend_scorer.generate_program(
+                random_state=None, **GENERATE_PARAMS
+            ),
+            repeat=ctx.n_programs,
+        )
+        stats[name] = result
+
+    for name, result in stats.items():
+        result["speedup_over_numpy"] = {
+            kernel: stats["numpy"][kernel]["mean_s"] / result[kernel]["mean_s"]
+            for kernel in (
+                "count_windows",
+                "scorable_positions",
+                "weighted_sum",
+                "sample",
+                "generate_program",
+            )
+        }
+    return stats
+
+
+def stage_ensemble_train(ctx: BenchmarkContext) -> dict:
+    def train():
+        ctx.model = make_ensemble().train(ctx.data, n_jobs=ctx.n_jobs)
+
+    return time_calls(train)
+
+
+def stage_categorical(ctx: BenchmarkContext) -> dict:
+    """the categorical feature path from training through scoring, against the same
+    steps on object columns: frame memory, chain fits, minor value substitution and
+    vocabulary encoding of the catalogue, and scorer setup"""
+    object_data = ctx.data.astype({f: object for f in FEATURES})
+    category_data = categorize_features(ctx.data, FEATURES)
+    object_model = copy.copy(ctx.model)
+    object_model.train_data = object_data
+    category_scorer = ChainEnsembleScorer(ctx.model)
+    object_scorer = ChainEnsembleScorer(object_model)
+
+    stats: dict = {
+        "train_data_bytes": int(category_data.memory_usage(deep=True).sum()),
+        "score_data_bytes": int(
+            category_scorer.score_data.memory_usage(deep=True).sum()
+        ),
+        "object": {
+            "train_data_bytes": int(object_data.memory_usage(deep=True).sum()),
+            "score_data_bytes": int(
+                object_scorer.score_data.memory_usage(deep=True).sum()
+            ),
+        },
+    }
+    for feature in FEATURES:
+        chain = ctx.model.chains[feature]
+        paths = {}
+        for path, data, scorer in (
+            ("categorical", category_data, category_scorer),
+            ("object", object_data, object_scorer),
+        ):
+            column = scorer.raw_data[feature]
+            transformed = chain.transform_scoring_series(column)
+            paths[path] = {
+                "chain_fit": time_calls(
+                    lambda: Chain(data[feature], **BASE_CHAIN_CONFIG)
+                ),
+                "transform_scoring_series": time_calls(
+                    lambda: chain.transform_scoring_series(column), repeat=20
+                ),
+                "encode": time_calls(lambda: chain.encode(transformed), repeat=20),
+                "codes": chain.encode(transformed),
+            }
+        result = paths["categorical"]
+        result["matches_object"] = bool(
+            np.array_equal(result.pop("codes"), paths["object"].pop("codes"))
+        )
+        result["object"] = paths["object"]
+        stats[feature] = result
+
+    stats["scorer_init"] = time_calls(lambda: ChainEnsembleScorer(ctx.model))
+    stats["object"]["scorer_init"] = time_calls(
+        lambda: ChainEnsembleScorer(object_model)
+    )
+    return stats
+
+
+def stage_scorer_init(ctx: BenchmarkContext) -> dict:
+    def build():
+        ctx.scorer = ChainEnsembleScorer(ctx.model)
+
+    return time_calls(build)
+
+
+def stage_generate_program(ctx: BenchmarkContext) -> dict:
+    timings = []
+    lengths = []
+    np.random.seed(ctx.seed)
+    for _ in range(ctx.n_programs):
+        start = time.perf_counter()
+        program = ctx.scorer.generate_program(random_state=None, **GENERATE_PARAMS)
+        timings.append(time.perf_counter() - start)
+        lengths.append(len(program))
+    stats = summarize_timings(timings)
+    stats["mean_program_length"] = float(np.mean(lengths))
+    return stats
+
+
+def alias_implied_probabilities(scorer: ChainEnsembleScorer, options: tuple) -> tuple:
+    """(implied, bound): the chance of accepting each catalogue row from one alias draw
+    at the scorer's current state, normalized, and the step's rejection bound"""
+    weights, weighted_average_exponent, case_weight_exponent = options
+    entries = {c: scorer.chain_entry(c, scorer.state[c]) for c in weights}
+    bound = scorer.alias_bound(weights, weighted_average_exponent, entries)
+    probabilities, aliases = scorer.alias_table(
+        weights, weighted_average_exponent, case_weight_exponent, entries
+    )
+    drawn = probabilities.copy()
+    np.add.at(drawn, aliases, 1 - probabilities)
+    implied = drawn * [
+        scorer.alias_ratio(pos, weights, weighted_average_exponent, entries)
+        if scorer.alive[pos]
+        else 0.0
+        for pos in range(len(drawn))
+    ]
+    return implied / implied.sum(), bound
+
+
+def stage_alias_sampler(ctx: BenchmarkContext, n_draws: int = 20000) -> dict:
+    """programs drawn through alias tables with rejection against exact sampling: the
+    distribution implied by table, bound and acceptance at each step of a few programs
+    against exact_probabilities, empirical draws against exact ones, and per-step costs
+    and rejections, with tables cold and then cached"""
+    weights = {
+        c: w for c, w in GENERATE_PARAMS["feature_weights"].items() if w is not None
+    }
+    options = (
+        weights,
+        GENERATE_PARAMS["weighted_average_exponent"],
+        GENERATE_PARAMS["case_weight_exponent"],
+    )
+    exact = ChainEnsembleScorer(ctx.model)
+    alias = ChainEnsembleScorer(
+        ctx.model, sampler="alias", alias_cache=ScoreVectorCache(max_bytes=2**30)
+    )
+    n_rows = len(exact.selection_ids)
+
+    # replay a few programs' prefixes on both scorers
+    max_error = 0.0
+    bounds = []
+    for k in range(5):
+        program = exact.generate_program(random_state=k, **GENERATE_PARAMS)
+        if ctx.model.train_backwards:
+            program = program[::-1]
+        for t in range(len(program) + 1):
+            for scorer in (exact, alias):
+                scorer.initialize_score_state()
+                for selection_id in program[:t]:
+                    scorer.update_state(selection_id)
+                    scorer.scrub(selection_id=selection_id)
+            positions, probabilities = exact.exact_probabilities(*options)
+            expected = np.zeros(n_rows)
+            expected[positions] = probabilities
+            implied, bound = alias_implied_probabilities(alias, options)
+            max_error = max(max_error, float(np.abs(implied - expected).max()))
+            bounds.append(bound)
+
+    # empirical draws at the last replayed state, and as many exact draws for scale
+    rng = np.random.RandomState(ctx.seed)
+    draws = np.array([alias.alias_position(*options, rng) for _ in range(n_draws)])
+    exact_draws = np.random.RandomState(ctx.seed).choice(
+        n_rows, size=n_draws, p=expected
+    )
+    stats: dict = {
+        "n_rows": n_rows,
+        "implied_max_abs_error": max_error,
+        "implied_matches_exact": max_error < 1e-9,
+        "max_bound": float(max(bounds)),
+        "draws_total_variation": float(
+            np.abs(np.bincount(draws, minlength=n_rows) / n_draws - expected).sum() / 2
+        ),
+        "exact_draws_total_variation": float(
+            np.abs(
+                np.bincount(exact_draws, minlength=n_rows) / n_draws - expected
+            ).sum()
+            / 2
+        ),
+    }
+
+    def programs(scorer: ChainEnsembleScorer) -> dict:
+        traces = [GenerationTrace() for _ in range(ctx.n_programs)]
+        np.random.seed(ctx.seed)
+        for trace in traces:
+            scorer.generate_program(random_state=None, trace=trace, **GENERATE_PARAMS)
+        steps = [step for trace in traces for step in trace.steps]
+        return {
+            "program_s": float(np.mean([trace.total_seconds for trace in traces])),
+            "step_s": float(np.mean([step.total_seconds for step in steps])),
+            "alias_steps": sum(step.sampler == "alias" for step in steps) / len(steps),
+            "rejections_per_step": sum(step.n_rejected for step in steps) / len(steps),
+        }
+
+    alias.alias_cache.clear()
+    stats["exact"] = programs(exact)
+    stats["alias_cold"] = programs(alias)
+    stats["alias_warm"] = programs(alias)
+    stats["alias_tables"] = len(alias.alias_cache)
+    stats["alias_table_bytes"] = alias.alias_cache.nbytes
+    stats["warm_step_speedup"] = (
+        stats["exact"]["step_s"] / stats["alias_warm"]["step_s"]
+    )
+    return stats
+
+
+def stage_truncation(ctx: BenchmarkContext, top_k: int = 50) -> dict:
+    """top_k truncated generation, by np.argpartition over exact scores and by walking
+    presorted candidate lists, against untruncated exact generation: heads against a
+    full sort, presorted heads' probabilities against exact ones over the same rows,
+    and per-step costs with the mass each step leaves out"""
+    rng = np.random.RandomState(ctx.seed)
+    heads_match = True
+    for _ in range(200):
+        p = rng.pareto(1.0, size=rng.randint(1, 5000))
+        p /= p.sum()
+        k = int(rng.randint(1, len(p) + 1))
+        top_p = float(rng.uniform(0.05, 1.0))
+        expected = np.argsort(-p, kind="stable")[:k]
+        expected = expected[: np.searchsorted(np.cumsum(p[expected]), top_p) + 1]
+        heads_match &= np.array_equal(
+            np.sort(p[truncate_head(p, k, top_p)]), np.sort(p[expected])
+        )
+
+    weights = {
+        c: w for c, w in GENERATE_PARAMS["feature_weights"].items() if w is not None
+    }
+    options = (
+        weights,
+        GENERATE_PARAMS["weighted_average_exponent"],
+        GENERATE_PARAMS["case_weight_exponent"],
+    )
+    exact = ChainEnsembleScorer(ctx.model)
+    presorted = ChainEnsembleScorer(
+        ctx.model, sampler="alias", alias_cache=ScoreVectorCache(max_bytes=2**30)
+    )
+    n_rows = len(exact.selection_ids)
+
+    # replay a few programs' prefixes on both scorers
+    max_error = 0.0
+    for k in range(5):
+        program = exact.generate_program(random_state=k, **GENERATE_PARAMS)
+        if ctx.model.train_backwards:
+            program = program[::-1]
+        for t in range(len(program) + 1):
+            for scorer in (exact, presorted):
+                scorer.initialize_score_state()
+                for selection_id in program[:t]:
+                    scorer.update_state(selection_id)
+                    scorer.scrub(selection_id=selection_id)
+            positions, probabilities = exact.exact_probabilities(*options)
+            expected = np.zeros(n_rows)
+            expected[positions] = probabilities
+            entries = {c: presorted.chain_entry(c, presorted.state[c]) for c in weights}
+            order, _ = presorted.candidate_list(*options, entries)
+            head = order[presorted.alive[order]][:top_k]
+            mass = presorted.rescored_mass(head, *options, entries)
+            max_error = max(
+                max_error,
+                float(
+                    np.abs(
+                        mass / mass.sum() - expected[head] / expected[head].sum()
+                    ).max()
+                ),
+            )
+    exact.initialize_score_state()
+    presorted.initialize_score_state()
+
+    def programs(scorer: ChainEnsembleScorer, **kwargs) -> dict:
+        traces = [GenerationTrace() for _ in range(ctx.n_programs)]
+        np.random.seed(ctx.seed)
+        for trace in traces:
+            scorer.generate_program(
+                random_state=None, trace=trace, **GENERATE_PARAMS, **kwargs
+            )
+        steps = [step for trace in traces for step in trace.steps]
+        truncated = [s.truncated_mass for s in steps if s.truncated_mass is not None]
+        return {
+            "step_s": float(np.mean([step.total_seconds for step in steps])),
+            "sample_s": float(np.mean([step.sample_seconds for step in steps])),
+            "mean_truncated_mass": float(np.mean(truncated)) if truncated else 0.0,
+        }
+
+    # np's global generator, as a fixed random_state redraws the same number each step
+    untruncated = []
+    for kwargs in ({}, {"top_p": 1.0}):
+        np.random.seed(ctx.seed)
+        untruncated.append(
+            [
+                exact.generate_program(random_state=None, **GENERATE_PARAMS, **kwargs)
+                for _ in range(ctx.n_programs)
+            ]
+        )
+
+    stats: dict = {
+        "n_rows": n_rows,
+        "heads_match_sort": bool(heads_match),
+        "presorted_max_abs_error": max_error,
+        "presorted_matches_exact": max_error < 1e-9,
+        "untruncated_matches_exact": untruncated[0] == untruncated[1],
+        "exact": programs(exact),
+        "argpartition": programs(exact, top_k=top_k),
+    }
+    programs(presorted, top_k=top_k)  # fill the candidate lists
+    stats["presorted_warm"] = programs(presorted, top_k=top_k)
+    stats["presorted_step_speedup"] = (
+        stats["exact"]["step_s"] / stats["presorted_warm"]["step_s"]
+    )
+    return stats
+
+
+def stage_generate_season(ctx: BenchmarkContext) -> dict:
+    """a season of n_programs programs from one SeasonGenerator, against the same
+    number of single programs each from a freshly copied scorer"""
+    from nyp.season import SeasonGenerator
+
+    np.random.seed(ctx.seed)
+    stats = time_calls(
+        lambda: SeasonGenerator(ctx.scorer).generate_season(
+            ctx.n_programs, random_state=None, **GENERATE_PARAMS
+        )
+    )
+
+    def singles():
+        for _ in range(ctx.n_programs):
+            ctx.scorer.copy().generate_program(random_state=None, **GENERATE_PARAMS)
+
+    np.random.seed(ctx.seed)
+    stats["single_programs"] = time_calls(singles)
+    return stats
+
+
+def stage_fold_models(ctx: BenchmarkContext, n_folds: int = 5) -> dict:
+    """models for k-fold cross validation by count subtraction, against training a
+    model per fold"""
+    concert_ids = ctx.data.index.get_level_values("concert_id").unique()
+    folds = pd.Series(np.arange(len(concert_ids)) % n_folds, index=concert_ids)
+    stats = time_calls(
+        lambda: make_ensemble().fold_models(ctx.data, folds, n_jobs=ctx.n_jobs)
+    )
+
+    row_folds = folds.reindex(ctx.data.index.get_level_values("concert_id")).values
+
+    def train_per_fold():
+        for fold in range(n_folds):
+            make_ensemble().train(ctx.data[row_folds != fold], n_jobs=ctx.n_jobs)
+
+    stats["train_per_fold"] = time_calls(train_per_fold)
+    return stats
+
+
+def stage_variants(
+    ctx: BenchmarkContext,
+    state_sizes: tuple = (1, 2, 3, 4, 5),
+    cull_thresholds: tuple = (0.001, 0.005, 0.01, 0.02, 0.05),
+) -> dict:
+    """a grid of (state_size, cull_threshold) models from one counting pass, against
+    one training run at the largest state size and a training run per variant"""
+    stats = time_calls(
+        lambda: make_ensemble().variant_models(
+            ctx.data, state_sizes, cull_thresholds, n_jobs=ctx.n_jobs
+        )
+    )
+    stats["n_variants"] = len(state_sizes) * len(cull_thresholds)
+
+    def train(state_size, cull_threshold):
+        ChainEnsemble(
+            CHAIN_CONFIGS, dict(state_size=state_size, cull_threshold=cull_threshold)
+        ).train(ctx.data, n_jobs=ctx.n_jobs)
+
+    stats["single_train"] = time_calls(
+        lambda: train(max(state_sizes), BASE_CHAIN_CONFIG["cull_threshold"])
+    )
+
+    def train_per_variant():
+        for state_size in state_sizes:
+            for cull_threshold in cull_thresholds:
+                train(state_size, cull_threshold)
+
+    stats["train_per_variant"] = time_calls(train_per_variant)
+    return stats
+
+
+def stage_partial_fit(ctx: BenchmarkContext, n_new: int = 100) -> dict:
+    """adding the last n_new concerts (about a season) to a model and scorer fit on the
+    rest, against retraining on everything"""
+    concert_ids = ctx.data.index.get_level_values("concert_id")
+    is_new = concert_ids.isin(concert_ids.unique()[-n_new:])
+    model = make_ensemble().train(ctx.data[~is_new], n_jobs=ctx.n_jobs)
+    scorer = ChainEnsembleScorer(model)
+    stats = time_calls(lambda: scorer.partial_fit(ctx.data[is_new]))
+    stats["n_new_rows"] = int(is_new.sum())
+    stats["full_train"] = time_calls(
+        lambda: make_ensemble().train(ctx.data, n_jobs=ctx.n_jobs)
+    )
+    return stats
+
+
+def stage_likelihood(ctx: BenchmarkContext) -> dict:
+    """encoding the training concerts for likelihood scoring, then scoring all of them
+    under the generation parameters"""
+    from nyp.likelihood import ProgramLikelihood
+
+    start = time.perf_counter()
+    likelihood = ProgramLikelihood(ctx.scorer, ctx.model.train_data)
+    stats: dict = {"encode_seconds": time.perf_counter() - start}
+    stats.update(
+        time_calls(lambda: likelihood.log_likelihood(**GENERATE_PARAMS), repeat=3)
+    )
+    stats["n_concerts"] = len(likelihood.concert_ids)
+    stats["n_steps"] = len(likelihood.step_rows)
+    stats["n_contexts"] = likelihood.n_contexts
+    stats["n_combos"] = likelihood.n_combos
+    return stats
+
+
+def reference_log_odds(p: np.ndarray, w: np.ndarray) -> np.ndarray:
+    odds = np.exp(np.sum(np.log(p / (1 - p)) * w, axis=1) / w.sum())
+    return odds / (1 + odds)
+
+
+# direct (non log-space) forms of the summary functions, to check the kernels against
+REFERENCE_SUMMARY_FUNCTIONS: Dict[str, Callable] = {
+    "simple_weighted_avg": lambda p, w: np.sum(p * w, axis=1) / w.sum(),
+    "sum_weighted_log_odds": reference_log_odds,
+    "rescaled_power_weight": lambda p, w: np.power(
+        np.prod(p**w, axis=1), 1 / w.sum()
+    ),
+}
+
+
+def stage_summary_functions(ctx: BenchmarkContext) -> dict:
+    """each summary function over a catalogue-sized score matrix, and generation with
+    a scorer using it"""
+    n_rows = len(ctx.scorer.selection_ids)
+    weights = np.array(list(GENERATE_PARAMS["feature_weights"].values()))
+    p = np.random.RandomState(ctx.seed).uniform(1e-6, 0.5, (n_rows, len(weights)))
+
+    stats: dict = {"n_rows": n_rows}
+    for name, function in AVAILABLE_SUMMARY_FUNCTIONS.items():
+        expected = REFERENCE_SUMMARY_FUNCTIONS[name](p, weights)
+        result = time_calls(lambda: function(p, weights), repeat=20)
+        result["max_rel_error"] = float(
+            np.max(np.abs(function(p, weights) / expected - 1))
+        )
+
+        scorer = ChainEnsembleScorer(ctx.model, summary_function=name)
+        np.random.seed(ctx.seed)
+        result["generate_program"] = time_calls(
+            lambda: scorer.generate_program(random_state=None, **GENERATE_PARAMS),
+            repeat=ctx.n_programs,
+        )
+        stats[name] = result
+    return stats
+
+
+def stage_export_features(ctx: BenchmarkContext) -> dict:
+    """the per-row feature extraction helpers from scripts/export.py"""
+    from scripts.export import (
+        OPUS_MARKERS,
+        WORK_TYPES,
+        categorize_soloists,
+        matches_any,
+        matches_which,
+    )
+
+    n_rows = len(ctx.data)
+    titles = synthetic_work_titles(n_rows, seed=ctx.seed)
+    soloists = synthetic_soloist_lists(n_rows, seed=ctx.seed)
+
+    def extract():
+        for title, instruments in zip(titles, soloists):
+            matches_any(title, OPUS_MARKERS)
+            matches_any(title, [r"ARR\."])
+            matches_which(title, WORK_TYPES)
+            categorize_soloists(instruments)
+
+    stats = time_calls(extract)
+    stats["n_rows"] = n_rows
+    return stats
+
+
+def stage_ingest(ctx: BenchmarkContext) -> dict:
+    """load raw programs through ProgramParser into an in-memory SQLite database"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from nyp.models import Base
+    from nyp.parsers import ProgramParser
+
+    n_programs = max(int(100 * ctx.scale), 10)
+    programs = synthetic_raw_programs(n_programs, seed=ctx.seed)
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(engine)()
+
+    timings = []
+    for program in programs:
+        start = time.perf_counter()
+        ProgramParser(program, session).load_relationships()
+        timings.append(time.perf_counter() - start)
+
+    session.close()
+    engine.dispose()
+    stats = summarize_timings(timings)
+    stats["n_programs"] = n_programs
+    return stats
+
+
+# each run in a fresh interpreter, so nothing is imported yet
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+READY_SCRIPT = """
+import time
+start = time.perf_counter()
+import nyp.server as server
+print(time.perf_counter() - start)
+client = server.application.test_client()
+while client.get("/ready").status_code != 200:
+    if server.model_load_error:
+        raise SystemExit(server.model_load_error)
+    time.sleep(0.01)
+print(time.perf_counter() - start)
+"""
+
+
+def run_script(code: str, env: dict) -> List[float]:
+    """the numbers a script prints, run with `env` added to the environment"""
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], env={**os.environ, **env}
+    )
+    return [float(line) for line in output.decode().split()]
+
+
+def stage_startup(ctx: BenchmarkContext, n_runs: int = 5) -> dict:
+    """cold starts: importing nyp.models, importing nyp.server (after which it can
+    listen), and the server's time until /ready reports a pickle of this scale's model
+    loaded by the warm-up thread"""
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = os.path.join(tmp, "model.p")
+        with open(model_path, "wb") as fp:
+            pickle.dump(ctx.model, fp)
+        env = {"MODEL_PATH": model_path, "MODEL_WARM_UP": "1"}
+        models_import = [
+            run_script(IMPORT_SCRIPT.format(module="nyp.models"), env)[0]
+            for _ in range(n_runs)
+        ]
+        server_runs = [run_script(READY_SCRIPT, env) for _ in range(n_runs)]
+        model_file_bytes = os.path.getsize(model_path)
+
+    stats = summarize_timings([listening for listening, _ in server_runs])
+    stats["ready_p50_s"] = float(np.median([ready for _, ready in server_runs]))
+    stats["models_import_p50_s"] = float(np.median(models_import))
+    stats["model_file_bytes"] = model_file_bytes
+    return stats
+
+
+# stages that later stages read their inputs from
+PREREQUISITES = ("synthesize", "ensemble_train", "scorer_init")
+
+STAGES: Dict[str, Callable[[BenchmarkContext], dict]] = OrderedDict(
+    [
+        ("synthesize", stage_synthesize),
+        ("pre_process", stage_pre_process),
+        ("chain_fit", stage_chain_fit),
+        ("ensemble_train", stage_ensemble_train),
+        ("scorer_init", stage_scorer_init),
+        ("categorical", stage_categorical),
+        ("backends", stage_backends),
+        ("generate_program", stage_generate_program),
+        ("alias_sampler", stage_alias_sampler),
+        ("truncation", stage_truncation),
+        ("generate_season", stage_generate_season),
+        ("summary_functions", stage_summary_functions),
+        ("fold_models", stage_fold_models),
+        ("variants", stage_variants),
+        ("partial_fit", stage_partial_fit),
+        ("likelihood", stage_likelihood),
+        ("export_features", stage_export_features),
+        ("ingest", stage_ingest),
+        ("startup", stage_startup),
+    ]
+)
+
+
+def git_revision() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(
+    scales: List[float],
+    stages: List[str] = None,
+    seed: int = 0,
+    n_jobs: int = 1,
+    n_programs: int = 50,
+) -> dict:
+    """run the selected stages at each scale; returns a json-serializable result dict"""
+    stages = stages or list(STAGES)
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        raise ValueError(f"unknown stages: {', '.join(unknown)}")
+
+    results: dict = {
+        "meta": {
+            "timestamp": dt.now().isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "seed": seed,
+            "n_jobs": n_jobs,
+            "n_programs": n_programs,
+        },
+        "scales": {},
+    }
+
+    for scale in scales:
+        ctx = BenchmarkContext(scale, seed, n_jobs, n_programs)
+        scale_results = OrderedDict()
+        last = max(list(STAGES).index(s) for s in stages)
+        for i, name in enumerate(STAGES):
+            if name in stages:
+                print(f"[scale {scale}] {name}...", flush=True)
+                scale_results[name] = STAGES[name](ctx)
+            elif name in PREREQUISITES and i < last:
+                # later stages need this one's output, so run it untimed
+                STAGES[name](ctx)
+        results["scales"][str(scale)] = scale_results
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--scale",
+        type=float,
+        action="append",
+        help="multiple of the NY Phil archive size; may be repeated (default 1)",
+    )
+    parser.add_argument("--stage", action="append", choices=list(STAGES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--n-programs", type=int, default=50)
+    parser.add_argument("--output", default=None, help="json file to write results to")
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        scales=args.scale or [1.0],
+        stages=args.stage,
+        seed=args.seed,
+        n_jobs=args.n_jobs,
+        n_programs=args.n_programs,
+    )
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as fp:
+            fp.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""Synthetic concert histories shaped like the NY Phil archive, for benchmarking"""
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from nyp.markov import INTERMISSION
+
+# rough size of the modelable NY Phil archive at scale 1
+ARCHIVE_CONCERTS = 14000
+ARCHIVE_SELECTIONS = 11000
+ARCHIVE_COMPOSERS = 2700
+
+INTERMISSION_ID = 4
+
+FEATURE_VALUES = {
+    "work_type": [
+        "symphony",
+        "concerto",
+        "overture",
+        "suite",
+        "dance",
+        "march",
+        "mass",
+        "Other",
+    ],
+    "composer_country": [
+        "DE",
+        "AT",
+        "US",
+        "RU",
+        "FR",
+        "IT",
+        "GB",
+        "CZ",
+        "HU",
+        "NO",
+        "FI",
+        "ES",
+        "PL",
+        "BR",
+        "Unknown",
+    ],
+    "composer_birth_century": ["16th", "17th", "18th", "19th", "20th", "Other"],
+    "soloist_type": [
+        "No Featured Instruments",
+        "Keyboard",
+        "Strings",
+        "Vocal",
+        "Woodwind",
+        "Brass",
+        "Multiple",
+        "Other",
+    ],
+    "percent_after_intermission_bin": ["0-20", "20-40", "40-60", "60-80", "80-100"],
+}
+
+FEATURES = list(FEATURE_VALUES)
+
+# typical position of a work type within a program, used to order synthetic programs
+WORK_TYPE_POSITION = {
+    "overture": 0.0,
+    "march": 0.1,
+    "dance": 0.4,
+    "concerto": 0.3,
+    "suite": 0.5,
+    "Other": 0.5,
+    "mass": 0.8,
+    "symphony": 0.9,
+}
+
+
+def zipf_weights(n: int, exponent: float = 1.1) -> np.ndarray:
+    """normalized Zipf popularity over n ranked items"""
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def skewed_choice(rng: np.random.RandomState, values: list, size: int) -> np.ndarray:
+    return rng.choice(values, size=size, p=zipf_weights(len(values), 1.3))
+
+
+def synthetic_catalogue(
+    n_selections: int, n_composers: int, rng: np.random.RandomState
+) -> pd.DataFrame:
+    """selection-level features, ordered by popularity rank"""
+    composer_id = rng.choice(
+        np.arange(1, n_composers + 1), size=n_selections, p=zipf_weights(n_composers)
+    )
+
+    # composer-level features are shared by every selection of a composer
+    composer_country = skewed_choice(
+        rng, FEATURE_VALUES["composer_country"], n_composers + 1
+    )
+    composer_century = skewed_choice(
+        rng, FEATURE_VALUES["composer_birth_century"][::-1], n_composers + 1
+    )
+
+    catalogue = pd.DataFrame(
+        {
+            "composer_id": composer_id,
+            "work_type": skewed_choice(rng, FEATURE_VALUES["work_type"], n_selections),
+            "composer_country": composer_country[composer_id],
+            "composer_birth_century": composer_century[composer_id],
+            "soloist_type": skewed_choice(
+                rng, FEATURE_VALUES["soloist_type"], n_selections
+            ),
+            "percent_after_intermission_bin": rng.choice(
+                FEATURE_VALUES["percent_after_intermission_bin"], size=n_selections
+            ),
+        },
+        index=pd.Index(
+            # leave room for the intermission's real selection id
+            np.arange(1, n_selections + 1)
+            + (np.arange(1, n_selections + 1) >= INTERMISSION_ID),
+            name="selection_id",
+        ),
+    )
+    return catalogue
+
+
+def synthetic_program_lengths(
+    n_concerts: int, rng: np.random.RandomState
+) -> np.ndarray:
+    """number of works per program: mostly 3-5, occasionally a single work or a gala"""
+    return np.clip(rng.poisson(3.2, size=n_concerts), 1, 12)
+
+
+def synthetic_training_data(
+    scale: float = 1.0, seed: Optional[int] = 0, zipf_exponent: float = 0.9
+) -> pd.DataFrame:
+    """
+    build a training frame like scripts/export.py's, indexed by [concert_id, selection_id]
+    with a `weight` column, the `composer_id` used by scorer constraints, and one column
+    per modeled feature
+
+    - scale: multiple of the NY Phil archive's size in concerts and selections
+    - zipf_exponent: skew of selection popularity; higher means a heavier head
+    """
+    rng = np.random.RandomState(seed)
+    n_concerts = max(int(ARCHIVE_CONCERTS * scale), 1)
+    n_selections = max(int(ARCHIVE_SELECTIONS * scale), 10)
+    n_composers = max(int(ARCHIVE_COMPOSERS * scale), 5)
+
+    catalogue = synthetic_catalogue(n_selections, n_composers, rng)
+    popularity = zipf_weights(n_selections, zipf_exponent)
+    lengths = synthetic_program_lengths(n_concerts, rng)
+
+    # draw every program's works at once, then drop in-program repeats
+    total = int(lengths.sum())
+    draws = rng.choice(n_selections, size=total, p=popularity)
+    concert_ids = np.repeat(np.arange(1, n_concerts + 1), lengths)
+    frame = pd.DataFrame(
+        {"concert_id": concert_ids, "selection_id": catalogue.index.values[draws]}
+    ).drop_duplicates()
+
+    # order works within each program by work type, plus some noise
+    position = catalogue.loc[frame["selection_id"], "work_type"].map(
+        WORK_TYPE_POSITION
+    ).values + rng.normal(0, 0.15, size=len(frame))
+    frame = frame.assign(position=position).sort_values(["concert_id", "position"])
+
+    # most multi-work programs have an intermission about two thirds of the way through
+    frame["order"] = frame.groupby("concert_id").cumcount()
+    n_works = frame.groupby("concert_id")["order"].transform("size")
+    has_break = (n_works >= 3) & (rng.rand(len(frame)) < 0.85)
+    break_at = (n_works * 2 // 3).where(has_break, -1)
+    breaks = frame.loc[frame["order"] == break_at, ["concert_id", "order"]].copy()
+    breaks["selection_id"] = INTERMISSION_ID
+    breaks["order"] = breaks["order"] - 0.5
+    frame = (
+        pd.concat([frame[["concert_id", "selection_id", "order"]], breaks])
+        .sort_values(["concert_id", "order"])
+        .drop("order", axis=1)
+    )
+
+    intermission = pd.DataFrame(
+        {c: [INTERMISSION] for c in catalogue.columns},
+        index=pd.Index([INTERMISSION_ID], name="selection_id"),
+    )
+    # as in the export, composer_id is a nullable integer, NA for intermissions
+    intermission["composer_id"] = pd.NA
+    features = pd.concat([catalogue, intermission])
+    features["composer_id"] = features["composer_id"].astype("Int64")
+
+    data = frame.join(features, on="selection_id")
+    data["weight"] = data.groupby("selection_id")["selection_id"].transform("size")
+    data = data.set_index(["concert_id", "selection_id"])
+
+    # the export leads with the weight column
+    return data[["weight", "composer_id"] + FEATURES]
+
+
+COMPOSER_NAMES = ["Haydn", "Mozart", "Beethoven", "Brahms", "Mahler", "Dvorak"]
+WORK_TITLES = [
+    "SYMPHONY NO. {n}, OP. {n}",
+    "CONCERTO, PIANO, NO. {n}",
+    "OVERTURE TO THE OPERA {n}",
+    "SUITE NO. {n} (ARR. SMITH)",
+    "WALTZ NO. {n}",
+    "MASS IN C, K. {n}",
+    "MARCH NO. {n}",
+    "TONE POEM {n}",
+]
+SOLOIST_INSTRUMENTS = ["Piano", "Violin", "Soprano", "Cello", "Trumpet", "Flute"]
+
+
+def synthetic_work_titles(n: int, seed: Optional[int] = 0) -> List[str]:
+    rng = np.random.RandomState(seed)
+    templates = rng.choice(WORK_TITLES, size=n)
+    numbers = rng.randint(1, 600, size=n)
+    return [t.format(n=num) for t, num in zip(templates, numbers)]
+
+
+def synthetic_soloist_lists(n: int, seed: Optional[int] = 0) -> List[List[str]]:
+    rng = np.random.RandomState(seed)
+    n_soloists = np.clip(rng.poisson(0.5, size=n), 0, 4)
+    return [list(rng.choice(SOLOIST_INSTRUMENTS, size=k)) for k in n_soloists]
+
+
+def synthetic_raw_programs(n_programs: int, seed: Optional[int] = 0) -> List[dict]:
+    """programs in the raw NY Phil performance history json format read by ProgramParser"""
+    rng = np.random.RandomState(seed)
+    programs = []
+    for i in range(n_programs):
+        n_works = int(synthetic_program_lengths(1, rng)[0])
+        works: List[dict] = []
+        for w in range(n_works):
+            if w == n_works * 2 // 3 and n_works >= 3:
+                works.append({"ID": "0*", "interval": "Intermission"})
+            composer = rng.choice(COMPOSER_NAMES)
+            number = int(rng.randint(1, 40))
+            work: dict = {
+                "ID": f"{number}*",
+                "composerName": f"{composer}, Composer {number % 7}",
+                "workTitle": rng.choice(WORK_TITLES).format(n=number),
+                "conductorName": f"Conductor, Number {int(rng.randint(1, 30))}",
+                "soloists": [],
+            }
+            if rng.rand() < 0.3:
+                work["soloists"].append(
+                    {
+                        "soloistName": f"Soloist, Number {int(rng.randint(1, 200))}",
+                        "soloistInstrument": rng.choice(SOLOIST_INSTRUMENTS),
+                        "soloistRoles": "S",
+                    }
+                )
+            if rng.rand() < 0.2:
+                movement = int(rng.randint(1, 5))
+                work["ID"] = f"{number}*{movement}"
+                work["movement"] = f"Movement {movement}"
+            works.append(work)
+
+        year = 1842 + i % 175
+        programs.append(
+            {
+                "id": f"synthetic-{i}",
+                "season": f"{year}-{str(year + 1)[2:]}",
+                "orchestra": "New York Philharmonic",
+                "concerts": [
+                    {
+                        "eventType": "Subscription Season",
+                        "Location": "Manhattan, NY",
+                        "Venue": "Carnegie Hall",
+                        "Date": f"{year}-10-{1 + c:02d}T05:00:00Z",
+                        "Time": "8:00PM",
+                    }
+                    for c in range(int(rng.randint(1, 4)))
+                ],
+                "works": works,
+            }
+        )
+    return programs
@@ -0,0 +1,28 @@
+import time
+from typing import Callable, List
+
+import numpy as np
+
+
+def summarize_timings(timings: List[float]) -> dict:
+    """summary statistics (seconds) for a list of timings"""
+    arr = np.array(timings, dtype=float)
+    return {
+        "n": len(arr),
+        "total_s": float(arr.sum()),
+        "mean_s": float(arr.mean()),
+        "min_s": float(arr.min()),
+        "p50_s": float(np.percentile(arr, 50)),
+        "p95_s": float(np.percentile(arr, 95)),
+        "max_s": float(arr.max()),
+    }
+
+
+def time_calls(fn: Callable, repeat: int = 1) -> dict:
+    """call `fn` `repeat` times and summarize the wall clock timings"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return summarize_timings(timings)
@@ -0,0 +1,146 @@
+"""
+Numeric kernels for the hot loops of training and generation
+
+Every backend provides the same kernels with the same results:
+
+- count_windows: distinct windows of a code sequence and how often each appears, for
+    counting chain transitions
+- scorable_positions and weighted_sum: the per-step filter and weighted sum of
+    transformed scores over the catalogue
+- sample: a draw from a probability vector by cumulative sum, matching
+    `RandomState.choice` given the same uniform draw
+- alias_table: a Walker alias table, for O(1) draws from a fixed vector of weights
+
+"numpy" is always available; "numba" (nyp.numba_backend) compiles the same loops where
+Numba is installed, and is only imported when first requested. The default, "auto",
+prefers numba; set NYP_BACKEND to choose one for the process.
+"""
+import functools
+import os
+from typing import Optional
+
+import numpy as np
+
+# window keys are packed into int64 while base ** window size stays under this
+MAX_PACKED_KEY = 2**62
+
+
+def pack_windows(size: int, base: int) -> Optional[np.ndarray]:
+    """powers of `base` that pack a window of `size` codes into one integer, or None
+    where the keys could overflow"""
+    if float(base) ** size >= MAX_PACKED_KEY:
+        return None
+    return base ** np.arange(size - 1, -1, -1, dtype=np.int64)
+
+
+class NumpyBackend:
+    name = "numpy"
+
+    def __repr__(self):
+        return f"<{type(self).__name__}>"
+
+    def count_windows(self, codes: np.ndarray, size: int, base: int) -> tuple:
+        """(windows, counts): each distinct run of `size` consecutive `codes` (which
+        are in [0, base)) as a row, in sorted order, and how many times it appears"""
+        windows = np.lib.stride_tricks.sliding_window_view(codes, size)
+        powers = pack_windows(size, base)
+        if powers is None:
+            return np.unique(windows, axis=0, return_counts=True)
+        keys, counts = np.unique(windows @ powers, return_counts=True)
+        return (keys[:, None] // powers) % base, counts
+
+    def scorable_positions(
+        self, scores: tuple, alive: np.ndarray, zero: float
+    ) -> np.ndarray:
+        """positions of `alive` rows that no score vector has at `zero`"""
+        mask = alive.copy()
+        for s in scores:
+            mask &= s != zero
+        return np.flatnonzero(mask)
+
+    def weighted_sum(
+        self,
+        scores: tuple,
+        weights: np.ndarray,
+        positions: np.ndarray,
+        out: np.ndarray,
+        gather: np.ndarray,
+    ) -> np.ndarray:
+        """sum of each score vector at `positions` times its weight, into `out` (using
+        `gather` as scratch space); both are at least len(positions) long"""
+        n = len(positions)
+        total = out[:n]
+        gathered = gather[:n]
+        total.fill(0.0)
+        for s, w in zip(scores, weights):
+            np.take(s, positions, out=gathered)
+            gathered *= w
+            total += gathered
+        return total
+
+    def sample(self, probabilities: np.ndarray, uniform: float) -> int:
+        """the position drawn from `probabilities` by a uniform draw in [0, 1)"""
+        cdf = np.cumsum(probabilities)
+        cdf /= cdf[-1]
+        return int(np.searchsorted(cdf, uniform, side="right"))
+
+    def alias_table(self, weights: np.ndarray) -> tuple:
+        """(probabilities, aliases) of a Walker alias table over nonnegative `weights`:
+        pick a position i uniformly, then keep it with probability probabilities[i] or
+        take aliases[i] instead, and each position is drawn in proportion to its weight
+        """
+        n = len(weights)
+        scaled = (weights * (n / weights.sum())).tolist()
+        probabilities = [1.0] * n
+        aliases = list(range(n))
+        small = [i for i, x in enumerate(scaled) if x < 1.0]
+        large = [i for i, x in enumerate(scaled) if x >= 1.0]
+        while small and large:
+            s = small.pop()
+            g = large[-1]
+            probabilities[s] = scaled[s]
+            aliases[s] = g
+            scaled[g] += scaled[s] - 1.0
+            if scaled[g] < 1.0:
+                small.append(large.pop())
+        # anything left over is 1 up to rounding, and keeps itself
+        return np.array(probabilities), np.array(aliases, dtype=np.int64)
+
+
+BACKENDS = {"numpy": NumpyBackend()}
+
+
+@functools.lru_cache(maxsize=None)
+def load_numba_backend() -> Optional[NumpyBackend]:
+    """the numba backend, imported (and registered in BACKENDS) on first call; None
+    where numba isn't installed"""
+    try:
+        from nyp.numba_backend import NumbaBackend
+    except ImportError:  # numba is optional; everything runs on the numpy backend
+        return None
+    BACKENDS["numba"] = NumbaBackend()
+    return BACKENDS["numba"]
+
+
+def available_backends() -> list:
+    """names of the backends that can run here"""
+    return ["numpy"] + (["numba"] if load_numba_backend() is not None else [])
+
+
+def get_backend(name: Optional[str] = None) -> NumpyBackend:
+    """the backend called `name`; None means NYP_BACKEND, or "auto" if that's unset,
+    which is numba where it's installed and numpy otherwise"""
+    if name is None:
+        name = os.getenv("NYP_BACKEND", "auto")
+    if name in ("auto", "numba"):
+        backend = load_numba_backend()
+        if backend is not None:
+            return backend
+        if name == "numba":
+            raise ValueError("the numba backend needs numba installed")
+        name = "numpy"
+    if name not in BACKENDS:
+        raise ValueError(
+            'backend unknown, please use one of ("numpy", "numba") or "auto"'
+        )
+    return BACKENDS[name]
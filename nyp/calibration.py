@@ -0,0 +1,276 @@
+import itertools
+import json
+import random
+from multiprocessing import Pool, cpu_count
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from nyp.likelihood import ProgramLikelihood
+from nyp.markov import ChainEnsemble, ChainEnsembleScorer
+
+# options for ChainEnsembleScorer.generate_program that a calibration can tune
+TUNABLE_PARAMS = (
+    "feature_weights",
+    "weighted_average_exponent",
+    "case_weight_exponent",
+    "break_weight",
+)
+
+
+def random_params(features: list, rng=random) -> dict:
+    """random generation options: weights for a random subset of features sharing a
+    budget of 100, and exponents and break weight over the ranges the app compares"""
+    features = list(features)
+    rng.shuffle(features)
+
+    weights = {}
+    available_weight = 100
+
+    for feature in features:
+        if available_weight <= 1:
+            continue
+        weight_max = 65 if available_weight >= 65 else available_weight
+        weight = rng.randrange(1, weight_max, 1)
+        weights[feature] = weight
+        available_weight -= weight
+
+    return {
+        "feature_weights": weights,
+        "weighted_average_exponent": rng.randrange(10, 30, 1) / 10,
+        "case_weight_exponent": rng.randrange(10, 30, 1) / 10,
+        "break_weight": rng.randrange(1, 20, 1),
+    }
+
+
+def random_candidates(
+    n_candidates: int, features: list, seed: Optional[int] = None
+) -> List[dict]:
+    rng = random.Random(seed)
+    return [random_params(features, rng) for _ in range(n_candidates)]
+
+
+def grid_candidates(grid: dict) -> List[dict]:
+    """every combination of a grid of options; lists (at any depth, e.g. per feature
+    under feature_weights) are the values to try and anything else is held fixed, so
+    {"feature_weights": {"a": [1, 2], "b": 1}, "break_weight": [1, 5]} is 4 candidates
+    """
+    axes = []
+
+    def find_axes(spec, path):
+        if isinstance(spec, dict):
+            for k, v in spec.items():
+                find_axes(v, path + (k,))
+        elif isinstance(spec, (list, tuple)):
+            axes.append((path, list(spec)))
+
+    def fill(spec, values, path=()):
+        if isinstance(spec, dict):
+            return {k: fill(v, values, path + (k,)) for k, v in spec.items()}
+        return values.get(path, spec)
+
+    find_axes(grid, ())
+    return [
+        fill(grid, dict(zip([path for path, _ in axes], combination)))
+        for combination in itertools.product(*[values for _, values in axes])
+    ]
+
+
+def iter_candidates(
+    features: list,
+    n_random: int = 0,
+    grid: Optional[dict] = None,
+    seed: Optional[int] = None,
+) -> Iterator[dict]:
+    """grid candidates (if any) followed by n_random random ones"""
+    if grid:
+        yield from grid_candidates(grid)
+    yield from random_candidates(n_random, features, seed)
+
+
+def concert_folds(data: pd.DataFrame, n_folds: int, seed: int = 0) -> pd.Series:
+    """assign each concert in `data` to one of `n_folds` folds at random"""
+    concert_ids = data.index.get_level_values("concert_id").unique()
+    folds = np.arange(len(concert_ids)) % n_folds
+    np.random.RandomState(seed).shuffle(folds)
+    return pd.Series(folds, index=concert_ids, name="fold")
+
+
+class Calibrator:
+    """
+    Cross-validated search over generation options
+
+    Concerts are split into folds; for each fold, a model is trained on the other folds
+    (see `ChainEnsemble.fold_models`) and its held-out concerts are encoded for
+    likelihood scoring. All of that is independent of the options being tuned, so it
+    happens once in `prepare` and each candidate only costs a
+    `ProgramLikelihood.log_likelihood` call per fold. `search` scores candidates across
+    a process pool and ranks them in a leaderboard.
+
+    - data: training data indexed by [concert_id, selection_id], as for ChainEnsemble
+    - chain_configs, base_chain_config, train_backwards: as for ChainEnsemble
+    - n_folds: number of concert folds; every concert is held out exactly once
+    - summary_function: the scorer's summary function, which isn't tuned
+    - base_params: options for anything a candidate leaves out (by default, every
+        feature weighted 1)
+    """
+
+    def __init__(
+        self,
+        data: pd.DataFrame,
+        chain_configs: dict,
+        base_chain_config: dict,
+        train_backwards: bool = True,
+        n_folds: int = 5,
+        seed: int = 0,
+        summary_function: str = "rescaled_power_weight",
+        base_params: Optional[dict] = None,
+    ):
+        self.data = data
+        self.chain_configs = chain_configs
+        self.base_chain_config = base_chain_config
+        self.train_backwards = train_backwards
+        self.n_folds = n_folds
+        self.summary_function = summary_function
+        self.base_params: dict = base_params or {
+            "feature_weights": {f: 1.0 for f in chain_configs}
+        }
+        self.folds: pd.Series = concert_folds(data, n_folds, seed)
+        self.likelihoods: List[ProgramLikelihood] = []
+        self.steps_per_concert: pd.Series = pd.Series(dtype=int)
+        self.leaderboard: pd.DataFrame = pd.DataFrame()
+
+    @classmethod
+    def from_model(cls, model: ChainEnsemble, **kwargs) -> "Calibrator":
+        """cross-validate the configuration (and training data) of a fit model"""
+        return cls(
+            model.train_data,
+            model.chain_configs,
+            {},
+            train_backwards=model.train_backwards,
+            **kwargs,
+        )
+
+    def __repr__(self):
+        status = "prepared" if self.likelihoods else "not prepared"
+        return f"<Calibrator: {self.n_folds} folds, {status}>"
+
+    @property
+    def features(self) -> list:
+        return list(self.chain_configs)
+
+    def prepare(self, n_jobs: int = cpu_count()):
+        """train each fold's model and encode its held-out concerts"""
+        fold_of_row = self.folds.reindex(
+            self.data.index.get_level_values("concert_id")
+        ).values
+        models = ChainEnsemble(
+            self.chain_configs, self.base_chain_config, self.train_backwards
+        ).fold_models(self.data, self.folds, n_jobs=n_jobs)
+        self.likelihoods = []
+        for fold in range(self.n_folds):
+            model = models[fold]
+            scorer = ChainEnsembleScorer(model, summary_function=self.summary_function)
+            held_out = self.data[fold_of_row == fold]
+            self.likelihoods.append(ProgramLikelihood(scorer, held_out))
+
+        self.steps_per_concert = pd.concat(
+            [
+                pd.Series(np.bincount(lik.step_concert), index=lik.concert_ids)
+                for lik in self.likelihoods
+            ]
+        )
+        return self
+
+    def options(self, params: dict) -> dict:
+        """a candidate's tunable options, filled in from base_params"""
+        merged = {**self.base_params, **params}
+        return {k: merged[k] for k in TUNABLE_PARAMS if k in merged}
+
+    def concert_log_likelihoods(self, params: dict) -> pd.Series:
+        """held-out log-likelihood of each concert under one candidate, across every
+        fold (NaN where the concert can't be scored, -inf where it's impossible)"""
+        if not self.likelihoods:
+            raise RuntimeError("call prepare() before evaluating candidates")
+        options = self.options(params)
+        return pd.concat([lik.log_likelihood(**options) for lik in self.likelihoods])
+
+    def summarize(self, results: pd.Series, shared: Optional[pd.Index] = None) -> dict:
+        """a candidate's leaderboard entry from its concert_log_likelihoods; means are
+        over the `shared` concerts (by default, every one it makes possible)"""
+        scored = results.dropna()
+        possible = scored[np.isfinite(scored)]
+        if shared is None:
+            shared = possible.index
+        compared = possible.reindex(shared)
+        return {
+            "mean_log_likelihood": compared.mean(),
+            "mean_step_log_likelihood": (
+                compared.sum() / self.steps_per_concert[shared].sum()
+            ),
+            "impossible_rate": (len(scored) - len(possible)) / max(len(scored), 1),
+            "n_scored": len(scored),
+            "n_unscorable": len(results) - len(scored),
+            "n_excluded": len(possible) - len(shared),
+        }
+
+    def evaluate(self, params: dict) -> dict:
+        """held-out log-likelihood of one candidate across every fold's concerts"""
+        return self.summarize(self.concert_log_likelihoods(params))
+
+    def search(
+        self, candidates: Iterable[dict], n_jobs: int = cpu_count()
+    ) -> pd.DataFrame:
+        """evaluate candidates (in a pool of n_jobs processes when n_jobs > 1) and rank
+        them: fewest held-out concerts the options make impossible, then highest mean
+        log-likelihood over the concerts every candidate makes possible, so all are
+        compared on the same concerts (n_excluded counts each one's others)"""
+        candidates = [self.options(params) for params in candidates]
+        if not self.likelihoods:
+            self.prepare(n_jobs)
+
+        if n_jobs > 1:
+            with Pool(
+                n_jobs, initializer=_set_worker_calibrator, initargs=(self,)
+            ) as pool:
+                results = list(pool.imap(_evaluate_in_worker, candidates, chunksize=1))
+        else:
+            results = [self.concert_log_likelihoods(params) for params in candidates]
+
+        possible = pd.concat([np.isfinite(r) for r in results], axis=1)
+        shared = possible.index[possible.all(axis=1)]
+        leaderboard = pd.DataFrame([self.summarize(r, shared) for r in results])
+        leaderboard["params"] = [json.dumps(p, sort_keys=True) for p in candidates]
+        for k in TUNABLE_PARAMS:
+            if k == "feature_weights":
+                continue
+            leaderboard[k] = [p.get(k) for p in candidates]
+        for feature in self.features:
+            leaderboard["weight:" + feature] = [
+                p.get("feature_weights", {}).get(feature) for p in candidates
+            ]
+        self.leaderboard = leaderboard.sort_values(
+            ["impossible_rate", "mean_log_likelihood"], ascending=[True, False]
+        ).rename_axis("candidate")
+        return self.leaderboard
+
+    def best_params(self) -> dict:
+        return json.loads(self.leaderboard["params"].iloc[0])
+
+    def write_leaderboard(self, path: str) -> None:
+        self.leaderboard.to_csv(path, index=True)
+
+
+# pool workers get the prepared calibrator once, at startup (for free where the pool
+# forks), rather than with every candidate
+_worker_calibrator: Optional[Calibrator] = None
+
+
+def _set_worker_calibrator(calibrator: Calibrator) -> None:
+    global _worker_calibrator
+    _worker_calibrator = calibrator
+
+
+def _evaluate_in_worker(params: dict) -> pd.Series:
+    return _worker_calibrator.concert_log_likelihoods(params)
@@ -1,3 +1,4 @@
+import json
 import os
 
 import dotenv
@@ -7,3 +8,18 @@ dotenv.load_dotenv()
 APP_SECRET = os.getenv("APP_SECRET")
 LOCAL_RAW_DATA_FILE = os.getenv("LOCAL_RAW_DATA_FILE")
 MYSQL_CON = os.getenv("MYSQL_CON")
+# seeded /generate responses: in-process LRU size, and an optional SQLite file shared
+# by every worker on the host
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH")
+
+# programs kept pregenerated for DEFAULTS and for each extra option set in the json list
+# PREFETCH_PARAM_SETS; 0 disables the pool
+PREFETCH_POOL_SIZE = int(os.getenv("PREFETCH_POOL_SIZE", 0))
+PREFETCH_PARAM_SETS = json.loads(os.getenv("PREFETCH_PARAM_SETS", "[]"))
+
+# the model pickle the server loads; with MODEL_WARM_UP=1 (the default) it's loaded on a
+# background thread as soon as the server is imported, otherwise by the first request
+# that needs it. Either way the server answers /ready with 503 until it's loaded
+MODEL_PATH = os.getenv("MODEL_PATH", "data/model_v1.p")
+MODEL_WARM_UP = bool(int(os.getenv("MODEL_WARM_UP", 1)))
@@ -0,0 +1,303 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from nyp.markov import BREAK, ChainEnsembleScorer
+
+# finite stand-ins for transformed scores of +inf (a logit of 1) and the summary kernel's
+# zero, far enough apart that any combo including a zero sums below IMPOSSIBLE / 2
+CERTAIN = 1e100
+IMPOSSIBLE = -1e250
+
+
+class ProgramLikelihood:
+    """
+    Log-likelihood of observed concerts under a scorer's generation process
+
+    Each concert is replayed as the sequence of draws `ChainEnsembleScorer.next_idx`
+    would have to make to produce it (in training order, ending with BREAK). A draw's
+    probability is the picked row's final score over the sum of final scores of every
+    available row, so the likelihood accounts for scrubbing, dead-end fallbacks and the
+    break weight exactly as generation does.
+
+    Everything that doesn't depend on the generation parameters is encoded up front:
+
+    - catalogue rows are grouped by their combination of chain values, since rows
+        sharing every value share a score; sums over the catalogue become sums over
+        these combos, weighted by each combo's case weight total
+    - every chain state the concerts pass through is looked up once, giving a table of
+        transition probabilities per chain
+    - steps are grouped into contexts of chain states and rows scrubbed earlier in the
+        concert; the scrubbed rows are recorded as (context, row) pairs, whose
+        contributions are subtracted from each context's total
+
+    - scorer: supplies the model, catalogue and summary function
+    - data: concerts indexed by [concert_id, selection_id] in program order, e.g. the
+        model's train_data or a held-out frame like it; concerts with selections missing
+        from the scorer's catalogue score as NaN
+    """
+
+    def __init__(self, scorer: ChainEnsembleScorer, data: pd.DataFrame):
+        self.scorer = scorer
+        self.chains = list(scorer.model.chains)
+        self.encode_combos()
+        self.encode_steps(data)
+
+    def __repr__(self):
+        return (
+            f"<ProgramLikelihood: {len(self.concert_ids)} concerts, "
+            f"{len(self.step_rows)} steps in {self.n_contexts} contexts, "
+            f"{self.n_combos} value combos>"
+        )
+
+    def encode_combos(self):
+        scorer = self.scorer
+        codes = np.vstack([scorer.codes[c] for c in self.chains])
+        combos, self.row_combo = np.unique(codes, axis=1, return_inverse=True)
+        self.row_combo = self.row_combo.ravel()
+        self.n_combos: int = combos.shape[1]
+        self.combo_sizes: np.ndarray = np.bincount(
+            self.row_combo, minlength=self.n_combos
+        )
+        # per chain, a (values x combos) one-hot matrix of each combo's value, so scores
+        # by value map onto combos with one matrix product; codes of -1 (values outside
+        # the chain's vocabulary) map to a trailing slot that always scores as zero
+        self.combo_values: dict = {}
+        for i, c in enumerate(self.chains):
+            vocab_size = len(scorer.full_counts[c])
+            codes = np.where(combos[i] >= 0, combos[i], vocab_size)
+            one_hot = np.zeros((vocab_size + 1, self.n_combos))
+            one_hot[codes, np.arange(self.n_combos)] = 1.0
+            self.combo_values[c] = one_hot
+        return self
+
+    def encode_steps(self, data: pd.DataFrame):
+        scorer = self.scorer
+        positions = scorer.positions
+        train_backwards = scorer.model.train_backwards
+        sizes = {
+            c: scorer.model.chain_configs[c].get("state_size") for c in self.chains
+        }
+
+        concert_ids = []
+        step_concert = []
+        step_rows = []
+        step_context = []
+        # a step's scores depend only on its context: every chain's state, plus the rows
+        # scrubbed before it; steps sharing a context (every concert's first step, say)
+        # are scored once
+        contexts: dict = {}
+        self.missing: list = []
+        for concert_id, concert in data.groupby(level="concert_id", sort=False):
+            selection_ids = concert.index.get_level_values("selection_id")
+            pos = positions.get_indexer(selection_ids)
+            if (pos < 0).any():
+                self.missing.append(concert_id)
+                continue
+            pos = list(pos[::-1] if train_backwards else pos) + [scorer.break_pos]
+
+            concert_index = len(concert_ids)
+            concert_ids.append(concert_id)
+            states = {c: (BREAK,) * sizes[c] for c in self.chains}
+            for t, row in enumerate(pos):
+                key = (tuple(states.values()), tuple(sorted(pos[:t])))
+                step_context.append(contexts.setdefault(key, len(contexts)))
+                step_concert.append(concert_index)
+                step_rows.append(row)
+                for c in self.chains:
+                    states[c] = states[c][1:] + (scorer.feature_values[c][row],)
+
+        self.concert_ids = pd.Index(concert_ids, name="concert_id")
+        self.step_concert = np.array(step_concert, dtype=int)
+        self.step_rows = np.array(step_rows, dtype=int)
+        self.step_context = np.array(step_context, dtype=int)
+        self.n_contexts = len(contexts)
+        # steps ordered by context, with each context's first position in that order
+        self.context_order = np.argsort(self.step_context, kind="stable")
+        self.context_bounds = np.searchsorted(
+            self.step_context[self.context_order], np.arange(self.n_contexts + 1)
+        )
+
+        # rows scrubbed before each context, as (context, row) pairs
+        n_scrubbed = [len(scrubbed) for _, scrubbed in contexts]
+        self.pair_contexts = np.repeat(np.arange(self.n_contexts), n_scrubbed)
+        self.pair_rows = np.array(
+            [r for _, scrubbed in contexts for r in scrubbed], dtype=int
+        )
+
+        # per chain, a probability table over each distinct state seen, with the backoff
+        # table in the last row, and each context's row in it
+        self.state_tables: dict = {}
+        self.context_state_ids: dict = {}
+        for i, c in enumerate(self.chains):
+            chain = scorer.model.chains[c]
+            state_ids: dict = {}
+            ids = [
+                state_ids.setdefault(states[i], len(state_ids))
+                for states, _ in contexts
+            ]
+            self.state_tables[c] = np.vstack(
+                [chain.state_vector(s, backoff=True) for s in state_ids]
+                + [chain.state_vector(None)]
+            )
+            self.context_state_ids[c] = np.array(ids, dtype=int)
+        return self
+
+    def context_scores(
+        self,
+        contexts: np.ndarray,
+        weights: dict,
+        weighted_average_exponent: float,
+        backoff: bool = False,
+    ) -> tuple:
+        """(contexts x combos) final scores before case weights, and which combos are
+        scorable, in the given (sorted) contexts; `backoff` scores with every chain's
+        backoff table as next_idx does at a dead end"""
+        scorer = self.scorer
+        kernel = scorer.kernel
+        weight_sum = sum(weights.values())
+
+        # values each context has lost to rows scrubbed earlier in its concert
+        in_chunk = np.isin(self.pair_contexts, contexts)
+        local = np.searchsorted(contexts, self.pair_contexts[in_chunk])
+        scrubbed_rows = self.pair_rows[in_chunk]
+
+        # each chain's weighted, transformed score by value; values scoring as the
+        # kernel's zero get a sentinel that swamps any combo they're part of, and +inf
+        # (a logit of 1) a stand-in that's finite, so the matrix product stays defined
+        by_value = []
+        for c, w in weights.items():
+            counts = np.tile(scorer.full_counts[c], (len(contexts), 1))
+            codes = scorer.codes[c][scrubbed_rows]
+            keep = codes >= 0
+            np.subtract.at(counts, (local[keep], codes[keep]), 1)
+
+            if backoff:
+                probas = np.tile(self.state_tables[c][-1], (len(contexts), 1))
+            else:
+                probas = self.state_tables[c][self.context_state_ids[c][contexts]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                transformed = kernel.transform(probas / counts)
+            zero = (counts == 0) | (transformed == kernel.zero)
+            np.minimum(transformed, CERTAIN, out=transformed)
+            transformed *= w / weight_sum
+            transformed[zero] = IMPOSSIBLE
+            outside = np.full((len(contexts), 1), IMPOSSIBLE)
+            by_value.append(np.hstack([transformed, outside]))
+
+        total = np.hstack(by_value) @ np.vstack([self.combo_values[c] for c in weights])
+        valid = total > IMPOSSIBLE / 2
+
+        with np.errstate(over="ignore", invalid="ignore"):
+            if kernel.inverse is np.exp:
+                scores = np.exp(total * weighted_average_exponent, out=total)
+            else:
+                scores = np.power(
+                    kernel.inverse(total, out=total), weighted_average_exponent
+                )
+        scores[~valid] = 0.0
+        return scores, valid, local, scrubbed_rows
+
+    def log_likelihood(
+        self,
+        feature_weights: dict,
+        weighted_average_exponent: float = 1.0,
+        case_weight_exponent: float = 1.0,
+        break_weight: Optional[float] = None,
+        chunk_size: int = 512,
+    ) -> pd.Series:
+        """log-likelihood of each concert under a set of `generate_program` options"""
+        scorer = self.scorer
+        weights = {c: w for c, w in feature_weights.items() if w is not None and w > 0}
+        if break_weight is None:
+            break_weight = scorer.default_break_weight
+
+        row_weights = scorer.raw_weights.copy()
+        row_weights[[scorer.break_pos, scorer.intermission_pos]] = break_weight
+        row_weights = np.power(row_weights, case_weight_exponent)
+        combo_weights = np.bincount(
+            self.row_combo, weights=row_weights, minlength=self.n_combos
+        )
+
+        step_ll = np.empty(len(self.step_rows))
+        for start in range(0, self.n_contexts, chunk_size):
+            stop = min(start + chunk_size, self.n_contexts)
+            steps = self.context_order[
+                self.context_bounds[start] : self.context_bounds[stop]
+            ]
+            step_ll[steps] = self.chunk_log_likelihood(
+                np.arange(start, stop),
+                steps,
+                weights,
+                weighted_average_exponent,
+                row_weights,
+                combo_weights,
+            )
+
+        result = np.bincount(
+            self.step_concert, weights=step_ll, minlength=len(self.concert_ids)
+        )
+        # -inf steps make bincount's sums nan; keep them as -inf
+        impossible = np.bincount(
+            self.step_concert, weights=np.isneginf(step_ll), minlength=len(result)
+        )
+        result[impossible > 0] = -np.inf
+        out = pd.Series(result, index=self.concert_ids, name="log_likelihood")
+        if self.missing:
+            out = pd.concat(
+                [out, pd.Series(np.nan, index=self.missing, name=out.name)]
+            ).rename_axis("concert_id")
+        return out
+
+    def chunk_log_likelihood(
+        self,
+        contexts: np.ndarray,
+        steps: np.ndarray,
+        weights: dict,
+        weighted_average_exponent: float,
+        row_weights: np.ndarray,
+        combo_weights: np.ndarray,
+        backoff: bool = False,
+    ) -> np.ndarray:
+        """log-probability of each of `steps`' picks, given `contexts` (sorted) covers
+        every step's context"""
+        scores, valid, local, scrubbed_rows = self.context_scores(
+            contexts, weights, weighted_average_exponent, backoff
+        )
+        scrubbed_combos = self.row_combo[scrubbed_rows]
+
+        # available scorable rows per context, to find dead ends exactly
+        n_scorable = valid.astype(int) @ self.combo_sizes
+        np.subtract.at(n_scorable, local, valid[local, scrubbed_combos])
+
+        normalizer = scores @ combo_weights
+        np.subtract.at(
+            normalizer,
+            local,
+            scores[local, scrubbed_combos] * row_weights[scrubbed_rows],
+        )
+
+        step_local = np.searchsorted(contexts, self.step_context[steps])
+        picked = self.step_rows[steps]
+        numerator = scores[step_local, self.row_combo[picked]] * row_weights[picked]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = np.log(numerator) - np.log(normalizer[step_local])
+
+        dead_ends = n_scorable == 0
+        if dead_ends.any() and not backoff:
+            at_dead_end = dead_ends[step_local]
+            result[at_dead_end] = self.chunk_log_likelihood(
+                contexts[dead_ends],
+                steps[at_dead_end],
+                weights,
+                weighted_average_exponent,
+                row_weights,
+                combo_weights,
+                backoff=True,
+            )
+        return result
+
+    def total_log_likelihood(self, *args, **kwargs) -> float:
+        """summed log-likelihood of every scorable concert"""
+        return float(self.log_likelihood(*args, **kwargs).dropna().sum())
@@ -1,9 +1,19 @@
-from collections import defaultdict
+import copy
+import itertools
+import pickle
+import threading
+import uuid
+from collections import OrderedDict, defaultdict, namedtuple
 from multiprocessing import Pool, cpu_count
+from time import perf_counter
 from typing import Optional, Union
 
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+from nyp.backends import NumpyBackend, get_backend
+from nyp.tracing import SAMPLERS, GenerationTrace
 
 BREAK = "___BREAK__"
 MINOR = "___MINOR__"
@@ -15,20 +25,63 @@ def _internal_defaultdict_int():
     return defaultdict(int)
 
 
+def identity(x: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    if out is None or out is x:
+        return x
+    out[:] = x
+    return out
+
+
+def log(p: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore"):
+        return np.log(p)
+
+
+def logit(p: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore"):
+        return np.log(p) - np.log1p(-p)
+
+
+def expit(x: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """1 / (1 + exp(-x)), in place when `out` is given"""
+    with np.errstate(over="ignore"):
+        out = np.negative(x, out=out)
+        np.exp(out, out=out)
+        out += 1
+        return np.reciprocal(out, out=out)
+
+
+# each summary is g(sum(w * f(p)) / sum(w)) for a transform f and inverse g (which takes
+# an `out` array like a numpy ufunc); `zero` is f(0), so scores can be transformed once,
+# up front, and filtered in transformed space
+SummaryKernel = namedtuple("SummaryKernel", ("transform", "inverse", "zero"))
+
+SUMMARY_KERNELS = {
+    "simple_weighted_avg": SummaryKernel(identity, identity, 0.0),
+    "sum_weighted_log_odds": SummaryKernel(logit, expit, -np.inf),
+    "rescaled_power_weight": SummaryKernel(log, np.exp, -np.inf),
+}
+
+
+def summarize(kernel: SummaryKernel, p: np.ndarray, w: np.ndarray) -> np.ndarray:
+    """apply a summary kernel to each row-like array of p as one matrix-vector product"""
+    return kernel.inverse(kernel.transform(p) @ (w / w.sum()))
+
+
 def simple_weighted_avg(p: np.ndarray, w: np.ndarray) -> np.ndarray:
-    return np.sum(p * w, axis=1) / w.sum()
+    return summarize(SUMMARY_KERNELS["simple_weighted_avg"], p, w)
 
 
 def sum_weighted_log_odds(p: np.ndarray, w: np.ndarray) -> np.ndarray:
     """calculate weighted odds by taking a weighted sum in log-odds space,
     then convert back to probability"""
-    weighted_odds = np.exp(np.sum(np.log(p / (1 - p)) * w, axis=1) / w.sum())
-    return weighted_odds / (1 + weighted_odds)
+    return summarize(SUMMARY_KERNELS["sum_weighted_log_odds"], p, w)
 
 
 def rescaled_power_weight(p: np.ndarray, w: np.ndarray) -> np.ndarray:
-    """for each row-like array of p, p0,0^w0 * p0,1^w1 ... * p0,x^wx"""
-    return np.power(np.prod(p ** w, axis=1), (1 / w.sum()))
+    """for each row-like array of p, (p0,0^w0 * p0,1^w1 ... * p0,x^wx)^(1 / sum(w)),
+    computed as a weighted mean in log space so many features can't underflow"""
+    return summarize(SUMMARY_KERNELS["rescaled_power_weight"], p, w)
 
 
 AVAILABLE_SUMMARY_FUNCTIONS = {
@@ -37,6 +90,100 @@ AVAILABLE_SUMMARY_FUNCTIONS = {
     "rescaled_power_weight": rescaled_power_weight,
 }
 
+# categories every modeled feature reserves, so sentinel rows can be added to (and
+# minor values remapped in) a categorical frame without changing its dtype
+RESERVED_CATEGORIES = [BREAK, MINOR, INTERMISSION]
+
+
+def is_categorical(values) -> bool:
+    return isinstance(getattr(values, "dtype", None), pd.CategoricalDtype)
+
+
+def sorted_index(values) -> pd.Index:
+    """values as an Index, sorted where they're comparable"""
+    index = pd.Index(values, dtype=object)
+    try:
+        return index.sort_values()
+    except TypeError:
+        return index
+
+
+def as_categorical(values: pd.Series) -> pd.Series:
+    """a feature Series as a Categorical over the reserved categories and its own
+    values (sorted); categorical Series that already reserve them are returned as is"""
+    if is_categorical(values) and set(RESERVED_CATEGORIES).issubset(
+        values.cat.categories
+    ):
+        return values
+    observed = pd.unique(values.dropna())
+    observed = sorted_index(observed[~pd.Index(observed).isin(RESERVED_CATEGORIES)])
+    categories = pd.Index(RESERVED_CATEGORIES, dtype=object).append(observed)
+    return values.astype(pd.CategoricalDtype(categories))
+
+
+def categorize_features(data: pd.DataFrame, columns: list) -> pd.DataFrame:
+    """a copy of `data` with `columns` converted by as_categorical"""
+    return data.assign(**{c: as_categorical(data[c]) for c in columns})
+
+
+def align_categories(data: pd.DataFrame, other: pd.DataFrame, columns: list) -> tuple:
+    """`data` and `other` with the same categories in each of `columns` (data's, then
+    any new to other), so concatenating them keeps the categorical dtypes"""
+    data = categorize_features(data, columns)
+    other = categorize_features(other, columns)
+    for c in columns:
+        categories = data[c].cat.categories
+        extra = other[c].cat.categories.difference(categories, sort=False)
+        if len(extra):
+            categories = categories.append(extra)
+            data[c] = data[c].cat.add_categories(extra)
+        other[c] = other[c].cat.set_categories(categories)
+    return data, other
+
+
+def categorical_from_codes(codes: np.ndarray, values: np.ndarray) -> pd.Categorical:
+    """`values[codes]` as a Categorical with sorted categories, working on the (short)
+    `values` table only; values may repeat or be missing"""
+    present = np.zeros(len(values), dtype=bool)
+    present[codes] = True
+    value_codes, categories = pd.factorize(np.where(present, values, None))
+    categories = pd.Index(categories, dtype=object)
+    ordered = sorted_index(categories)
+    rank = np.append(ordered.get_indexer(categories), -1)
+    return pd.Categorical.from_codes(rank[value_codes][codes], ordered)
+
+
+def replace_categories(values: pd.Series, replaced, replacement) -> pd.Series:
+    """a categorical Series with any of `replaced` swapped for `replacement`, by
+    remapping codes rather than comparing every element"""
+    categories = values.cat.categories
+    hit = categories.isin(replaced)
+    if not hit.any():
+        return values.copy()
+    if replacement not in categories:
+        categories = categories.append(pd.Index([replacement], dtype=object))
+    remap = np.arange(len(categories))
+    remap[: len(hit)][hit] = categories.get_loc(replacement)
+    codes = np.append(remap, -1)[values.cat.codes.values]
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories),
+        index=values.index,
+        name=values.name,
+    )
+
+
+def minor_values(summary: pd.Series, cull_threshold: Union[int, float]) -> np.ndarray:
+    """values under a cull threshold (see Chain), given how many times each
+    (non-BREAK) value appears"""
+    if cull_threshold < 0:
+        raise ValueError("cull_threshold should be >= 0")
+
+    # convert summary to percentages if needed
+    if 0 < cull_threshold < 1:
+        summary = summary / sum(summary)
+
+    return summary.index[summary < cull_threshold].values
+
 
 class Chain:
     """
@@ -66,6 +213,9 @@ class Chain:
         self.cull_threshold: Union[int, float] = cull_threshold
 
         self.minor_values: list = []
+        # raw transitions merged by culling, filled by pre_process_data
+        self.minor_counts: dict = defaultdict(_internal_defaultdict_int)
+        self.is_compact: bool = False
 
         new_data = data.copy()  # don't modify in place
         self.data: pd.Series = self.pre_process_data(new_data)
@@ -73,10 +223,29 @@ class Chain:
         self.probas: dict = {
             k: self.counts_to_probabilities(v) for k, v in self.counts.items()
         }
+        self.build_tables()
 
     def __repr__(self):
         return f"<Chain ({self.name}): {{{self.sample_data_str}}}>"
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # fill in tables added since older models were pickled
+        if "cache_key" not in state:
+            self.build_tables()
+
+    def build_tables(self):
+        """derive the lookup tables used for scoring from the fitted counts"""
+        # backoff table: outcome frequencies over every state, used at dead ends
+        self.backoff_probas: dict = self.counts_to_probabilities(self.marginal_counts())
+        # outcome values in a fixed order, to express probabilities as vectors
+        # (sorted where comparable: missing values and mixed types are allowed)
+        self.vocab: np.ndarray = np.asarray(
+            sorted_index(list(self.backoff_probas)), dtype=object
+        )
+        # identifies this fit in caches shared across copies of the chain
+        self.cache_key: str = uuid.uuid4().hex
+
     @property
     def sample_data_str(self) -> str:
         """string of first few chain items"""
@@ -90,35 +259,210 @@ class Chain:
 
     def pre_process_data(self, data: pd.Series) -> pd.Series:
         """pre-process the data (including culling) into a clean character vector"""
+        k = self.state_size
+
+        # integer-code the values; BREAK and missing values get the last two codes
+        codes, uniques = pd.factorize(data)
+        n_values = len(uniques)
+        values = np.empty(n_values + 2, dtype=object)
+        values[:n_values] = uniques.tolist() if n_values else []
+        values[n_values] = BREAK
+        values[n_values + 1] = np.nan
+        codes = np.where(codes < 0, n_values + 1, codes)
+
+        # each concert (in sorted order) followed by state_size breaks, with another
+        # state_size breaks in front: row j of the sorted data, in concert g, lands at
+        # k + j + k * g
+        groups = pd.factorize(data.index.get_level_values(0), sort=True)[0]
+        order = np.argsort(groups, kind="stable")
+        n_groups = groups.max() + 1 if len(groups) else 0
+        sequence = np.full(k + len(data) + k * n_groups, n_values, dtype=np.int64)
+        sequence[k + np.arange(len(data)) + k * groups[order]] = codes[order]
+
+        if self.train_backwards:
+            sequence = sequence[::-1]
+
+        if self.cull:
+            summary = pd.Series(
+                np.bincount(codes, minlength=n_values)[:n_values],
+                index=values[:n_values],
+            )
+            self.minor_values = self.find_minor_values(
+                summary.sort_values(ascending=False)
+            )
+            is_minor = np.zeros(len(values), dtype=bool)
+            is_minor[:n_values] = pd.Index(values[:n_values]).isin(self.minor_values)
+            # the raw transitions culling is about to merge, so it can be redone later
+            self.minor_counts = self.count_windows(
+                sequence, values, np.flatnonzero(is_minor[sequence])
+            )
+            values = np.where(is_minor, MINOR, values)
+
+        processed = pd.Series(categorical_from_codes(sequence, values))
+        if self.train_backwards:
+            # index as if reversed after building, like the sequence itself
+            processed.index = processed.index[::-1]
+        return processed
+
+    def compact(self):
+        """drop the training series and counts, keeping what scoring reads: the
+        probability tables, vocabulary and minor values"""
+        self.data = pd.Series([], dtype="category", name=self.data.name)
+        self.counts = {}
+        self.minor_counts = None
+        self.is_compact = True
+        return self
 
-        # initialize a receptacle and break values
-        break_values = [BREAK] * self.state_size
-        raw_values = break_values.copy()
+    def count_windows(
+        self, sequence: np.ndarray, values: np.ndarray, positions: np.ndarray
+    ) -> dict:
+        """transition counts of the windows of `values[sequence]` that include any of
+        `positions`"""
+        k = self.state_size
+        starts = (positions[:, None] - np.arange(k + 1)).ravel()
+        starts = np.unique(starts[(starts >= 0) & (starts < len(sequence) - k)])
+        lookup: defaultdict = defaultdict(_internal_defaultdict_int)
+        for i in starts:
+            lookup[tuple(values[sequence[i : i + k]])][values[sequence[i + k]]] += 1
+        return lookup
 
-        for i, d in data.groupby(level=0):
-            raw_values += d.values.tolist() + break_values
+    def find_minor_values(self, summary: pd.Series) -> np.ndarray:
+        """values to cull, given how many times each (non-BREAK) value appears"""
+        return minor_values(summary, self.cull_threshold)
 
-        values = pd.Series(raw_values)
+    @classmethod
+    def from_counts(
+        cls,
+        name: str,
+        raw_counts: dict,
+        state_size: int = 1,
+        train_backwards: bool = True,
+        cull: bool = True,
+        cull_threshold: Union[int, float] = 0.01,
+        value_counts: Optional[pd.Series] = None,
+    ) -> "Chain":
+        """
+        build a chain from transition counts over raw values, as fit by a chain with
+        cull=False; culling is applied to the counts, so the result matches a chain
+        fit directly on the data the counts came from
 
+        Counts add up per concert, so counts for any set of concerts can be derived
+        from others (see `add_counts` and `subtract_counts`) without revisiting the
+        data. The chain keeps no training data.
+        """
+        chain = cls.__new__(cls)
+        chain.name = name
+        chain.state_size = state_size
+        chain.train_backwards = train_backwards
+        chain.cull = cull
+        chain.cull_threshold = cull_threshold
+        chain.data = pd.Series([], dtype=object)
+        chain.is_compact = False
+        return chain.set_raw_counts(raw_counts, value_counts)
+
+    @staticmethod
+    def value_counts(raw_counts: dict) -> pd.Series:
+        """how many times each value appears in the data raw_counts were counted from;
+        every value after the leading breaks is an outcome once, so these are the
+        outcome totals (less BREAK)"""
+        value_counts: defaultdict = defaultdict(int)
+        for outcomes in raw_counts.values():
+            for out_val, count in outcomes.items():
+                if out_val != BREAK:
+                    value_counts[out_val] += count
+        return pd.Series(value_counts, dtype=float).sort_values(ascending=False)
+
+    def set_raw_counts(
+        self, raw_counts: dict, value_counts: Optional[pd.Series] = None
+    ):
+        """derive culling, counts and probabilities from counts over raw values;
+        `value_counts` (as from Chain.value_counts) saves recounting them when several
+        chains are derived from the same raw counts"""
+        self.minor_values = []
         if self.cull:
+            if value_counts is None:
+                value_counts = self.value_counts(raw_counts)
+            self.minor_values = self.find_minor_values(value_counts)
 
-            if self.cull_threshold < 0:
-                raise ValueError("cull_threshold should be >= 0")
+        self.counts, self.minor_counts = cull_counts(raw_counts, self.minor_values)
+        self.probas = {
+            k: self.counts_to_probabilities(v) for k, v in self.counts.items()
+        }
+        self.build_tables()
+        return self
 
-            summary = values[values != BREAK].value_counts()
+    def raw_counts(self) -> dict:
+        """transition counts over raw values, as if fit with cull=False"""
+        if len(self.minor_values) == 0:
+            return self.counts
+        self.check_updatable()
+        raw: defaultdict = defaultdict(_internal_defaultdict_int)
+        for in_val, outcomes in self.counts.items():
+            if MINOR in in_val:
+                continue
+            for out_val, count in outcomes.items():
+                if out_val != MINOR:
+                    raw[in_val][out_val] = count
+        return add_counts([raw, self.minor_counts])
+
+    def check_updatable(self):
+        """raise if the chain can't recover its raw counts, which partial_fit needs"""
+        if getattr(self, "is_compact", False):
+            raise ValueError(f"{self.name} chain was compacted; refit it instead")
+        if len(self.minor_values) and getattr(self, "minor_counts", None) is None:
+            raise ValueError(
+                f"{self.name} chain was fit without keeping its culled transitions; "
+                "refit it to recover raw counts"
+            )
 
-            # convert summary to percentages if needed
-            if 0 < self.cull_threshold < 1:
-                summary = summary / sum(summary)
+    def partial_fit(self, new_data: pd.Series):
+        """
+        add the transitions of new concerts, a Series like the one the chain was fit on
 
-            self.minor_values = summary.index[summary < self.cull_threshold].values
+        Cull thresholds are re-checked against the combined value counts. Unless that
+        changes which values are culled, only the states the new concerts pass through
+        have their probabilities recomputed. `data` gets the new concerts appended,
+        culled as of this update.
+        """
+        self.check_updatable()
+        new = Chain(new_data, self.state_size, self.train_backwards, cull=False)
+        new_values = new.data
 
-            values[values.isin(self.minor_values)] = MINOR
+        minor = set(self.minor_values)
+        if self.cull:
+            raw = add_counts([self.raw_counts(), new.counts])
+            if set(self.find_minor_values(self.value_counts(raw))) != minor:
+                self.set_raw_counts(raw)
+                self.append_data(new_values)
+                return self
+
+        touched = set()
+        for in_val, outcomes in new.counts.items():
+            state = tuple(MINOR if v in minor else v for v in in_val)
+            touched.add(state)
+            for out_val, count in outcomes.items():
+                culled = MINOR if out_val in minor else out_val
+                self.counts[state][culled] += count
+                if state != in_val or culled != out_val:
+                    self.minor_counts[in_val][out_val] += count
+        for state in touched:
+            self.probas[state] = self.counts_to_probabilities(self.counts[state])
+        self.build_tables()
+        self.append_data(new_values)
+        return self
 
+    def append_data(self, new_values: pd.Series):
+        """extend `data` with another pre-processed (but not culled) sequence; both
+        begin and end with breaks, so one set of them is dropped at the seam"""
+        if len(self.data) == 0:
+            return self
+        new_values = replace_categories(new_values, self.minor_values, MINOR).values
+        k = self.state_size
+        parts = [self.data.values, new_values[k:]]
         if self.train_backwards:
-            values = values[::-1]
-
-        return values
+            parts = [new_values[: len(new_values) - k], self.data.values]
+        self.data = pd.Series(union_categoricals(parts, sort_categories=True))
+        return self
 
     @classmethod
     def counts_to_probabilities(cls, counts: dict) -> dict:
@@ -130,48 +474,102 @@ class Chain:
         loosely adapted from jsvine/markovify; major difference is that this is set to accept a full corpus
         all at once with interpolated beginning/end markers
         """
+        k = self.state_size
         lookup: defaultdict = defaultdict(_internal_defaultdict_int)
-
-        # accumulate counts of each input to output
-        for i in range(len(self.data) - self.state_size):
-            slice_end = i + self.state_size
-            in_val = tuple(self.data.iloc[i:slice_end])
-            out_val = self.data.iloc[i + self.state_size]
-
-            lookup[in_val][out_val] += 1
+        if len(self.data) <= k:
+            return lookup
+
+        # count each distinct window of codes once; code -1 (missing) becomes the nan
+        # at the end of the values table
+        codes, uniques = pd.factorize(self.data)
+        values = np.append(np.asarray(uniques, dtype=object), np.nan)
+        codes = np.where(codes < 0, len(values) - 1, codes).astype(np.int64)
+        windows, counts = get_backend().count_windows(codes, k + 1, len(values))
+        for window, count in zip(values[windows].tolist(), counts.tolist()):
+            lookup[tuple(window[:k])][window[k]] += count
 
         return lookup
 
-    def get_probas(self, in_val: tuple):
-        """fetch the probabilities for a given input"""
+    def marginal_counts(self) -> dict:
+        """counts of each outcome, summed over all states"""
+        marginal: defaultdict = defaultdict(int)
+        for outcomes in self.counts.values():
+            for out_val, count in outcomes.items():
+                marginal[out_val] += count
+        return dict(marginal)
+
+    def clean_state(self, in_val: tuple) -> tuple:
+        """replace minor values in a state tuple with the placeholder"""
+        return tuple(i if i not in self.minor_values else MINOR for i in in_val)
+
+    def has_state(self, in_val: tuple) -> bool:
+        """whether the chain has seen `in_val` (after minor value substitution)"""
+        return self.clean_state(in_val) in self.probas
+
+    def get_probas(self, in_val: tuple, backoff: bool = False):
+        """fetch the probabilities for a given input; unseen inputs raise a ValueError
+        unless `backoff`, in which case the chain's backoff table is returned
+        """
 
         if len(in_val) != self.state_size:
             raise ValueError("Input value length does not equal Chain state size")
 
         # replace minor values with placeholder
-        in_val = tuple(i if i not in self.minor_values else MINOR for i in in_val)
+        in_val = self.clean_state(in_val)
 
         # this has to be explicit since self.probas is now a default dict
         if in_val not in self.probas:
+            if backoff:
+                return self.backoff_probas
             raise ValueError(
                 f"Value {in_val} is not keyed in chain data for {self.name} chain"
             )
 
         return self.probas[in_val]
 
+    def encode(self, values) -> np.ndarray:
+        """positions of values in self.vocab, -1 where the chain never saw the value"""
+        if is_categorical(values):
+            # look up each category once; code -1 (missing) maps to the trailing -1
+            values = pd.Categorical(values)
+            lookup = self.encode(values.categories)
+            return np.append(lookup, -1)[values.codes]
+        return pd.Index(self.vocab).get_indexer(np.asarray(values, dtype=object))
+
+    def state_vector(
+        self, in_val: Optional[tuple], backoff: bool = False
+    ) -> np.ndarray:
+        """outcome probabilities for a state, indexed like self.vocab; `in_val` of None
+        gives the backoff table"""
+        probas = (
+            self.backoff_probas if in_val is None else self.get_probas(in_val, backoff)
+        )
+        vector = np.zeros(len(self.vocab))
+        vector[self.encode(list(probas))] = list(probas.values())
+        return vector
+
     def transform_scoring_series(self, data: pd.Series) -> pd.Series:
         """transform the values in the scoring series to accommodate culled minor value substitution"""
+        if is_categorical(data):
+            return replace_categories(data, self.minor_values, MINOR)
         data = data.copy()
         data.loc[data.isin(self.minor_values)] = MINOR
         return data
 
-    def score_series(self, new_data: pd.Series, in_val: tuple) -> pd.Series:
-        """apply the modeled scores to a new series of data"""
+    def score_series(
+        self, new_data: pd.Series, in_val: Optional[tuple], backoff: bool = False
+    ) -> pd.Series:
+        """apply the modeled scores to a new series of data; `in_val` of None scores
+        with the backoff table regardless of state"""
 
         # set up a series indexed by its own values
-        new_data = pd.Series(new_data.values, index=new_data.values, name=new_data.name)
+        values = np.asarray(new_data, dtype=object)
+        new_data = pd.Series(values, index=values, name=new_data.name)
 
-        probas = self.get_probas(in_val)
+        if in_val is None:
+            probas = self.backoff_probas
+        else:
+            probas = self.get_probas(in_val, backoff)
         counts = new_data.value_counts()
 
         # divide each probability by the number of scoring cases
@@ -184,6 +582,436 @@ class Chain:
         return new_data
 
 
+class VariableOrderChain(Chain):
+    """
+    build a variable-order Markov Chain from a categorical Series
+
+    Counts for every order from 0 up to `state_size` are kept in an array-backed trie:
+    one level per order, each a sorted array of integer context keys (the context's
+    value codes, most recent first, in mixed radix) with its outcome counts stored
+    CSR-style. Looking up a state walks the levels until the context stops matching,
+    so any state can be scored from its longest seen suffix.
+
+    - smoothing: "interpolate" (Witten-Bell interpolation across all matched orders,
+         default) or "backoff" (maximum likelihood of the longest matched suffix)
+    - other arguments as for Chain; state_size is the maximum order
+    """
+
+    def __init__(
+        self,
+        data: pd.Series,
+        state_size: int = 2,
+        train_backwards: bool = True,
+        cull: bool = True,
+        cull_threshold: Union[int, float] = 0.01,
+        smoothing: str = "interpolate",
+    ):
+        if smoothing not in ("interpolate", "backoff"):
+            raise ValueError('smoothing should be one of "interpolate" or "backoff"')
+
+        self.name: str = data.name or "unnamed"
+        self.state_size: int = state_size
+        self.train_backwards: bool = train_backwards
+        self.cull: bool = cull
+        self.cull_threshold: Union[int, float] = cull_threshold
+        self.smoothing: str = smoothing
+
+        self.minor_values: list = []
+        self.is_compact: bool = False
+
+        new_data = data.copy()  # don't modify in place
+        self.data: pd.Series = self.pre_process_data(new_data)
+
+        # integer-code the values; every lookup after this point works on codes
+        codes, vocab = pd.factorize(self.data, sort=True)
+        self.vocab: np.ndarray = np.asarray(vocab, dtype=object)
+        self.n_values: int = len(self.vocab)
+        self.fill_trie(codes.astype(np.int64))
+
+    @property
+    def counts(self) -> dict:
+        """counts of the full-order contexts, keyed by state tuple as in Chain"""
+        k = self.state_size
+        counts: dict = {}
+        for node, key in enumerate(self.level_keys[k]):
+            state = tuple(self.vocab[self.key_to_codes(key, k)])
+            start, end = self.level_offsets[k][node], self.level_offsets[k][node + 1]
+            counts[state] = {
+                self.vocab[o]: int(c)
+                for o, c in zip(
+                    self.level_outcomes[k][start:end], self.level_counts[k][start:end]
+                )
+            }
+        return counts
+
+    def key_to_codes(self, key: int, order: int) -> list:
+        """decode a context key into value codes, oldest first"""
+        codes = []
+        for _ in range(order):
+            key, code = divmod(int(key), self.n_values)
+            codes.append(code)
+        return codes
+
+    def fill_trie(self, codes: np.ndarray, counts: Optional[np.ndarray] = None):
+        """
+        count outcomes after every context of every order in one vectorized pass
+        per order, replacing any trie already built
+
+        `codes` is the coded training sequence or, given `counts`, rows of
+        state_size + 1 codes (a full-order context and its outcome) with how many
+        times each appears: every shorter context is a suffix of a full-order one, so
+        those counts are all the trie needs.
+        """
+        if float(self.n_values) ** (self.state_size + 1) >= 2**62:
+            raise ValueError(
+                f"{self.name} chain has too many values for a trie of order "
+                f"{self.state_size}"
+            )
+        if counts is None:
+            windows = np.lib.stride_tricks.sliding_window_view(
+                codes, self.state_size + 1
+            )
+        else:
+            windows = codes.reshape(-1, self.state_size + 1)
+        outcomes = windows[:, self.state_size]
+
+        # level k holds contexts of length k; level 0 is the single empty context
+        self.level_keys: list = []
+        self.level_offsets: list = []
+        self.level_outcomes: list = []
+        self.level_counts: list = []
+        keys = np.zeros(len(windows), dtype=np.int64)
+        for k in range(self.state_size + 1):
+            if k > 0:
+                # extend each context one value further into the past
+                keys = keys * self.n_values + windows[:, self.state_size - k]
+
+            if counts is None:
+                pairs, pair_counts = np.unique(
+                    keys * self.n_values + outcomes, return_counts=True
+                )
+            else:
+                pairs, inverse = np.unique(
+                    keys * self.n_values + outcomes, return_inverse=True
+                )
+                pair_counts = np.bincount(inverse, weights=counts)
+            node_keys, pair_outcomes = np.divmod(pairs, self.n_values)
+            level_keys, starts = np.unique(node_keys, return_index=True)
+
+            self.level_keys.append(level_keys)
+            self.level_offsets.append(np.append(starts, len(pairs)).astype(np.int64))
+            self.level_outcomes.append(pair_outcomes.astype(np.int32))
+            self.level_counts.append(pair_counts.astype(np.int64))
+
+        self.backoff_probas: dict = self.vector_to_probas(self.order_probas(0, 0))
+        # identifies this fit in caches shared across copies of the chain
+        self.cache_key: str = uuid.uuid4().hex
+
+    def set_raw_counts(
+        self, raw_counts: dict, value_counts: Optional[pd.Series] = None
+    ):
+        """rebuild culling, vocabulary and trie from full-order counts over raw
+        values; see Chain.set_raw_counts"""
+        self.minor_values = []
+        if self.cull:
+            if value_counts is None:
+                value_counts = self.value_counts(raw_counts)
+            self.minor_values = self.find_minor_values(value_counts)
+        counts, self.minor_counts = cull_counts(raw_counts, self.minor_values)
+
+        rows = [
+            in_val + (out_val,)
+            for in_val, outcomes in counts.items()
+            for out_val in outcomes
+        ]
+        self.vocab = np.array(sorted({v for row in rows for v in row}), dtype=object)
+        self.n_values = len(self.vocab)
+        code = {v: i for i, v in enumerate(self.vocab)}
+        windows = np.array(
+            [[code[v] for v in row] for row in rows], dtype=np.int64
+        ).reshape(-1, self.state_size + 1)
+        weights = np.fromiter(
+            (c for outcomes in counts.values() for c in outcomes.values()),
+            dtype=np.int64,
+            count=len(rows),
+        )
+        self.fill_trie(windows, weights)
+        return self
+
+    def encode_state(self, in_val: tuple) -> Optional[list]:
+        """value codes of a state, most recent first, stopping at the first value the
+        chain has never seen"""
+        in_val = self.clean_state(in_val)
+        codes = []
+        for value in reversed(in_val):
+            pos = np.searchsorted(self.vocab, value)
+            if pos >= self.n_values or self.vocab[pos] != value:
+                break
+            codes.append(int(pos))
+        return codes
+
+    def match_nodes(self, in_val: tuple) -> list:
+        """trie node index at each order of the longest matching suffix of `in_val`,
+        from order 0 up"""
+        nodes = [0]
+        key = 0
+        for k, code in enumerate(self.encode_state(in_val), start=1):
+            key = key * self.n_values + code
+            level = self.level_keys[k]
+            pos = np.searchsorted(level, key)
+            if pos >= len(level) or level[pos] != key:
+                break
+            nodes.append(int(pos))
+        return nodes
+
+    def matched_order(self, in_val: tuple) -> int:
+        return len(self.match_nodes(in_val)) - 1
+
+    def has_state(self, in_val: tuple) -> bool:
+        """every state can be scored from some suffix; true if the full state was seen"""
+        return self.matched_order(in_val) == self.state_size
+
+    def order_probas(self, order: int, node: int) -> np.ndarray:
+        """maximum likelihood outcome probabilities at one trie node"""
+        start, end = (
+            self.level_offsets[order][node],
+            self.level_offsets[order][node + 1],
+        )
+        counts = np.zeros(self.n_values)
+        counts[self.level_outcomes[order][start:end]] = self.level_counts[order][
+            start:end
+        ]
+        return counts / counts.sum()
+
+    def state_vector(self, in_val: Optional[tuple], backoff: bool = True) -> np.ndarray:
+        """outcome probabilities for a state from its longest seen suffix, indexed like
+        self.vocab; `in_val` of None gives the order 0 probabilities"""
+        if in_val is None:
+            return self.order_probas(0, 0)
+        nodes = self.match_nodes(in_val)
+        if self.smoothing == "backoff":
+            return self.order_probas(len(nodes) - 1, nodes[-1])
+
+        probas = self.order_probas(0, 0)
+        for order, node in enumerate(nodes[1:], start=1):
+            start = self.level_offsets[order][node]
+            end = self.level_offsets[order][node + 1]
+            total = self.level_counts[order][start:end].sum()
+            n_types = end - start
+            counts = np.zeros(self.n_values)
+            counts[self.level_outcomes[order][start:end]] = self.level_counts[order][
+                start:end
+            ]
+            probas = (counts + n_types * probas) / (total + n_types)
+        return probas
+
+    def vector_to_probas(self, vector: np.ndarray) -> dict:
+        return {self.vocab[i]: vector[i] for i in np.flatnonzero(vector)}
+
+    def get_probas(self, in_val: tuple, backoff: bool = True):
+        """fetch the probabilities for a given input from its longest seen suffix;
+        `backoff` is accepted for compatibility with Chain and always applies"""
+        if len(in_val) != self.state_size:
+            raise ValueError("Input value length does not equal Chain state size")
+        return self.vector_to_probas(self.state_vector(in_val))
+
+    def compact(self):
+        """drop the training series; the trie is the model"""
+        self.data = pd.Series([], dtype=object, name=self.data.name)
+        self.is_compact = True
+        return self
+
+    def partial_fit(self, new_data: pd.Series):
+        """
+        add the transitions of new concerts, as Chain.partial_fit
+
+        The new concerts' full-order transitions are added to the trie's and every
+        level is rebuilt from the total, re-checking cull thresholds; this costs about
+        as much as counting the new concerts plus a pass over the distinct contexts,
+        not a refit.
+        """
+        self.check_updatable()
+        new = Chain(new_data, self.state_size, self.train_backwards, cull=False)
+        self.set_raw_counts(add_counts([self.raw_counts(), new.counts]))
+        self.append_data(new.data)
+        return self
+
+    def memory_by_order(self) -> dict:
+        """bytes of trie storage used by each order"""
+        return {
+            k: int(
+                self.level_keys[k].nbytes
+                + self.level_offsets[k].nbytes
+                + self.level_outcomes[k].nbytes
+                + self.level_counts[k].nbytes
+            )
+            for k in range(self.state_size + 1)
+        }
+
+
+CHAIN_TYPES = {"fixed": Chain, "variable": VariableOrderChain}
+
+
+def add_counts(counts: list) -> dict:
+    """sum several {state: {outcome: count}} transition count tables"""
+    total: defaultdict = defaultdict(_internal_defaultdict_int)
+    for table in counts:
+        for in_val, outcomes in table.items():
+            for out_val, count in outcomes.items():
+                total[in_val][out_val] += count
+    return total
+
+
+def cull_counts(raw_counts: dict, minor_values) -> tuple:
+    """(counts, minor_counts): raw transition counts with `minor_values` merged into
+    MINOR, and the raw transitions that merged"""
+    minor = set(minor_values)
+    counts: defaultdict = defaultdict(_internal_defaultdict_int)
+    minor_counts: defaultdict = defaultdict(_internal_defaultdict_int)
+    for in_val, outcomes in raw_counts.items():
+        if minor.isdisjoint(in_val) and minor.isdisjoint(outcomes):
+            # nothing to cull, and no other state is culled into this one
+            counts[in_val] = defaultdict(int, outcomes)
+            continue
+        state = tuple(MINOR if v in minor else v for v in in_val)
+        for out_val, count in outcomes.items():
+            culled = MINOR if out_val in minor else out_val
+            counts[state][culled] += count
+            if state != in_val or culled != out_val:
+                minor_counts[in_val][out_val] += count
+    return counts, minor_counts
+
+
+def subtract_counts(counts: dict, other: dict) -> dict:
+    """counts less other's, which must be a part of them (e.g. some of the concerts
+    they were counted from); transitions left with no count are dropped"""
+    result: defaultdict = defaultdict(_internal_defaultdict_int)
+    for in_val, outcomes in counts.items():
+        removed = other.get(in_val, {})
+        for out_val, count in outcomes.items():
+            remaining = count - removed.get(out_val, 0)
+            if remaining > 0:
+                result[in_val][out_val] = remaining
+    return result
+
+
+def split_chain_type(config: dict) -> tuple:
+    """(chain_type, the rest of the config) from a chain config, checking the type"""
+    config = dict(config)
+    chain_type = config.pop("chain_type", "fixed")
+    if chain_type not in CHAIN_TYPES:
+        raise ValueError(
+            f'chain_type unknown, please use one of ({", ".join(CHAIN_TYPES)})'
+        )
+    return chain_type, config
+
+
+def fit_chain(arg_tuple) -> Chain:
+    """module level function so Pool can fit any chain type from (data, config)"""
+    data, config = arg_tuple
+    chain_type, config = split_chain_type(config)
+    return CHAIN_TYPES[chain_type](data, **config)
+
+
+def fit_fold_chains(arg_tuple) -> dict:
+    """module level function so Pool can fit a feature's chains for every fold from
+    (data, config, fold of each row); each fold's chain is fit on the other folds"""
+    data, config, row_folds = arg_tuple
+    chain_type, config = split_chain_type(config)
+    folds = pd.unique(row_folds)
+    if chain_type != "fixed":
+        return {
+            f: CHAIN_TYPES[chain_type](data[row_folds != f], **config) for f in folds
+        }
+
+    # one counting pass over the data, a fold at a time, on raw values
+    fold_counts = {
+        f: Chain(data[row_folds == f], **dict(config, cull=False)).counts for f in folds
+    }
+    total = add_counts(list(fold_counts.values()))
+    return {
+        f: Chain.from_counts(
+            data.name or "unnamed", subtract_counts(total, fold_counts[f]), **config
+        )
+        for f in folds
+    }
+
+
+def marginalize_counts(counts: dict, state_size: int, order: int) -> dict:
+    """transition counts of a chain of a lower `order`, from raw counts of a chain of
+    `state_size` fit on the same data"""
+    if order == state_size:
+        return counts
+    total: defaultdict = defaultdict(_internal_defaultdict_int)
+    for in_val, outcomes in counts.items():
+        state = in_val[state_size - order :]
+        for out_val, count in outcomes.items():
+            total[state][out_val] += count
+
+    # concerts are separated by state_size breaks rather than order; the extra ones
+    # are all-break transitions, state_size - order per concert (each of which starts
+    # with the one transition out of an all-break state to a value)
+    n_concerts = sum(
+        count
+        for out_val, count in counts.get((BREAK,) * state_size, {}).items()
+        if out_val != BREAK
+    )
+    extra = {(BREAK,) * order: {BREAK: (state_size - order) * n_concerts}}
+    return subtract_counts(total, extra)
+
+
+def fit_variant_chains(arg_tuple) -> dict:
+    """module level function so Pool can fit a feature's chains for every
+    (state_size, cull_threshold) variant from (data, config, variants); fixed chains
+    share one counting pass at the largest state size"""
+    data, config, variants = arg_tuple
+    chain_type, config = split_chain_type(config)
+    if chain_type != "fixed":
+        return {
+            v: CHAIN_TYPES[chain_type](
+                data, **dict(config, state_size=v[0], cull_threshold=v[1])
+            )
+            for v in variants
+        }
+
+    max_order = max(state_size for state_size, _ in variants)
+    counts = Chain(data, **dict(config, state_size=max_order, cull=False)).counts
+    by_order = {
+        order: marginalize_counts(counts, max_order, order)
+        for order in set(state_size for state_size, _ in variants)
+    }
+    value_counts = {order: Chain.value_counts(raw) for order, raw in by_order.items()}
+
+    # thresholds that cull the same values give the same chain, so it's fit once
+    chains: dict = {}
+    fit: dict = {}
+    for state_size, cull_threshold in variants:
+        culled = None
+        if config.get("cull", True):
+            culled = frozenset(minor_values(value_counts[state_size], cull_threshold))
+        key = (state_size, culled)
+        if key not in fit:
+            fit[key] = Chain.from_counts(
+                data.name or "unnamed",
+                by_order[state_size],
+                value_counts=value_counts[state_size],
+                **dict(config, state_size=state_size, cull_threshold=cull_threshold),
+            )
+        chains[(state_size, cull_threshold)] = fit[key]
+    return chains
+
+
+def unique_selections(data: pd.DataFrame) -> pd.DataFrame:
+    """one row per selection_id of concert data, the first one seen"""
+    return (
+        data.reset_index()
+        .drop("concert_id", axis=1)
+        .drop_duplicates("selection_id")
+        .set_index("selection_id")
+        .copy()
+    )
+
+
 class ChainEnsemble:
     def __init__(
         self, chain_configs: dict, base_chain_config: dict, train_backwards: bool = True
@@ -197,12 +1025,60 @@ class ChainEnsemble:
         self.is_fit: bool = False
         self.chains: dict = {}
         self.train_data: pd.DataFrame = pd.DataFrame()
+        # one row per selection, kept in place of train_data by compact()
+        self.selection_data: Optional[pd.DataFrame] = None
+
+    @property
+    def is_compact(self) -> bool:
+        return getattr(self, "selection_data", None) is not None
+
+    def selection_table(self) -> pd.DataFrame:
+        """the features of each selection in the training data"""
+        if self.is_compact:
+            return self.selection_data.copy()
+        return unique_selections(self.train_data)
+
+    def compact(self):
+        """
+        drop everything scoring doesn't need: the training data (keeping one row per
+        selection, which is what ChainEnsembleScorer reads) and each chain's training
+        series and counts; see memory_report for the savings. A compact model can't be
+        updated with partial_fit or cross validated.
+        """
+        if not self.is_fit:
+            raise ValueError("only a fit model can be compacted")
+        if not self.is_compact:
+            self.selection_data = unique_selections(self.train_data)
+            self.train_data = pd.DataFrame()
+        for chain in self.chains.values():
+            chain.compact()
+        return self
+
+    def memory_report(self) -> dict:
+        """bytes used by the model: pickled in total and by chain, and in memory by
+        its data frames and the chains' training series"""
+        report = {
+            "pickle_bytes": len(pickle.dumps(self, pickle.HIGHEST_PROTOCOL)),
+            "train_data_bytes": int(self.train_data.memory_usage(deep=True).sum()),
+            "selection_data_bytes": (
+                int(self.selection_data.memory_usage(deep=True).sum())
+                if self.is_compact
+                else 0
+            ),
+            "chains": {},
+        }
+        for name, chain in self.chains.items():
+            report["chains"][name] = {
+                "pickle_bytes": len(pickle.dumps(chain, pickle.HIGHEST_PROTOCOL)),
+                "data_bytes": int(chain.data.memory_usage(deep=True)),
+            }
+        return report
 
     def initialize_chain_configs(
         self, chain_configs: dict, base_chain_config: dict
     ) -> dict:
         """initialize chain config dicts, filling in with base config and ensemble-wide `train_backwards`"""
-        final_configs: dict = {c: base_chain_config for c in chain_configs}
+        final_configs: dict = {c: dict(base_chain_config) for c in chain_configs}
         for col in final_configs:
             for key in chain_configs[col]:
                 final_configs[col][key] = chain_configs[col][key]
@@ -210,39 +1086,414 @@ class ChainEnsemble:
             final_configs[col]["train_backwards"] = self.train_backwards
         return final_configs
 
-    def validate_training_args(self):
+    def validate_training_args(self, data: Optional[pd.DataFrame] = None):
         """ensure indexes, columns, and chain config keys are all as expected"""
-        assert all(k in self.train_data.columns for k in self.chain_configs.keys())
-        assert self.train_data.index.names == [
+        data = self.train_data if data is None else data
+        assert all(k in data.columns for k in self.chain_configs.keys())
+        assert data.index.names == [
             "concert_id",
             "selection_id",
         ], "Data must be indexed by concert_id and selection_id"
-        assert "weight" in self.train_data.columns, "Data must contain a weight field"
+        assert "weight" in data.columns, "Data must contain a weight field"
 
     def train(self, data: pd.DataFrame, n_jobs: int = cpu_count()):
         """fit the chain models defined by chain_configs"""
-        self.train_data = data
-        self.validate_training_args()
+        self.validate_training_args(data)
+        self.train_data = categorize_features(data, list(self.chain_configs))
 
         with Pool(n_jobs) as pool:
             job_data = [
                 (self.train_data[col], kwargs)
                 for col, kwargs in self.chain_configs.items()
             ]
-            chains = pool.map(Chain.from_tuple, job_data, chunksize=1)
+            chains = pool.map(fit_chain, job_data, chunksize=1)
 
         self.chains = {c.name: c for c in chains}
         self.is_fit = True
 
         return self
 
+    def partial_fit(self, new_data: pd.DataFrame):
+        """add new concerts (e.g. a season) to a fit model without retraining; see
+        Chain.partial_fit"""
+        if not self.is_fit:
+            raise ValueError("partial_fit needs a fit model; call train first")
+        if self.is_compact:
+            raise ValueError("a compacted model can't be updated; refit it instead")
+        self.validate_training_args(new_data)
+        new_concerts = new_data.index.get_level_values("concert_id").unique()
+        seen = self.train_data.index.get_level_values("concert_id")
+        if seen.isin(new_concerts).any():
+            raise ValueError("new_data includes concerts the model was already fit on")
+        # every chain is checked before any is changed, so a failure leaves the
+        # model as it was
+        for chain in self.chains.values():
+            chain.check_updatable()
+
+        train_data, new_data = align_categories(
+            self.train_data, new_data, list(self.chain_configs)
+        )
+        for col, chain in self.chains.items():
+            chain.partial_fit(new_data[col])
+        self.train_data = pd.concat([train_data, new_data])
+        return self
+
+    def fold_models(
+        self, data: pd.DataFrame, folds: pd.Series, n_jobs: int = cpu_count()
+    ) -> dict:
+        """
+        for k-fold cross validation, a model like this one fit on each fold's
+        complement, keyed by fold
+
+        Transitions are counted once per fold and each fold's model subtracts its
+        fold's counts from the total, so this costs about one call to `train` rather
+        than k. Each model's train_data holds its training concerts.
+
+        - data: training data, as for `train`
+        - folds: the fold of each concert, indexed by concert_id
+        """
+        template = copy.copy(self)
+        template.validate_training_args(data)
+        data = categorize_features(data, list(self.chain_configs))
+        template.train_data = data
+        template.selection_data = None
+        row_folds = folds.reindex(data.index.get_level_values("concert_id")).values
+        if pd.isnull(row_folds).any():
+            raise ValueError("folds must assign every concert in data to a fold")
+
+        with Pool(n_jobs) as pool:
+            job_data = [
+                (data[col], kwargs, row_folds)
+                for col, kwargs in self.chain_configs.items()
+            ]
+            fold_chains = pool.map(fit_fold_chains, job_data, chunksize=1)
+
+        models = {}
+        for fold in pd.unique(row_folds):
+            model = copy.copy(template)
+            model.train_data = data[row_folds != fold]
+            model.chains = {
+                col: chains[fold]
+                for col, chains in zip(self.chain_configs, fold_chains)
+            }
+            model.is_fit = True
+            models[fold] = model
+        return models
+
+    def variant_models(
+        self,
+        data: pd.DataFrame,
+        state_sizes: list,
+        cull_thresholds: list,
+        n_jobs: int = cpu_count(),
+    ) -> dict:
+        """
+        models like this one with every chain's state_size and cull_threshold set to
+        each combination of `state_sizes` and `cull_thresholds`, keyed by
+        (state_size, cull_threshold)
+
+        Each feature's transitions are counted once, on raw values at the largest state
+        size; lower orders are derived by marginalizing those counts and each cull
+        threshold by remapping them, so a grid costs about one call to `train`.
+        Variable-order chains are fit once per variant. As with `Chain.from_counts`,
+        the chains keep no training series, and variants whose thresholds cull the same
+        values of a feature share its chain, so models are for scoring and comparison
+        rather than further updates.
+
+        - data: training data, as for `train`
+        """
+        template = copy.copy(self)
+        template.validate_training_args(data)
+        if any(int(k) != k or k < 1 for k in state_sizes):
+            raise ValueError("state_sizes should be positive integers")
+        data = categorize_features(data, list(self.chain_configs))
+        template.train_data = data
+        template.selection_data = None
+        variants = list(itertools.product(state_sizes, cull_thresholds))
+
+        with Pool(n_jobs) as pool:
+            job_data = [
+                (data[col], kwargs, variants)
+                for col, kwargs in self.chain_configs.items()
+            ]
+            variant_chains = pool.map(fit_variant_chains, job_data, chunksize=1)
+
+        models = {}
+        for variant in variants:
+            state_size, cull_threshold = variant
+            model = copy.copy(template)
+            model.chain_configs = {
+                col: dict(config, state_size=state_size, cull_threshold=cull_threshold)
+                for col, config in self.chain_configs.items()
+            }
+            model.chains = {
+                col: chains[variant]
+                for col, chains in zip(self.chain_configs, variant_chains)
+            }
+            model.is_fit = True
+            models[variant] = model
+        return models
+
+
+class ScoreVectorCache:
+    """
+    Process-wide LRU cache of full-catalogue score vectors, keyed by
+    (chain fit, scoring catalogue, state, summary kernel)
+
+    A chain's per-row scores depend only on its current state and on how many rows
+    share each value. Entries hold the scores over the whole catalogue, already put
+    through the summary kernel's transform, and scorers correct the few values that
+    lost rows to scrubbing after looking them up.
+
+    The cache holds at most `max_bytes` of arrays (entries are catalogue-sized, so a
+    count of them would hold very different amounts of memory from one catalogue to
+    the next); an entry bigger than that on its own isn't kept.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.nbytes: int = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f"<ScoreVectorCache: {len(self.entries)} entries, "
+            f"{self.nbytes}/{self.max_bytes} bytes, {self.hit_rate:.1%} hits>"
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __deepcopy__(self, memo):
+        return self  # copied scorers keep sharing the cache
+
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        # caches pickled with an entry count rather than a byte budget get the default
+        if "max_bytes" in state:
+            self.__init__(state["max_bytes"])
+        else:
+            self.__init__()
+
+    @classmethod
+    def entry_nbytes(cls, entry: tuple) -> int:
+        return sum(a.nbytes for a in entry)
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, entry: tuple) -> None:
+        with self._lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.nbytes += self.entry_nbytes(entry)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= self.entry_nbytes(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "nbytes": self.nbytes,
+        }
+
+
+# shared by every scorer in the process
+SCORE_CACHE = ScoreVectorCache()
+
+# alias tables and presorted candidate lists (see ChainEnsembleScorer.alias_table and
+# candidate_list) in the same kind of cache
+ALIAS_CACHE = ScoreVectorCache(max_bytes=64 * 2**20)
+
+# an alias sampling step falls back to exact sampling when scrubbing may have raised a
+# row's score by more than this factor, or after this many rejected draws
+ALIAS_MAX_BOUND = 10.0
+ALIAS_MAX_ATTEMPTS = 64
+
+
+def truncate_head(
+    probabilities: np.ndarray,
+    top_k: Optional[int] = None,
+    top_p: Optional[float] = None,
+) -> np.ndarray:
+    """positions of the most probable entries of normalized `probabilities`: at most
+    top_k of them, and only as many as it takes to cover top_p of the mass. Found with
+    np.argpartition, growing the head until it covers top_p and sorting only the head
+    """
+    n = len(probabilities)
+    k = n if top_k is None else min(top_k, n)
+    if top_p is None or top_p >= 1:
+        if k == n:
+            return np.arange(n)
+        return np.argpartition(-probabilities, k - 1)[:k]
+
+    size = min(k, 64)
+    while True:
+        if size < n:
+            head = np.argpartition(-probabilities, size - 1)[:size]
+        else:
+            head = np.arange(n)
+        head = head[np.argsort(-probabilities[head], kind="stable")]
+        covered = np.cumsum(probabilities[head])
+        if size == k or covered[-1] >= top_p:
+            break
+        size = min(size * 4, k)
+    return head[: np.searchsorted(covered, top_p) + 1]
+
+
+class FeatureConstraint:
+    """
+    Cap how many selections in a program may share values of a catalogue column
+
+    - feature: any column of the training data, whether or not a chain models it
+    - limit: the most selections allowed before the matching rows are scrubbed
+    - values: values counted together against `limit` (e.g. ["concerto"] on work_type
+        for "no more concertos after the first"); if None, each value is capped
+        separately (e.g. "no repeated composer" on composer_id). Values match the
+        column's raw values by equality, so their types must agree: composer_id holds
+        integers (NA for intermissions), so it takes e.g. [12], not ["12"]. Values the
+        column doesn't hold raise ValueError
+    """
+
+    def __init__(self, feature: str, limit: int = 1, values: Optional[list] = None):
+        if limit < 1:
+            raise ValueError("constraint limit must be at least 1")
+        self.feature = feature
+        self.limit = limit
+        self.values = None if values is None else list(values)
+
+    def __repr__(self):
+        values = "each value" if self.values is None else self.values
+        return f"<FeatureConstraint {self.feature}: at most {self.limit} of {values}>"
+
+    @classmethod
+    def from_spec(cls, feature: str, spec: Union[int, dict]) -> "FeatureConstraint":
+        """build from a json-friendly spec: a bare limit, or {"limit": ..., "values": ...}"""
+        if isinstance(spec, dict):
+            return cls(feature, spec.get("limit", 1), spec.get("values"))
+        return cls(feature, spec)
+
+
+def parse_constraints(constraints: Union[None, dict, list]) -> list:
+    """FeatureConstraints from a list of them or a {feature: spec} dict"""
+    if not constraints:
+        return []
+    if isinstance(constraints, dict):
+        return [FeatureConstraint.from_spec(f, s) for f, s in constraints.items()]
+    return list(constraints)
+
+
+class ConstraintCounter:
+    """
+    Running counts of drawn selections against a list of FeatureConstraints, over the
+    catalogue of a ChainEnsembleScorer
+
+    `count` returns the row masks that newly reached limits rule out, for the caller to
+    scrub; a scorer does so within a program and a SeasonGenerator across programs.
+    """
+
+    def __init__(self, scorer: "ChainEnsembleScorer", constraints: list):
+        self.scorer = scorer
+        self.constraints = constraints
+        # per constraint, selections drawn so far by value code (one shared count for
+        # constraints on a group of values) and which value codes are in the group
+        self.counts: list = []
+        self.groups: list = []
+        for constraint in constraints:
+            if constraint.feature not in scorer.raw_data.columns:
+                raise ValueError(
+                    f"cannot constrain unknown feature {constraint.feature}"
+                )
+            _, values = scorer.feature_codes(constraint.feature)
+            if constraint.values is None:
+                self.counts.append(np.zeros(len(values), dtype=int))
+                self.groups.append(None)
+            else:
+                # a value the column lacks would quietly never be counted
+                missing = values.get_indexer(constraint.values) < 0
+                if missing.any():
+                    unknown = np.asarray(constraint.values, dtype=object)[missing]
+                    raise ValueError(
+                        f"cannot constrain {constraint.feature} on values it doesn't "
+                        f"hold: {', '.join(map(repr, unknown))}"
+                    )
+                group = np.zeros(len(values), dtype=bool)
+                group[scorer.value_codes(constraint.feature, constraint.values)] = True
+                self.counts.append(np.zeros(1, dtype=int))
+                self.groups.append(group)
+
+    def __repr__(self):
+        return f"<ConstraintCounter: {len(self.constraints)} constraints>"
+
+    def __len__(self):
+        return len(self.constraints)
+
+    def reset(self):
+        for counts in self.counts:
+            counts[:] = 0
+        return self
+
+    def count(self, pos: int) -> list:
+        """count the catalogue row at `pos`; returns masks of rows to scrub"""
+        ruled_out = []
+        for constraint, counts, group in zip(
+            self.constraints, self.counts, self.groups
+        ):
+            code = self.scorer.constraint_codes[constraint.feature][pos]
+            if code < 0:
+                continue
+            if group is None:
+                counts[code] += 1
+                if counts[code] >= constraint.limit:
+                    ruled_out.append(self.scorer.code_mask(constraint.feature, [code]))
+            elif group[code]:
+                counts[0] += 1
+                if counts[0] >= constraint.limit:
+                    ruled_out.append(
+                        self.scorer.code_mask(constraint.feature, np.flatnonzero(group))
+                    )
+        return ruled_out
+
 
 class ChainEnsembleScorer:
     def __init__(
         self,
         model: ChainEnsemble,
         default_break_weight: int = 1,
-        summary_function: str = "rpw",
+        summary_function: str = "rescaled_power_weight",
+        cache: Optional[ScoreVectorCache] = SCORE_CACHE,
+        backend: Optional[str] = None,
+        sampler: str = "exact",
+        alias_cache: Optional[ScoreVectorCache] = ALIAS_CACHE,
     ):
         if not model.is_fit:
             raise ValueError(
@@ -255,36 +1506,59 @@ class ChainEnsembleScorer:
                 f'summary function unknown, please use one of ({", ".join(AVAILABLE_SUMMARY_FUNCTIONS)})'
             )
         self.summary_function = AVAILABLE_SUMMARY_FUNCTIONS[summary_function]
+        self.summary_name = summary_function
+        self.kernel: SummaryKernel = SUMMARY_KERNELS[summary_function]
+        self.cache = cache
+        # kernels for per-step filtering, summing and sampling (see nyp.backends)
+        self.backend: NumpyBackend = get_backend(backend)
+        # "exact" draws from every available row's score; "alias" draws from cached alias
+        # tables over the full catalogue with rejection (see alias_position)
+        if sampler not in SAMPLERS:
+            raise ValueError(
+                f'sampler unknown, please use one of ({", ".join(SAMPLERS)})'
+            )
+        self.sampler = sampler
+        self.alias_cache = alias_cache
 
         # metadata on our scoring data frame
         self.break_idx: Optional[int] = None  # filled by collapse_training_data
         self.intermission_idx = None  # ''  ''
         self.raw_data: pd.DataFrame = self.collapse_training_data()
+        self.encode_catalogue()
 
         # initialize state
         self.state: dict = {}
-        self.score_data: pd.DataFrame = pd.DataFrame()
         self.is_clean_start: bool = False
+        # rows available at the start of every program; None means all of them
+        self.start_mask: Optional[np.ndarray] = None
         self.initialize_score_state()
-        self.set_break_weight(self.default_break_weight)
+
+    def copy(self) -> "ChainEnsembleScorer":
+        """a clean scorer sharing this one's model, encoded catalogue and lookup tables,
+        which are never modified after encode_catalogue; far cheaper than a deepcopy"""
+        other = copy.copy(self)
+        other.summary_buffer = np.empty_like(self.summary_buffer)
+        other.gather_buffer = np.empty_like(self.gather_buffer)
+        other.initialize_score_state()
+        return other
 
     def collapse_training_data(self) -> pd.DataFrame:
         """Collapse the full training dataset down to the unique selections that will be scored,
         add a row representing the end of a program
         """
-        data = (
-            self.model.train_data.reset_index()
-            .drop("concert_id", axis=1)
-            .drop_duplicates("selection_id")
-            .set_index("selection_id")
-            .copy()
-        )
+        return self.add_break_row(self.model.selection_table())
 
+    def add_break_row(self, data: pd.DataFrame) -> pd.DataFrame:
+        """append the BREAK row to a catalogue of selections"""
         # handle the break record
         self.break_idx = data.index.max() + 1
-        break_row = pd.Series({c: BREAK for c in data.columns}, name=self.break_idx)
+        # a one-row frame with the catalogue's dtypes, so categorical columns (which
+        # reserve BREAK) stay categorical
+        break_row = pd.DataFrame(
+            {c: [BREAK] for c in data.columns}, index=[self.break_idx]
+        ).astype({c: data[c].dtype for c in self.model.chains})
         break_row["weight"] = 1
-        data = data.append(break_row)
+        data = pd.concat([data, break_row])
 
         # take note of the intermission idx
         self.intermission_idx = data.loc[data[data.columns[-1]] == INTERMISSION].index[
@@ -293,6 +1567,74 @@ class ChainEnsembleScorer:
 
         return data
 
+    def partial_fit(self, new_data: pd.DataFrame):
+        """
+        add new concerts to the model (see ChainEnsemble.partial_fit), and their new
+        selections to the catalogue without re-collapsing the full training data
+
+        The model is shared with any copies of this scorer, which should be replaced
+        with fresh copies afterwards.
+        """
+        self.model.partial_fit(new_data)
+        catalogue, new_rows = align_categories(
+            self.raw_data.drop(self.break_idx),
+            unique_selections(new_data),
+            list(self.model.chains),
+        )
+        new_rows = new_rows[~new_rows.index.isin(catalogue.index)]
+        self.raw_data = self.add_break_row(pd.concat([catalogue, new_rows]))
+        self.encode_catalogue()
+        return self.initialize_score_state()
+
+    def encode_catalogue(self):
+        """Set up the fixed, array-based view of the scoring catalogue: each chain's
+        minor-substituted values as codes into its vocabulary, and per-value row counts
+        """
+        self.score_data: pd.DataFrame = self.raw_data.copy()
+        for c in self.model.chains:
+            self.score_data[c] = self.model.chains[c].transform_scoring_series(
+                self.score_data[c]
+            )
+
+        self.selection_ids: np.ndarray = self.score_data.index.values
+        self.positions: pd.Index = self.score_data.index
+        self.raw_weights: np.ndarray = self.score_data["weight"].values.astype(float)
+        self.break_pos: int = self.positions.get_loc(self.break_idx)
+        self.intermission_pos: int = self.positions.get_loc(self.intermission_idx)
+
+        self.feature_values: dict = {}
+        self.codes: dict = {}
+        self.rows_by_code: dict = {}
+        self.full_counts: dict = {}
+        for c, chain in self.model.chains.items():
+            values = self.score_data[c].values
+            codes = chain.encode(values)
+            self.feature_values[c] = values
+            self.codes[c] = codes
+            self.full_counts[c] = np.bincount(
+                codes[codes >= 0], minlength=len(chain.vocab)
+            )
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(chain.vocab) + 1))
+            self.rows_by_code[c] = [
+                order[bounds[v] : bounds[v + 1]] for v in range(len(chain.vocab))
+            ]
+
+        # raw value codes and per-(feature, value) row masks for scrubbing by feature,
+        # all filled lazily by feature_codes, value_codes and code_mask
+        self.constraint_codes: dict = {}
+        self.constraint_values: dict = {}
+        self.value_masks: dict = {}
+        self.value_code_lookups: dict = {}
+
+        # identifies this catalogue in the shared score cache
+        self.catalogue_key: str = uuid.uuid4().hex
+
+        # reused by next_idx to summarize scores without allocating per step
+        self.summary_buffer: np.ndarray = np.empty(len(self.selection_ids))
+        self.gather_buffer: np.ndarray = np.empty(len(self.selection_ids))
+        return self
+
     def reset_state(self):
         """initialize or reset state based on each config's state_size"""
         self.state = {
@@ -302,22 +1644,106 @@ class ChainEnsembleScorer:
         return self
 
     def initialize_score_state(self):
-        """Set up a clean start of state and score_data"""
+        """Set up a clean start of state: every row of the catalogue (or of start_mask)
+        available again"""
         self.reset_state()
-        self.score_data = self.raw_data.copy()
 
-        for c in self.model.chains:
-            self.score_data[c] = self.model.chains[c].transform_scoring_series(
-                self.score_data[c]
-            )
+        self.alive: np.ndarray = np.ones(len(self.selection_ids), dtype=bool)
+        self.alive_counts: dict = {c: v.copy() for c, v in self.full_counts.items()}
+        # per chain, which value codes have lost rows to scrubbing, and those values' rows
+        self.scrubbed_codes: dict = {
+            c: np.zeros(len(v), dtype=bool) for c, v in self.full_counts.items()
+        }
+        self.dirty_rows: dict = {c: np.zeros(0, dtype=int) for c in self.codes}
+        if self.start_mask is not None:
+            self.remove_rows(~self.start_mask)
+        self.weights: np.ndarray = self.raw_weights.copy()
+        self.set_break_weight(self.default_break_weight)
+        self.set_constraints(None)
 
         self.is_clean_start = True
 
         return self
 
+    def set_start_mask(self, mask: Optional[np.ndarray]):
+        """limit every following program to the catalogue rows in `mask` (e.g. works not
+        yet used this season); the break and intermission rows are always kept"""
+        if mask is not None:
+            mask = mask.copy()
+            mask[[self.break_pos, self.intermission_pos]] = True
+        self.start_mask = mask
+        return self.initialize_score_state()
+
     def set_break_weight(self, break_weight: int):
-        self.score_data.loc[self.break_idx, "weight"] = break_weight
-        self.score_data.loc[self.intermission_idx, "weight"] = break_weight
+        self.weights[self.break_pos] = break_weight
+        self.weights[self.intermission_pos] = break_weight
+        return self
+
+    def set_constraints(self, constraints: Union[None, dict, list]):
+        """replace the feature constraints applied as selections are scrubbed; see
+        FeatureConstraint and parse_constraints for the accepted forms"""
+        self.constraints = ConstraintCounter(self, parse_constraints(constraints))
+        return self
+
+    def feature_codes(self, feature: str) -> tuple:
+        """(codes, values) for a catalogue column's raw values; the break and
+        intermission rows get code -1 so constraints never scrub them"""
+        if feature not in self.constraint_codes:
+            codes, values = pd.factorize(self.raw_data[feature])
+            codes[[self.break_pos, self.intermission_pos]] = -1
+            self.constraint_codes[feature] = codes
+            self.constraint_values[feature] = pd.Index(values)
+        return self.constraint_codes[feature], self.constraint_values[feature]
+
+    def value_codes(self, feature: str, values: list) -> np.ndarray:
+        """codes of the `values` present in a catalogue column"""
+        key = (feature, tuple(values))
+        if key not in self.value_code_lookups:
+            _, index = self.feature_codes(feature)
+            codes = index.get_indexer(list(values))
+            self.value_code_lookups[key] = codes[codes >= 0]
+        return self.value_code_lookups[key]
+
+    def code_mask(self, feature: str, value_codes: np.ndarray) -> np.ndarray:
+        """rows whose raw `feature` has any of `value_codes`, from cached per-value masks"""
+        codes, _ = self.feature_codes(feature)
+        masks = []
+        for code in value_codes:
+            key = (feature, code)
+            if key not in self.value_masks:
+                self.value_masks[key] = codes == code
+            masks.append(self.value_masks[key])
+        if len(masks) == 1:
+            return masks[0]
+        return np.logical_or.reduce(masks) if masks else np.zeros(len(codes), bool)
+
+    def value_mask(self, feature: str, values: list) -> np.ndarray:
+        """rows whose raw `feature` is any of `values`"""
+        return self.code_mask(feature, self.value_codes(feature, values))
+
+    def remove_rows(self, mask: np.ndarray):
+        """scrub every available row in `mask`, keeping per-value counts in step"""
+        removed = np.flatnonzero(self.alive & mask)
+        if len(removed) == 0:
+            return self
+        self.alive[removed] = False
+        for c, codes in self.codes.items():
+            removed_codes = codes[removed]
+            n_removed = np.bincount(
+                removed_codes[removed_codes >= 0], minlength=len(self.alive_counts[c])
+            )
+            self.alive_counts[c] -= n_removed
+            self.mark_scrubbed(c, np.flatnonzero(n_removed))
+        return self
+
+    def mark_scrubbed(self, col: str, codes: np.ndarray):
+        """note that values of chain `col` have lost rows, so their scores need rescaling"""
+        new = codes[~self.scrubbed_codes[col][codes]]
+        if len(new):
+            self.scrubbed_codes[col][new] = True
+            self.dirty_rows[col] = np.concatenate(
+                [self.dirty_rows[col]] + [self.rows_by_code[col][code] for code in new]
+            )
         return self
 
     def get_selection_features(self, selection_id: int) -> pd.Series:
@@ -328,76 +1754,575 @@ class ChainEnsembleScorer:
         """update state with the feature values of the most recent selection;
         accommodates chains of varying size
         """
-        selection_features = self.get_selection_features(selection_id)
+        pos = self.positions.get_loc(selection_id)
         for k in self.state:
-            self.state[k] = self.state[k][1:] + (selection_features[k],)
+            self.state[k] = self.state[k][1:] + (self.feature_values[k][pos],)
         return self
 
-    def scrub(self, selection_id: int = None):  # feature_values: dict = None):
-        """cumulatively scrub rows from the scoring data frame by selection_id and/or by feature value"""
-        if selection_id:
-            if selection_id in self.score_data.index:
-                self.score_data = self.score_data.drop(selection_id, axis=0)
-        #
-        # if feature_values:
-        #     # TODO: transition to a cumulative index that's sliced only once
-        #     for feature in feature_values:
-        #         for val in feature:
-        #             self.score_data = self.score_data.loc[self.score_data[feature] != val]
+    def scrub(self, selection_id: int = None, feature_values: dict = None):
+        """cumulatively scrub rows from the scoring catalogue by selection_id and/or by
+        feature value ({feature: [values]}); a scrubbed selection also counts against
+        any constraints"""
+        if selection_id is not None and selection_id in self.positions:
+            pos = self.positions.get_loc(selection_id)
+            if self.alive[pos]:
+                self.alive[pos] = False
+                for c, codes in self.codes.items():
+                    code = codes[pos]
+                    if code >= 0:
+                        self.alive_counts[c][code] -= 1
+                        if not self.scrubbed_codes[c][code]:
+                            self.mark_scrubbed(c, codes[pos : pos + 1])
+                if self.constraints:
+                    for mask in self.constraints.count(pos):
+                        self.remove_rows(mask)
+
+        if feature_values:
+            for feature, values in feature_values.items():
+                self.remove_rows(self.value_mask(feature, values))
 
         return self
 
-    def next_idx(
+    def chain_entry(self, col: str, in_val: Optional[tuple]) -> tuple:
+        """(probabilities by value code, transformed scores over the full catalogue) for
+        a chain's state, from the shared score cache"""
+        chain = self.model.chains[col]
+        transform = self.kernel.transform
+        key = (
+            chain.cache_key,
+            self.catalogue_key,
+            None if in_val is None else chain.clean_state(in_val),
+            transform.__name__,
+        )
+        entry = self.cache.get(key) if self.cache is not None else None
+        if entry is None:
+            probas = chain.state_vector(in_val, backoff=True)
+            codes = self.codes[col]
+            counts = self.full_counts[col]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores = np.where(codes >= 0, probas[codes] / counts[codes], 0.0)
+            entry = (probas, transform(scores))
+            if self.cache is not None:
+                self.cache.put(key, entry)
+        return entry
+
+    def chain_scores(self, col: str, in_val: Optional[tuple]) -> np.ndarray:
+        """a chain's score for every catalogue row given its state, in the summary
+        kernel's transformed space: the state's probability of the row's value divided
+        by the number of available rows sharing that value; `in_val` of None scores
+        with the chain's backoff table
+        """
+        transform = self.kernel.transform
+        probas, scores = self.chain_entry(col, in_val)
+        rows = self.dirty_rows[col]
+        if len(rows) == 0:
+            return scores
+
+        # rescale the available rows of values that lost rows to scrubbing, leaving the
+        # cached entry intact; unavailable rows are never scored, so they are skipped
+        rows = rows[self.alive[rows]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rescaled = transform(probas / self.alive_counts[col])
+        scores = scores.copy()
+        scores[rows] = rescaled[self.codes[col][rows]]
+        return scores
+
+    def scorable_positions(self, scores: list) -> np.ndarray:
+        """positions of available rows that no model scored as 0"""
+        return self.backend.scorable_positions(scores, self.alive, self.kernel.zero)
+
+    def summarize_scores(
+        self, scores: list, weights: list, positions: np.ndarray
+    ) -> np.ndarray:
+        """the summary kernel over transformed `scores` at `positions`, accumulated
+        into preallocated buffers; the result is a view valid until the next call"""
+        weight_sum = float(sum(weights))
+        total = self.backend.weighted_sum(
+            scores,
+            np.array([w / weight_sum for w in weights]),
+            positions,
+            self.summary_buffer,
+            self.gather_buffer,
+        )
+        return self.kernel.inverse(total, out=total)
+
+    def exact_probabilities(
         self,
-        feature_weights: dict,  # feature_limits: dict,
+        weights: dict,
         weighted_average_exponent: float = 1.0,
         case_weight_exponent: float = 1.0,
-        random_state: int = None,
-    ) -> int:
-
-        if self.is_clean_start:  # this method will dirty scorer state
-            self.is_clean_start = False
-
-        # accumulate score cols and weights as we score each feature column with the current state
-        score_cols = []
-        score_weights = np.array([], dtype=float)
-        for col in feature_weights:
-            if feature_weights[col] <= 0 or feature_weights[col] is None:
-                continue
-            score_col = col + "___score__"
-            score_cols.append(score_col)
-            score_weights = np.append(score_weights, feature_weights[col])
-            self.score_data[score_col] = (
-                self.model.chains[col]
-                .score_series(self.score_data[col], self.state[col])
-                .values
-            )
+        step=None,
+    ) -> tuple:
+        """(positions, probabilities): every scorable available row and its chance of
+        being drawn next, backing off at a dead end; `weights` are the positive feature
+        weights"""
+        if step is not None:
+            tick = perf_counter()
+
+        # accumulate scores with the current state of each weighted feature
+        scores = []
+        fallback = None
+        for col in weights:
+            # a state the chain never saw backs off to its marginal outcome frequencies
+            if not self.model.chains[col].has_state(self.state[col]):
+                fallback = "unseen_state"
+            scores.append(self.chain_scores(col, self.state[col]))
+            if step is not None:
+                tock = perf_counter()
+                step.chain_seconds[col] = tock - tick
+                tick = tock
 
         # filter to rows with no model scored as 0
-        scorable_ids = self.score_data.index[
-            (self.score_data[score_cols] == 0).sum(axis=1) == 0
-        ]
-
-        summarized_scores = self.summary_function(
-            self.score_data.loc[scorable_ids, score_cols].values, score_weights
+        scorable = self.scorable_positions(scores)
+
+        if len(scorable) == 0:
+            # dead end: no remaining selection follows every chain's state, so rescore
+            # with the backoff tables (in which BREAK always has mass) instead of failing
+            fallback = "no_successor"
+            scores = [self.chain_scores(col, None) for col in weights]
+            scorable = self.scorable_positions(scores)
+
+        if step is not None:
+            tock = perf_counter()
+            step.filter_seconds = tock - tick
+            step.n_scorable = len(scorable)
+            step.fallback = fallback
+            tick = tock
+
+        summarized_scores = self.summarize_scores(
+            scores, list(weights.values()), scorable
         )
-        case_weights = self.score_data.loc[scorable_ids, "weight"]
+        if step is not None:
+            step.summarize_seconds = perf_counter() - tick
+
+        case_weights = self.weights[scorable]
 
         # apply non-linear transformations to the scores and case weights; normalize result to sum to 1
         final_scores = np.power(
             summarized_scores, weighted_average_exponent
         ) * np.power(case_weights, case_weight_exponent)
-        final_scores = final_scores / final_scores.sum()
+        return scorable, final_scores / final_scores.sum()
+
+    def exact_position(
+        self,
+        weights: dict,
+        weighted_average_exponent: float,
+        case_weight_exponent: float,
+        rng,
+        step=None,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+    ) -> int:
+        """draw the next row's catalogue position from exact_probabilities, or from
+        their truncate_head given top_k or top_p"""
+        scorable, final_scores = self.exact_probabilities(
+            weights, weighted_average_exponent, case_weight_exponent, step
+        )
+        if step is not None:
+            tick = perf_counter()
+
+        if not np.isfinite(final_scores).all():
+            raise ValueError("selection probabilities are not all finite")
+        truncated_mass = None
+        if top_k is not None or top_p is not None:
+            head = truncate_head(final_scores, top_k, top_p)
+            truncated_mass = 0.0
+            # a head of every row draws as if untruncated
+            if len(head) < len(final_scores):
+                head_mass = final_scores[head].sum()
+                truncated_mass = max(1.0 - float(head_mass), 0.0)
+                scorable = scorable[head]
+                final_scores = final_scores[head] / head_mass
+        # the backend's cumulative sum over one uniform draw picks what rng.choice would
+        pick = self.backend.sample(final_scores, rng.random_sample())
+
+        if step is not None:
+            step.sampler = "exact"
+            step.truncated_mass = truncated_mass
+            step.sample_seconds = perf_counter() - tick
+        return int(scorable[pick])
+
+    def table_key(
+        self,
+        kind: str,
+        weights: dict,
+        weighted_average_exponent: float,
+        case_weight_exponent: float,
+    ) -> tuple:
+        """identifies a `kind` of table over the full catalogue in alias_cache, for the
+        current states and these options"""
+        return (
+            kind,
+            self.catalogue_key,
+            tuple(
+                (
+                    self.model.chains[c].cache_key,
+                    self.model.chains[c].clean_state(self.state[c]),
+                    w,
+                )
+                for c, w in weights.items()
+            ),
+            self.kernel.transform.__name__,
+            weighted_average_exponent,
+            case_weight_exponent,
+            float(self.weights[self.break_pos]),
+        )
+
+    def catalogue_mass(
+        self,
+        weights: dict,
+        weighted_average_exponent: float,
+        case_weight_exponent: float,
+        entries: dict,
+    ) -> np.ndarray:
+        """every catalogue row's final score before any scrubbing, unnormalized"""
+        scores = [entries[c][1] for c in weights]
+        positions = self.backend.scorable_positions(
+            scores, np.ones(len(self.selection_ids), dtype=bool), self.kernel.zero
+        )
+        summarized_scores = self.summarize_scores(
+            scores, list(weights.values()), positions
+        )
+        mass = np.zeros(len(self.selection_ids))
+        mass[positions] = np.power(
+            summarized_scores, weighted_average_exponent
+        ) * np.power(self.weights[positions], case_weight_exponent)
+        return mass
+
+    def alias_table(
+        self,
+        weights: dict,
+        weighted_average_exponent: float,
+        case_weight_exponent: float,
+        entries: dict,
+    ) -> Optional[tuple]:
+        """(probabilities, aliases) of a Walker alias table over the whole catalogue,
+        each row weighted by its final score before any scrubbing, for the current
+        states and these options; built on first use and cached. None if no row scores
+        """
+        key = self.table_key(
+            "alias", weights, weighted_average_exponent, case_weight_exponent
+        )
+        table = self.alias_cache.get(key) if self.alias_cache is not None else None
+        if table is None:
+            mass = self.catalogue_mass(
+                weights, weighted_average_exponent, case_weight_exponent, entries
+            )
+            if not mass.any():
+                return None
+            table = self.backend.alias_table(mass)
+            if self.alias_cache is not None:
+                self.alias_cache.put(key, table)
+        return table
+
+    def candidate_list(
+        self,
+        weights: dict,
+        weighted_average_exponent: float,
+        case_weight_exponent: float,
+        entries: dict,
+    ) -> Optional[tuple]:
+        """(positions, cumulative mass): the catalogue rows with a final score before
+        any scrubbing, presorted by it (highest first), and the running total of those
+        scores; built on first use and cached like alias_table. None if no row scores
+        """
+        key = self.table_key(
+            "sorted", weights, weighted_average_exponent, case_weight_exponent
+        )
+        table = self.alias_cache.get(key) if self.alias_cache is not None else None
+        if table is None:
+            mass = self.catalogue_mass(
+                weights, weighted_average_exponent, case_weight_exponent, entries
+            )
+            order = np.argsort(-mass, kind="stable")[: np.count_nonzero(mass)]
+            if len(order) == 0:
+                return None
+            table = (order, np.cumsum(mass[order]))
+            if self.alias_cache is not None:
+                self.alias_cache.put(key, table)
+        return table
+
+    def alias_bound(
+        self, weights: dict, weighted_average_exponent: float, entries: dict
+    ) -> float:
+        """the most scrubbing can have raised an available row's final score over its
+        score in the alias table, as a factor: scores only grow as values lose rows"""
+        kernel = self.kernel
+        weight_sum = float(sum(weights.values()))
+        log_bound = 0.0
+        for c, w in weights.items():
+            probas, _ = entries[c]
+            alive_counts = self.alive_counts[c]
+            codes = np.flatnonzero(
+                self.scrubbed_codes[c] & (alive_counts > 0) & (probas > 0)
+            )
+            if len(codes) == 0:
+                continue
+            full = self.full_counts[c][codes]
+            alive = alive_counts[codes]
+            if kernel.inverse is identity:
+                # a weighted average grows by at most its largest factor
+                log_bound = max(log_bound, float(np.log(full / alive).max()))
+            else:
+                # exp and expit grow by at most exp of the growth in their argument
+                with np.errstate(divide="ignore"):
+                    gain = kernel.transform(probas[codes] / alive) - kernel.transform(
+                        probas[codes] / full
+                    )
+                log_bound += w / weight_sum * float(gain.max())
+        with np.errstate(over="ignore"):
+            return float(np.exp(max(weighted_average_exponent, 0.0) * log_bound))
+
+    def alias_ratio(
+        self,
+        pos: int,
+        weights: dict,
+        weighted_average_exponent: float,
+        entries: dict,
+    ) -> float:
+        """an available row's final score over its score in the alias table"""
+        kernel = self.kernel
+        weight_sum = float(sum(weights.values()))
+        totals = np.zeros(2)  # (with rows scrubbed so far, in the full catalogue)
+        rescaled = False
+        for c, w in weights.items():
+            probas, scores = entries[c]
+            score = scores[pos]
+            if score == kernel.zero:
+                return 0.0
+            code = self.codes[c][pos]
+            if self.scrubbed_codes[c][code]:
+                rescaled = True
+                with np.errstate(divide="ignore"):
+                    totals[0] += (
+                        w
+                        / weight_sum
+                        * kernel.transform(probas[code] / self.alive_counts[c][code])
+                    )
+            else:
+                totals[0] += w / weight_sum * score
+            totals[1] += w / weight_sum * score
+        if not rescaled:
+            return 1.0
+        with np.errstate(over="ignore", invalid="ignore"):
+            alive, full = kernel.inverse(totals, out=totals)
+            return float((alive / full) ** weighted_average_exponent)
+
+    def rescored_mass(
+        self,
+        positions: np.ndarray,
+        weights: dict,
+        weighted_average_exponent: float,
+        case_weight_exponent: float,
+        entries: dict,
+    ) -> np.ndarray:
+        """final scores, unnormalized, of rows at `positions` (each with a nonzero score
+        before scrubbing) given the rows scrubbed so far"""
+        kernel = self.kernel
+        weight_sum = float(sum(weights.values()))
+        total = np.zeros(len(positions))
+        for c, w in weights.items():
+            probas, scores = entries[c]
+            row_scores = scores[positions]
+            codes = self.codes[c][positions]
+            dirty = np.flatnonzero(self.scrubbed_codes[c][codes])
+            if len(dirty):
+                row_scores = row_scores.copy()
+                with np.errstate(divide="ignore"):
+                    row_scores[dirty] = kernel.transform(
+                        probas[codes[dirty]] / self.alive_counts[c][codes[dirty]]
+                    )
+            total += w / weight_sum * row_scores
+        with np.errstate(over="ignore", invalid="ignore"):
+            summarized_scores = kernel.inverse(total, out=total)
+        return np.power(summarized_scores, weighted_average_exponent) * np.power(
+            self.weights[positions], case_weight_exponent
+        )
+
+    def presorted_position(
+        self,
+        weights: dict,
+        weighted_average_exponent: float,
+        case_weight_exponent: float,
+        top_k: Optional[int],
+        top_p: Optional[float],
+        rng,
+        step=None,
+    ) -> Optional[int]:
+        """draw the next row's catalogue position from the head of the current state's
+        candidate_list: its first top_k available rows, within the rows covering top_p
+        of the catalogue's mass before scrubbing. Only the head is rescored, so a step
+        costs O(head) however large the catalogue; rows whose scores scrubbing raised
+        keep their presorted place. None if the head has no available rows, for the
+        caller to sample exactly instead"""
+        if step is not None:
+            tick = perf_counter()
+
+        entries = {c: self.chain_entry(c, self.state[c]) for c in weights}
+        candidates = self.candidate_list(
+            weights, weighted_average_exponent, case_weight_exponent, entries
+        )
+        if candidates is None:
+            return None
+        order, cumulative = candidates
+
+        size = len(order)
+        if top_p is not None:
+            size = min(
+                size, int(np.searchsorted(cumulative, top_p * cumulative[-1])) + 1
+            )
+        # walk the list until it holds top_k available rows, doubling the stretch read
+        stop = size if top_k is None else min(size, top_k)
+        head = order[:stop][self.alive[order[:stop]]]
+        while top_k is not None and len(head) < top_k and stop < size:
+            stop = min(stop * 2, size)
+            head = order[:stop][self.alive[order[:stop]]]
+        if top_k is not None:
+            head = head[:top_k]
+        if len(head) == 0:
+            return None
+
+        mass = self.rescored_mass(
+            head, weights, weighted_average_exponent, case_weight_exponent, entries
+        )
+        pick = self.backend.sample(mass / mass.sum(), rng.random_sample())
+
+        if step is not None:
+            step.sampler = "alias"
+            step.n_scorable = len(head)
+            step.truncated_mass = 1.0 - float(cumulative[stop - 1] / cumulative[-1])
+            step.sample_seconds = perf_counter() - tick
+            if not all(self.model.chains[c].has_state(self.state[c]) for c in weights):
+                step.fallback = "unseen_state"
+        return int(head[pick])
+
+    def alias_position(
+        self,
+        weights: dict,
+        weighted_average_exponent: float,
+        case_weight_exponent: float,
+        rng,
+        step=None,
+    ) -> Optional[int]:
+        """draw the next row's catalogue position in O(1) from an alias table over the
+        full catalogue, rejecting unavailable rows and thinning by alias_ratio over
+        alias_bound, so accepted draws follow exact_probabilities; None when the bound
+        is over ALIAS_MAX_BOUND or ALIAS_MAX_ATTEMPTS draws are rejected (including at
+        dead ends), for the caller to sample exactly instead"""
+        if step is not None:
+            tick = perf_counter()
+
+        entries = {c: self.chain_entry(c, self.state[c]) for c in weights}
+        bound = self.alias_bound(weights, weighted_average_exponent, entries)
+        table = None
+        if bound <= ALIAS_MAX_BOUND:
+            table = self.alias_table(
+                weights, weighted_average_exponent, case_weight_exponent, entries
+            )
 
-        # sample an index, seeding np's random number generator if needed; cast to int for sqlalchemy lookups
-        np.random.seed(random_state)
-        idx = int(np.random.choice(scorable_ids, p=final_scores))
+        position = None
+        n_rejected = 0
+        if table is not None:
+            probabilities, aliases = table
+            n_rows = len(probabilities)
+            while n_rejected < ALIAS_MAX_ATTEMPTS:
+                pos = int(rng.random_sample() * n_rows)
+                if rng.random_sample() >= probabilities[pos]:
+                    pos = int(aliases[pos])
+                if self.alive[pos]:
+                    ratio = self.alias_ratio(
+                        pos, weights, weighted_average_exponent, entries
+                    )
+                    if ratio >= bound or rng.random_sample() * bound < ratio:
+                        position = pos
+                        break
+                n_rejected += 1
+
+        if step is not None:
+            step.n_rejected = n_rejected
+            if position is not None:
+                step.sampler = "alias"
+                step.sample_seconds = perf_counter() - tick
+                if not all(
+                    self.model.chains[c].has_state(self.state[c]) for c in weights
+                ):
+                    step.fallback = "unseen_state"
+        return position
+
+    def next_idx(
+        self,
+        feature_weights: dict,  # feature_limits: dict,
+        weighted_average_exponent: float = 1.0,
+        case_weight_exponent: float = 1.0,
+        random_state: int = None,
+        trace: Optional[GenerationTrace] = None,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+    ) -> int:
+        """draw, record and scrub the next selection; top_k and top_p truncate each draw
+        to the most probable selections (see exact_position and presorted_position)"""
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k must be at least 1")
+        if top_p is not None and not 0 < top_p <= 1:
+            raise ValueError("top_p must be in (0, 1]")
+
+        if self.is_clean_start:  # this method will dirty scorer state
+            self.is_clean_start = False
+
+        # instrumentation is skipped entirely unless a trace is passed in
+        step = None
+        if trace is not None:
+            step = trace.new_step()
+            step_start = perf_counter()
+
+        weights = {
+            col: w for col, w in feature_weights.items() if w is not None and w > 0
+        }
+        # draw from a generator seeded with random_state if one is given (the same draws
+        # as seeding np's global generator, but safe across threads)
+        rng = np.random if random_state is None else np.random.RandomState(random_state)
+
+        pos = None
+        if self.sampler == "alias" and (top_k is not None or top_p is not None):
+            pos = self.presorted_position(
+                weights,
+                weighted_average_exponent,
+                case_weight_exponent,
+                top_k,
+                top_p,
+                rng,
+                step,
+            )
+        elif self.sampler == "alias":
+            pos = self.alias_position(
+                weights, weighted_average_exponent, case_weight_exponent, rng, step
+            )
+        if pos is None:
+            pos = self.exact_position(
+                weights,
+                weighted_average_exponent,
+                case_weight_exponent,
+                rng,
+                step,
+                top_k,
+                top_p,
+            )
+        # cast to int for sqlalchemy lookups
+        idx = int(self.selection_ids[pos])
 
         # update state, scrub the index from the score data, and return
-        # selection_features = self.get_selection_features(idx)  # for scrubbing later
+        if step is not None:
+            tick = perf_counter()
         self.update_state(idx)
         self.scrub(selection_id=idx)
 
+        if step is not None:
+            tock = perf_counter()
+            step.sample_seconds += tock - tick
+            step.total_seconds = tock - step_start
+            step.selection_id = idx
+            step.is_break = idx == self.break_idx
+
         return idx
 
     def generate_program(
@@ -407,16 +2332,31 @@ class ChainEnsembleScorer:
         case_weight_exponent: float = 1.0,
         break_weight: int = None,
         random_state: int = None,
+        trace: Optional[GenerationTrace] = None,
+        constraints: Union[None, dict, list] = None,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
     ) -> list:
+        """generate a program of selection ids; pass a GenerationTrace to record
+        per-step timings and counters into it, and `constraints` (see parse_constraints)
+        to limit selections sharing feature values, e.g. {"work_type": {"limit": 1,
+        "values": ["concerto"]}, "composer_id": 1}; `top_k` and `top_p` draw each step
+        from only the most probable selections (traces record the mass left out)
+        """
+        if trace is not None:
+            program_start = perf_counter()
 
         # initialize if `next_idx` has been called since last initialized
         if not self.is_clean_start:
             self.initialize_score_state()
 
-        # set break weight if it's not the default used in __init__
+        # set break weight if it's not the default set by initialize_score_state
         if break_weight is not None and break_weight != self.default_break_weight:
             self.set_break_weight(break_weight)
 
+        if constraints:
+            self.set_constraints(constraints)
+
         def local_next_idx():
             """helper to not pass the same options around everywhere"""
             return self.next_idx(
@@ -424,6 +2364,9 @@ class ChainEnsembleScorer:
                 weighted_average_exponent=weighted_average_exponent,
                 case_weight_exponent=case_weight_exponent,
                 random_state=random_state,
+                trace=trace,
+                top_k=top_k,
+                top_p=top_p,
             )
 
         program: list = []
@@ -436,6 +2379,9 @@ class ChainEnsembleScorer:
         if self.model.train_backwards:
             program = program[::-1]
 
+        if trace is not None:
+            trace.total_seconds = perf_counter() - program_start
+
         return program
 
 
@@ -0,0 +1,237 @@
+import json
+import re
+import unicodedata
+from collections import defaultdict, namedtuple
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+# thresholds shared with MBZComposerSearch.acceptable_match_filter
+MIN_RATIO = 70
+MIN_AVERAGE_RATIO = 85
+
+IndexEntry = namedtuple("IndexEntry", ("name", "mbz_id", "source"))
+IndexMatch = namedtuple(
+    "IndexMatch",
+    ("mbz_id", "name", "source", "token_sort_ratio", "partial_ratio", "average_ratio"),
+)
+
+
+def normalize_name(name: str) -> str:
+    """lowercase, strip accents and punctuation, and collapse whitespace"""
+    clean = unicodedata.normalize("NFKD", name).encode("ASCII", "ignore").decode()
+    clean = re.sub(r"[^a-z0-9 ]", " ", clean.lower())
+    return re.sub(r" +", " ", clean).strip()
+
+
+def name_tokens(name: str) -> List[str]:
+    return normalize_name(name).split()
+
+
+def token_sort_key(name: str) -> str:
+    """normalized name with its tokens sorted, as in fuzz.token_sort_ratio"""
+    return " ".join(sorted(name_tokens(name)))
+
+
+def ngrams(text: str, n: int = 3) -> set:
+    """character n-grams of a padded string, used for candidate blocking"""
+    padded = f" {text} "
+    return {padded[i : i + n] for i in range(max(len(padded) - n + 1, 1))}
+
+
+def encode_strings(strings: List[str]) -> np.ndarray:
+    """pack strings into a zero-padded 2d array of code points"""
+    width = max([len(s) for s in strings] + [1])
+    out = np.zeros((len(strings), width), dtype=np.int32)
+    for i, s in enumerate(strings):
+        out[i, : len(s)] = [ord(c) for c in s]
+    return out
+
+
+def batch_lcs(query: str, candidates: np.ndarray) -> np.ndarray:
+    """longest common subsequence length between `query` and every row of an
+    `encode_strings` array; the DP loops over characters and vectorizes over candidates
+    """
+    n, width = candidates.shape
+    prev = np.zeros((n, width + 1), dtype=np.int32)
+    cur = np.zeros_like(prev)
+    for q in query:
+        match = candidates == ord(q)
+        cur[:, 0] = 0
+        for j in range(1, width + 1):
+            cur[:, j] = np.where(
+                match[:, j - 1],
+                prev[:, j - 1] + 1,
+                np.maximum(prev[:, j], cur[:, j - 1]),
+            )
+        prev, cur = cur, prev
+    return prev[:, width]
+
+
+def batch_ratio(query: str, candidates: List[str]) -> np.ndarray:
+    """fuzz.ratio (indel-based, as with python-Levenshtein) of `query` against each candidate"""
+    if not candidates:
+        return np.zeros(0)
+    lengths = np.array([len(c) for c in candidates]) + len(query)
+    lcs = batch_lcs(query, encode_strings(candidates))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(lengths > 0, 200 * lcs / lengths, 0)
+    return np.round(ratio)
+
+
+def batch_token_sort_ratio(query: str, candidates: List[str]) -> np.ndarray:
+    return batch_ratio(token_sort_key(query), [token_sort_key(c) for c in candidates])
+
+
+def batch_partial_ratio(query: str, candidates: List[str]) -> np.ndarray:
+    """best ratio of the shorter string against every same-length window of the longer;
+    windows from all candidates are scored together in a single batch
+    """
+    query = normalize_name(query)
+    windows: List[str] = []
+    owners: List[int] = []
+    shorts: List[str] = []
+    for i, cand in enumerate(normalize_name(c) for c in candidates):
+        short, long = (query, cand) if len(query) <= len(cand) else (cand, query)
+        for start in range(len(long) - len(short) + 1):
+            windows.append(long[start : start + len(short)])
+            owners.append(i)
+        shorts.append(short)
+
+    out = np.zeros(len(candidates))
+    if not windows:
+        return out
+
+    # group windows by the short string they are compared against (usually the query)
+    owners_arr = np.array(owners)
+    by_short: Dict[str, List[int]] = defaultdict(list)
+    for w, owner in enumerate(owners):
+        by_short[shorts[owner]].append(w)
+    scores = np.zeros(len(windows))
+    for short, w_idx in by_short.items():
+        scores[w_idx] = batch_ratio(short, [windows[w] for w in w_idx])
+
+    np.maximum.at(out, owners_arr, scores)
+    return out
+
+
+class ComposerNameIndex:
+    """
+    Local index of known composer names -> MusicBrainz ids, so most composers can be
+    matched without a remote MBZ search
+
+    - candidates are blocked on shared character trigrams of the token-sorted name
+    - surviving candidates are scored in one batch with the same token sort / partial
+      ratio thresholds that MBZComposerSearch applies to remote results
+    """
+
+    def __init__(self, entries: Iterable[IndexEntry] = (), ngram_size: int = 3):
+        self.ngram_size = ngram_size
+        self.entries: List[IndexEntry] = []
+        self.keys: List[str] = []
+        self.postings: Dict[str, List[int]] = defaultdict(list)
+        for entry in entries:
+            self.add(*entry)
+
+    def __repr__(self):
+        return f"<ComposerNameIndex: {len(self.entries)} names>"
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name: str, mbz_id: str, source: str = "manual") -> None:
+        if not name or not mbz_id:
+            return
+        key = token_sort_key(name)
+        if not key:
+            return
+        entry_id = len(self.entries)
+        self.entries.append(IndexEntry(name, mbz_id, source))
+        self.keys.append(key)
+        for gram in ngrams(key, self.ngram_size):
+            self.postings[gram].append(entry_id)
+
+    @classmethod
+    def from_manual_file(
+        cls, path: str = "data/manual_musicbrainz_composer_ids.json"
+    ) -> "ComposerNameIndex":
+        index = cls()
+        index.add_manual_file(path)
+        return index
+
+    def add_manual_file(self, path: str = "data/manual_musicbrainz_composer_ids.json"):
+        with open(path, "r") as fp:
+            for record in json.load(fp):
+                self.add(record.get("name"), record.get("mbz_id"), "manual")
+        return self
+
+    def add_cached_composers(self, session):
+        """index every MBZ artist already stored, under both its MBZ sort name and the
+        name of the composer it was matched to"""
+        from nyp.models import MBZComposer
+
+        for mbz in session.query(MBZComposer).filter(MBZComposer.is_best_match):
+            self.add(mbz.sort_name, mbz.mbz_id, "cache")
+            if mbz.composer:
+                self.add(mbz.composer.name, mbz.mbz_id, "cache")
+        return self
+
+    def candidates(self, name: str, max_candidates: int = 50) -> np.ndarray:
+        """entry ids sharing the most n-grams with `name`"""
+        grams = ngrams(token_sort_key(name), self.ngram_size)
+        posting_lists = [self.postings[g] for g in grams if g in self.postings]
+        if not posting_lists:
+            return np.array([], dtype=int)
+
+        shared = np.bincount(np.concatenate(posting_lists), minlength=len(self.entries))
+        # require a reasonable share of the query's n-grams before doing any scoring
+        min_shared = max(1, int(len(grams) * 0.3))
+        hits = np.flatnonzero(shared >= min_shared)
+        if len(hits) > max_candidates:
+            hits = hits[np.argsort(-shared[hits], kind="stable")[:max_candidates]]
+        return hits
+
+    def score(self, name: str, max_candidates: int = 50) -> List[IndexMatch]:
+        """score all blocked candidates for a name, best average ratio first"""
+        hits = self.candidates(name, max_candidates)
+        if len(hits) == 0:
+            return []
+
+        names = [self.entries[i].name for i in hits]
+        token_sort = batch_token_sort_ratio(name, names)
+        partial = batch_partial_ratio(name, names)
+        average = (token_sort + partial) / 2
+
+        order = np.argsort(-average, kind="stable")
+        return [
+            IndexMatch(
+                self.entries[hits[i]].mbz_id,
+                self.entries[hits[i]].name,
+                self.entries[hits[i]].source,
+                float(token_sort[i]),
+                float(partial[i]),
+                float(average[i]),
+            )
+            for i in order
+        ]
+
+    @classmethod
+    def is_acceptable(cls, match: IndexMatch) -> bool:
+        return (
+            match.token_sort_ratio >= MIN_RATIO
+            and match.partial_ratio >= MIN_RATIO
+            and match.average_ratio >= MIN_AVERAGE_RATIO
+        )
+
+    def best_match(self, name: str) -> Optional[IndexMatch]:
+        """the best acceptable match, or None if there is none or the best score is shared
+        by more than one MBZ id (left to the remote search to disambiguate)
+        """
+        acceptable = [m for m in self.score(name) if self.is_acceptable(m)]
+        if not acceptable:
+            return None
+        top = acceptable[0].average_ratio
+        top_ids = {m.mbz_id for m in acceptable if m.average_ratio == top}
+        if len(top_ids) > 1:
+            return None
+        return acceptable[0]
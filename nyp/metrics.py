@@ -0,0 +1,357 @@
+import functools
+import itertools
+import os
+import sys
+import threading
+import weakref
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# upper bounds in seconds, spanning sub-millisecond steps to multi-second requests
+DEFAULT_LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+DEFAULT_COUNT_BUCKETS: Tuple[float, ...] = (
+    1,
+    2,
+    5,
+    10,
+    25,
+    50,
+    100,
+    250,
+    500,
+    1000,
+    2500,
+    5000,
+    10000,
+    25000,
+    50000,
+)
+
+
+def format_labels(labels: Optional[Dict[str, str]], **extra: str) -> str:
+    """render a prometheus label set, e.g. {chain="work_type",le="0.5"}"""
+    merged = {**(labels or {}), **extra}
+    if not merged:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in merged.items()
+    )
+    return "{" + body + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _HistogramShard:
+    __slots__ = ("counts", "total")
+
+    def __init__(self, n_buckets: int):
+        self.counts: List[int] = [0] * (n_buckets + 1)  # last slot is +Inf
+        self.total: float = 0.0
+
+    def add(self, other: "_HistogramShard") -> None:
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.total += other.total
+
+
+class _CounterShard:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value: float = 0
+
+    def add(self, other: "_CounterShard") -> None:
+        self.value += other.value
+
+
+class _ShardOwner:
+    """held in a thread's local storage; collected when the thread exits"""
+
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class ThreadShards:
+    """
+    Per-thread shards of a metric's state, so writers never take a lock
+
+    A thread's shard is created on its first write. When the thread exits, its shard
+    is folded into `retired` and dropped, so threads that come and go (one per request,
+    say) don't accumulate shards. Reads merge `retired` with the live shards.
+    """
+
+    def __init__(self, new_shard: Callable):
+        self.new_shard = new_shard
+        self.retired = new_shard()
+        self.live: Dict[int, object] = {}
+        self._keys = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.live)
+
+    def __getstate__(self):
+        return {"new_shard": self.new_shard, "retired": self.merged()}
+
+    def __setstate__(self, state):
+        self.__init__(state["new_shard"])
+        self.retired = state["retired"]
+
+    def get(self):
+        """the calling thread's shard"""
+        owner = getattr(self._local, "owner", None)
+        if owner is None:
+            shard = self.new_shard()
+            key = next(self._keys)
+            with self._lock:  # once per thread
+                self.live[key] = shard
+            owner = self._local.owner = _ShardOwner(shard)
+            weakref.finalize(owner, self._retire, key).atexit = False
+        return owner.shard
+
+    def _retire(self, key: int) -> None:
+        with self._lock:
+            self.retired.add(self.live.pop(key))
+
+    def merged(self):
+        total = self.new_shard()
+        # summed under the lock: a shard retiring mid-sum would otherwise be counted
+        # both live and in `retired`
+        with self._lock:
+            for shard in [self.retired, *self.live.values()]:
+                total.add(shard)
+        return total
+
+
+class Histogram:
+    """
+    Bucketed distribution of observed values, exported in prometheus text format
+
+    Each thread writes to its own shard (see ThreadShards), so `observe` never takes a
+    lock; shards are only summed when the histogram is read.
+    """
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str = "",
+        buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        self.labels = labels or {}
+        self._shards = ThreadShards(
+            functools.partial(_HistogramShard, len(self.buckets))
+        )
+
+    def __repr__(self):
+        return f"<Histogram {self.name}{format_labels(self.labels)}: n={self.count}>"
+
+    def observe(self, value: float) -> None:
+        shard = self._shards.get()
+        shard.counts[bisect_left(self.buckets, value)] += 1
+        shard.total += value
+
+    def _merged(self) -> _HistogramShard:
+        return self._shards.merged()
+
+    @property
+    def count(self) -> int:
+        return sum(self._merged().counts)
+
+    @property
+    def sum(self) -> float:
+        return self._merged().total
+
+    def snapshot(self) -> dict:
+        """cumulative bucket counts keyed by upper bound, plus count and sum"""
+        merged = self._merged()
+        cumulative = 0
+        buckets = {}
+        for bound, c in zip(self.buckets + (float("inf"),), merged.counts):
+            cumulative += c
+            buckets[bound] = cumulative
+        return {"buckets": buckets, "count": cumulative, "sum": merged.total}
+
+    def quantile(self, q: float) -> float:
+        """approximate quantile: the upper bound of the bucket holding the q-th value"""
+        snap = self.snapshot()
+        if snap["count"] == 0:
+            return float("nan")
+        rank = q * snap["count"]
+        for bound, cumulative in snap["buckets"].items():
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self) -> List[str]:
+        snap = self.snapshot()
+        lines = [
+            f"{self.name}_bucket{format_labels(self.labels, le=format_value(b))} {c}"
+            for b, c in snap["buckets"].items()
+        ]
+        lines.append(f"{self.name}_sum{format_labels(self.labels)} {snap['sum']}")
+        lines.append(f"{self.name}_count{format_labels(self.labels)} {snap['count']}")
+        return lines
+
+
+class Counter:
+    """
+    Monotonically increasing count; like Histogram, increments go to a per-thread
+    shard so the hot path never contends on a lock
+    """
+
+    metric_type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str = "",
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self._shards = ThreadShards(_CounterShard)
+
+    def __repr__(self):
+        return f"<Counter {self.name}{format_labels(self.labels)}: {self.value}>"
+
+    def inc(self, amount: float = 1) -> None:
+        self._shards.get().value += amount
+
+    @property
+    def value(self) -> float:
+        return self._shards.merged().value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels)} {format_value(self.value)}"]
+
+
+class Gauge:
+    """a value that can go up or down; either set directly or read from `function`
+    each time the gauge is collected"""
+
+    metric_type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str = "",
+        labels: Optional[Dict[str, str]] = None,
+        function: Optional[Callable[[], float]] = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self.function = function
+        self._value: float = 0.0
+
+    def __repr__(self):
+        return f"<Gauge {self.name}{format_labels(self.labels)}: {self.value}>"
+
+    def set(self, value: float) -> None:
+        self._value = float(value)  # a single attribute store, no lock needed
+
+    @property
+    def value(self) -> float:
+        if self.function is not None:
+            return float(self.function())
+        return self._value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels)} {format_value(self.value)}"]
+
+
+class MetricsRegistry:
+    """a named collection of metrics (and metric sources) rendered together"""
+
+    def __init__(self):
+        self.metrics: Dict[Tuple[str, str], object] = {}
+        self.collectors: List[Callable[[], Iterable]] = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<MetricsRegistry: {len(self.metrics)} metrics>"
+
+    def register(self, metric):
+        """add a metric, or return the one already registered under its name and labels"""
+        key = (metric.name, format_labels(metric.labels))
+        with self._lock:
+            return self.metrics.setdefault(key, metric)
+
+    def add_collector(self, collector: Callable[[], Iterable]) -> None:
+        """register a callable returning more metrics to include at render time"""
+        self.collectors.append(collector)
+
+    def histogram(self, name: str, documentation: str = "", **kwargs) -> Histogram:
+        return self.register(Histogram(name, documentation, **kwargs))
+
+    def counter(self, name: str, documentation: str = "", **kwargs) -> Counter:
+        return self.register(Counter(name, documentation, **kwargs))
+
+    def gauge(self, name: str, documentation: str = "", **kwargs) -> Gauge:
+        return self.register(Gauge(name, documentation, **kwargs))
+
+    def collect(self) -> list:
+        collected = list(self.metrics.values())
+        for collector in self.collectors:
+            collected.extend(collector())
+        return collected
+
+    def render_prometheus(self) -> str:
+        return render_prometheus(self.collect())
+
+
+def process_resident_memory_bytes() -> float:
+    """current resident set size of this process (peak RSS where /proc is unavailable)"""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource  # not available on windows
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def render_prometheus(metrics: Iterable) -> str:
+    """prometheus text exposition of metrics, one HELP/TYPE header per metric name"""
+    lines: List[str] = []
+    seen = set()
+    for metric in sorted(metrics, key=lambda m: m.name):
+        if metric.name not in seen:
+            seen.add(metric.name)
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
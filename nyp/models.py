@@ -2,9 +2,9 @@ import json
 import re
 import unicodedata
 from datetime import datetime as dt
+from functools import lru_cache
 from typing import Any, List, Optional
 
-from fuzzywuzzy import fuzz
 from sqlalchemy import (
     Boolean,
     Column,
@@ -20,15 +20,16 @@ from sqlalchemy import (
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
-from nyp.musicbrainz import MBZAPI, MBZCounter
+from nyp.musicbrainz import MBZAPI, MBZArtistExtras, MBZCounter
 
 Base: Any = declarative_base()
 
-with open("data/manual_event_types.json", "r") as f:
-    EVENT_TYPE_EXTRAS = json.load(f)
 
-with open("data/manual_instrument_categories.json", "r") as f:
-    INSTRUMENT_CATEGORIES = json.load(f)
+@lru_cache(maxsize=None)
+def manual_lookup(name: str) -> dict:
+    """one of the manual lookups in data/, e.g. "event_types", read on first use"""
+    with open(f"data/manual_{name}.json", "r") as f:
+        return json.load(f)
 
 
 class GetOrCreateMixin:
@@ -92,7 +93,7 @@ class EventType(GetOrCreateMixin, Base):
     def __init__(self, name):
         self.name = name
         try:
-            extras = EVENT_TYPE_EXTRAS[name]
+            extras = manual_lookup("event_types")[name]
             self.category = extras["category"]
             self.is_modelable = extras["is_modelable"]
         except KeyError:
@@ -148,8 +149,9 @@ class Performer(GetOrCreateMixin, NameLookupMixin, Base):
         if self.instrument == "":
             self.instrument = None
         if self.instrument:
+            categories = manual_lookup("instrument_categories")
             try:
-                self.instrument_category = INSTRUMENT_CATEGORIES[self.instrument]
+                self.instrument_category = categories[self.instrument]
             except KeyError:
                 print(f"{self.instrument} not categorized")
 
@@ -419,17 +421,69 @@ class MBZComposer(Base):
     n_recordings = Column(Integer)
     n_releases = Column(Integer)
 
-    def __init__(self, composer: Composer, record: dict):
+    def __init__(self, composer: Composer, record: Optional[dict] = None):
         self._area_id = None
         self._begin_area_id = None
         self._end_area_id = None
         self.composer = composer
-        self.parse_base_record(record)
-        self.score_name_match()
+        if record is not None:
+            self.parse_base_record(record)
+            self.score_name_match()
 
     def __repr__(self):
         return f"<MBZComposer for {self.composer.name} ({self.mbz_id})>"
 
+    # columns copied when re-using a stored MBZ artist for another composer
+    cached_columns = (
+        "mbz_id",
+        "score",
+        "country",
+        "gender",
+        "sort_name",
+        "lifespan_begin",
+        "lifespan_end",
+        "lifespan_ended",
+        "area_id",
+        "begin_area_id",
+        "end_area_id",
+        "n_aliases",
+        "n_tags",
+        "disambiguated_composer",
+        "tag_composer",
+        "n_works",
+        "n_recordings",
+        "n_releases",
+    )
+
+    @classmethod
+    def from_cached(
+        cls, composer: Composer, cached: "MBZComposer", match=None
+    ) -> "MBZComposer":
+        """build a record for `composer` from an MBZ artist already in the database,
+        skipping the search and related-record API calls entirely
+
+        :param match: optional nyp.matching.IndexMatch holding precomputed name ratios"""
+        new = cls(composer)
+        for column in cls.cached_columns:
+            setattr(new, column, getattr(cached, column))
+        if match is None:
+            new.score_name_match()
+        else:
+            new.match_token_sort_ratio = match.token_sort_ratio
+            new.match_partial_ratio = match.partial_ratio
+            new.match_average_ratio = match.average_ratio
+        return new
+
+    @classmethod
+    def from_mbz_id(cls, composer: Composer, mbz_id: str) -> Optional["MBZComposer"]:
+        """build a record for `composer` from an MBZ artist looked up directly by id,
+        e.g. a manual match that isn't stored yet; None if the lookup fails"""
+        lookup = MBZArtistExtras(mbz_id=mbz_id)
+        if lookup.retrieve() != 200:
+            return None
+        lookup.content["score"] = 100  # a lookup by id has no search score
+        return cls(composer, lookup.content)
+
     @classmethod
     def clean_name(cls, name: str) -> str:
         """remove commas and unicode from a name str input"""
@@ -487,8 +541,9 @@ class MBZComposer(Base):
             self.disambiguated_composer = "composer" in disambiguation
 
     def score_name_match(self) -> None:
-        """score the name match on two token comparisons, as well as their average
-        """
+        """score the name match on two token comparisons, as well as their average"""
+        from fuzzywuzzy import fuzz
+
         composer_name = self.clean_name(self.composer.name)
         match_name = self.clean_name(self.sort_name)
         self.match_token_sort_ratio = fuzz.token_sort_ratio(composer_name, match_name)
@@ -557,10 +612,13 @@ class MBZComposerSearch(MBZAPI):
     @classmethod
     def acceptable_match_filter(cls, match: MBZComposer) -> bool:
         """return true if both ratios are >= 70 and their average is >= 85"""
+        # nyp.matching imports numpy, which nothing else in the models needs
+        from nyp.matching import MIN_AVERAGE_RATIO, MIN_RATIO
+
         return (
-            match.match_token_sort_ratio >= 70
-            and match.match_partial_ratio >= 70
-            and match.match_average_ratio >= 85
+            match.match_token_sort_ratio >= MIN_RATIO
+            and match.match_partial_ratio >= MIN_RATIO
+            and match.match_average_ratio >= MIN_AVERAGE_RATIO
         )
 
     def pick_best_match(self) -> Optional[MBZComposer]:
@@ -604,3 +662,28 @@ class MBZComposerSearch(MBZAPI):
             return disambiguated_composer[0]
 
         return None
+
+
+def find_mbz_composer(session, composer: Composer, index=None) -> Optional[MBZComposer]:
+    """match a composer to an MBZ artist, trying a local nyp.matching.ComposerNameIndex
+    of stored artists and manual ids first and only falling back to a remote
+    MBZComposerSearch
+    """
+    if index is not None:
+        match = index.best_match(composer.name)
+        if match:
+            cached = session.query(MBZComposer).filter_by(mbz_id=match.mbz_id).first()
+            if cached:
+                return MBZComposer.from_cached(composer, cached, match)
+            # manual ids are only stored by script 4, after this runs; fetch the artist
+            # by id rather than searching by name
+            if match.source == "manual":
+                fetched = MBZComposer.from_mbz_id(composer, match.mbz_id)
+                if fetched:
+                    fetched.fill_additional_data(session)
+                    return fetched
+
+    search = MBZComposerSearch(composer=composer)
+    if search.best_match:
+        search.best_match.fill_additional_data(session)
+    return search.best_match
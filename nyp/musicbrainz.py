@@ -3,8 +3,6 @@ import os.path
 import time
 from typing import Optional
 
-import requests
-
 MBZ_APP_HEADER = {
     "User-Agent": "NYPhil Concert Builder/0.01 (https://github.com/drewmcdonald/nyphil-program-generator)"
 }
@@ -41,6 +39,9 @@ class MBZAPI:
         """make an MBZ API Request, then call the class's post-retrieve method
 
         :return: request's HTTP status code"""
+        # imported here so importing the models doesn't pay for requests
+        import requests
+
         time.sleep(0.3)
 
         result = requests.get(
@@ -60,6 +61,16 @@ class MBZAPI:
         return result.status_code
 
 
+class MBZArtistExtras(MBZAPI):
+    """a single artist, looked up by id with the extras a search result carries"""
+
+    endpoint = "artist"
+
+    @property
+    def add_params(self):
+        return {"inc": "aliases+ratings+tags"}
+
+
 class MBZCounter(MBZAPI):
     """Base class for counting the number of records of type 'endpoint' affiliated with
     'index_mbz_id' of type 'index_endpoint'
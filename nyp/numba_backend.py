@@ -0,0 +1,149 @@
+"""
+The numba backend: nyp.backends' kernels as compiled loops
+
+Imported by nyp.backends.get_backend the first time the numba backend is requested, so
+numba (and its compilation cache) isn't loaded by processes that never use it.
+"""
+import numba
+import numpy as np
+
+from nyp.backends import NumpyBackend, pack_windows
+
+
+@numba.njit(cache=True)
+def _window_keys(codes, powers):
+    size = len(powers)
+    keys = np.empty(len(codes) - size + 1, dtype=np.int64)
+    for i in range(len(keys)):
+        key = 0
+        for j in range(size):
+            key += codes[i + j] * powers[j]
+        keys[i] = key
+    return keys
+
+
+@numba.njit(cache=True)
+def _count_sorted(keys):
+    n_distinct = 0
+    for i in range(len(keys)):
+        if i == 0 or keys[i] != keys[i - 1]:
+            n_distinct += 1
+    distinct = np.empty(n_distinct, dtype=np.int64)
+    counts = np.zeros(n_distinct, dtype=np.int64)
+    k = -1
+    for i in range(len(keys)):
+        if i == 0 or keys[i] != keys[i - 1]:
+            k += 1
+            distinct[k] = keys[i]
+        counts[k] += 1
+    return distinct, counts
+
+
+@numba.njit(cache=True)
+def _scorable_positions(scores, alive, zero):
+    positions = np.empty(len(alive), dtype=np.int64)
+    n = 0
+    for i in range(len(alive)):
+        if not alive[i]:
+            continue
+        keep = True
+        for f in range(len(scores)):
+            if scores[f][i] == zero:
+                keep = False
+                break
+        if keep:
+            positions[n] = i
+            n += 1
+    return positions[:n]
+
+
+@numba.njit(cache=True)
+def _weighted_sum(scores, weights, positions, out):
+    # same order of operations as the numpy backend, feature by feature from 0.0
+    for j in range(len(positions)):
+        i = positions[j]
+        total = 0.0
+        for f in range(len(scores)):
+            total += scores[f][i] * weights[f]
+        out[j] = total
+    return out[: len(positions)]
+
+
+@numba.njit(cache=True)
+def _sample(probabilities, uniform):
+    n = len(probabilities)
+    total = 0.0
+    for i in range(n):
+        total += probabilities[i]
+    cumulative = 0.0
+    for i in range(n):
+        cumulative += probabilities[i]
+        if cumulative / total > uniform:
+            return i
+    return n
+
+
+@numba.njit(cache=True)
+def _alias_table(weights, scale):
+    n = len(weights)
+    scaled = weights * scale
+    probabilities = np.ones(n)
+    aliases = np.arange(n)
+    small = np.empty(n, dtype=np.int64)
+    large = np.empty(n, dtype=np.int64)
+    n_small = 0
+    n_large = 0
+    for i in range(n):
+        if scaled[i] < 1.0:
+            small[n_small] = i
+            n_small += 1
+        else:
+            large[n_large] = i
+            n_large += 1
+    # the same pairing as the numpy backend, with arrays as the stacks
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        s = small[n_small]
+        g = large[n_large - 1]
+        probabilities[s] = scaled[s]
+        aliases[s] = g
+        scaled[g] += scaled[s] - 1.0
+        if scaled[g] < 1.0:
+            n_large -= 1
+            small[n_small] = g
+            n_small += 1
+    return probabilities, aliases
+
+
+class NumbaBackend(NumpyBackend):
+    name = "numba"
+
+    def count_windows(self, codes: np.ndarray, size: int, base: int) -> tuple:
+        powers = pack_windows(size, base)
+        if powers is None:
+            return super().count_windows(codes, size, base)
+        keys, counts = _count_sorted(np.sort(_window_keys(codes, powers)))
+        return (keys[:, None] // powers) % base, counts
+
+    def scorable_positions(
+        self, scores: tuple, alive: np.ndarray, zero: float
+    ) -> np.ndarray:
+        return _scorable_positions(tuple(scores), alive, zero)
+
+    def weighted_sum(
+        self,
+        scores: tuple,
+        weights: np.ndarray,
+        positions: np.ndarray,
+        out: np.ndarray,
+        gather: np.ndarray,
+    ) -> np.ndarray:
+        return _weighted_sum(tuple(scores), weights, positions, out)
+
+    def sample(self, probabilities: np.ndarray, uniform: float) -> int:
+        return int(_sample(probabilities, uniform))
+
+    def alias_table(self, weights: np.ndarray) -> tuple:
+        # scaled as the numpy backend does, since numba sums in a different order
+        weights = np.asarray(weights, dtype=np.float64)
+        return _alias_table(weights, len(weights) / weights.sum())
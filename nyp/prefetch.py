@@ -0,0 +1,130 @@
+import queue
+import threading
+from typing import Callable, Dict, List, Optional
+
+from nyp.metrics import Counter, Gauge
+
+
+class ProgramPool:
+    """
+    Bounded queues of pregenerated programs for a few "hot" parameter sets, kept full
+    by a background worker thread
+
+    Only interchangeable results belong here (unseeded parameter sets): `get` hands out
+    whichever program was made first, and returns None when the set isn't pooled or its
+    queue is drained, so callers fall back to generating inline.
+
+    - produce: makes one program from a parameter set; runs on the worker thread
+    - param_sets: the parameter sets to keep programs ready for
+    - key: maps a parameter set to the key its requests are matched on
+    - size: programs kept ready per parameter set
+    """
+
+    def __init__(
+        self,
+        produce: Callable[[dict], object],
+        param_sets: List[dict],
+        key: Callable[[dict], str],
+        size: int = 32,
+        prefix: str = "nyp_prefetch",
+    ):
+        self.produce = produce
+        self.key = key
+        self.size = size
+        self.param_sets: Dict[str, dict] = {key(p): p for p in param_sets}
+        self.queues: Dict[str, queue.Queue] = {
+            k: queue.Queue(maxsize=size) for k in self.param_sets
+        }
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+        self.hits = Counter(
+            f"{prefix}_hits_total", "Requests served a pregenerated program"
+        )
+        self.misses = Counter(
+            f"{prefix}_misses_total",
+            "Requests for a pooled parameter set that found its queue empty",
+        )
+        self.errors = Counter(
+            f"{prefix}_errors_total", "Pregeneration attempts that raised an error"
+        )
+        self.depth = Gauge(
+            f"{prefix}_ready_programs",
+            "Pregenerated programs waiting across all pooled parameter sets",
+            function=lambda: sum(q.qsize() for q in self.queues.values()),
+        )
+
+    def __repr__(self):
+        ready = sum(q.qsize() for q in self.queues.values())
+        return (
+            f"<ProgramPool: {len(self.queues)} parameter sets, {ready} programs ready>"
+        )
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """start the worker if it isn't running; safe to call on every request, so a
+        forked server worker starts its own thread on first use"""
+        with self._start_lock:
+            if not self.is_running:
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name="program-prefetch", daemon=True
+                )
+                self._thread.start()
+        return self
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self
+
+    def get(self, params: dict) -> Optional[object]:
+        """a pregenerated program for `params`, or None to generate one inline"""
+        q = self.queues.get(self.key(params))
+        if q is None:
+            return None
+        try:
+            program = q.get_nowait()
+        except queue.Empty:
+            self.misses.inc()
+            return None
+        finally:
+            self._wake.set()
+        self.hits.inc()
+        return program
+
+    def _run(self):
+        """top up each queue by one program per pass until all are full, then sleep
+        until a program is taken"""
+        while not self._stop.is_set():
+            filled = False
+            for k, q in self.queues.items():
+                if self._stop.is_set():
+                    return
+                if q.full():
+                    continue
+                try:
+                    program = self.produce(self.param_sets[k])
+                except Exception:
+                    self.errors.inc()
+                    self._stop.wait(1)
+                    continue
+                try:
+                    q.put_nowait(program)
+                    filled = True
+                except queue.Full:
+                    pass
+            if not filled:
+                self._wake.wait(5)
+                self._wake.clear()
+
+    @property
+    def metrics(self) -> list:
+        return [self.hits, self.misses, self.errors, self.depth]
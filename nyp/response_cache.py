@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from nyp.metrics import Counter
+
+
+def canonicalize_params(params: dict) -> dict:
+    """normalize generation options so equivalent requests share a cache key: tuples
+    become lists, and feature weights that are unused (None or <= 0) are dropped; ints
+    stay ints, since e.g. random_state=1 and 1.0 aren't treated alike"""
+
+    def normalize(value):
+        if isinstance(value, dict):
+            return {str(k): normalize(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        return value
+
+    canonical = normalize(params)
+    weights = canonical.get("feature_weights")
+    if isinstance(weights, dict):
+        canonical["feature_weights"] = {
+            k: w for k, w in weights.items() if w is not None and w > 0
+        }
+    return canonical
+
+
+def params_key(params: dict, model_version: str) -> str:
+    body = json.dumps(
+        canonicalize_params(params), sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(f"{model_version}:{body}".encode()).hexdigest()
+
+
+def file_version(path: str, chunk_size: int = 1 << 20) -> str:
+    """content hash of a file, e.g. the model pickle, to version cached responses"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+class ResponseCache:
+    """
+    Bounded cache of serialized results of deterministic (seeded) requests
+
+    - an in-process LRU of up to `maxsize` responses
+    - optionally, a SQLite file at `path` shared by every worker on the host, trimmed to
+        the `shared_maxsize` most recently stored responses; entries found there are
+        promoted into the LRU. Each process opens its own connection on first use, so
+        workers forked after the cache is created never share one
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        path: Optional[str] = None,
+        shared_maxsize: int = 100000,
+        prefix: str = "nyp_response_cache",
+    ):
+        self.maxsize = maxsize
+        self.path = path
+        self.shared_maxsize = shared_maxsize
+        self.entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        self.hits = {
+            tier: Counter(
+                f"{prefix}_hits_total",
+                "Seeded requests served from the response cache",
+                labels={"tier": tier},
+            )
+            for tier in ("memory", "shared")
+        }
+        self.misses = Counter(
+            f"{prefix}_misses_total", "Seeded requests not in the response cache"
+        )
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_pid: Optional[int] = None
+
+    def __repr__(self):
+        shared = f", shared at {self.path}" if self.path else ""
+        return f"<ResponseCache: {len(self.entries)}/{self.maxsize} entries{shared}>"
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        """this process's connection to the shared tier (None without one), opened on
+        first use and again after a fork: SQLite connections can't cross processes"""
+        if not self.path:
+            return None
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._db_pid = os.getpid()
+            self._db.execute("pragma journal_mode=wal")
+            self._db.execute(
+                "create table if not exists responses "
+                "(key text primary key, body text not null, stored_at real not null)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _remember(self, key: str, body: str) -> None:
+        self.entries[key] = body
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+                self.hits["memory"].inc()
+                return body
+
+            db = self._connection()
+            if db is not None:
+                row = db.execute(
+                    "select body from responses where key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.hits["shared"].inc()
+                    return row[0]
+
+            self.misses.inc()
+            return None
+
+    def put(self, key: str, body: str) -> None:
+        with self._lock:
+            self._remember(key, body)
+            db = self._connection()
+            if db is None:
+                return
+            db.execute(
+                "insert or replace into responses values (?, ?, ?)",
+                (key, body, time.time()),
+            )
+            self._puts += 1
+            if self._puts % 100 == 0:
+                db.execute(
+                    "delete from responses where key not in "
+                    "(select key from responses order by stored_at desc limit ?)",
+                    (self.shared_maxsize,),
+                )
+            db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            db = self._connection()
+            if db is not None:
+                db.execute("delete from responses")
+                db.commit()
+
+    @property
+    def metrics(self) -> list:
+        return list(self.hits.values()) + [self.misses]
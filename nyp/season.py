@@ -0,0 +1,72 @@
+from typing import Iterator, Union
+
+import numpy as np
+
+from nyp.markov import ChainEnsembleScorer, ConstraintCounter, parse_constraints
+
+
+class SeasonGenerator:
+    """
+    Generate a season of programs in sequence with one scorer, carrying state from
+    program to program
+
+    - scorer: an initialized scorer; the season uses a copy, leaving it untouched
+    - allow_repeats: whether a selection may appear in more than one program
+    - constraints: FeatureConstraints counted over the whole season rather than one
+        program (see nyp.markov.parse_constraints), e.g. {"composer_id": 3} to cap each
+        composer at three works a season
+
+    Keyword arguments to `generate` are passed to `ChainEnsembleScorer.generate_program`
+    for every program, so per-program constraints still apply within each concert.
+    """
+
+    def __init__(
+        self,
+        scorer: ChainEnsembleScorer,
+        allow_repeats: bool = False,
+        constraints: Union[None, dict, list] = None,
+    ):
+        self.scorer = scorer.copy()
+        self.allow_repeats = allow_repeats
+        self.constraints = ConstraintCounter(
+            self.scorer, parse_constraints(constraints)
+        )
+        self.available: np.ndarray = np.ones(len(self.scorer.selection_ids), dtype=bool)
+        self.programs: list = []
+
+    def __repr__(self):
+        return (
+            f"<SeasonGenerator: {len(self.programs)} programs, "
+            f"{self.available.sum()} selections available>"
+        )
+
+    def reset(self):
+        """start a new season"""
+        self.constraints.reset()
+        self.available[:] = True
+        self.programs = []
+        self.scorer.set_start_mask(None)
+        return self
+
+    def record_program(self, program: list):
+        """rule out what a finished program used for the rest of the season"""
+        scorer = self.scorer
+        for selection_id in program:
+            pos = scorer.positions.get_loc(selection_id)
+            if not self.allow_repeats and pos != scorer.intermission_pos:
+                self.available[pos] = False
+            for mask in self.constraints.count(pos):
+                self.available &= ~mask
+        self.programs.append(program)
+        scorer.set_start_mask(self.available)
+        return self
+
+    def generate(self, n_programs: int, **program_kwargs) -> Iterator[list]:
+        """yield each of the next `n_programs` programs as soon as it is generated"""
+        for _ in range(n_programs):
+            program = self.scorer.generate_program(**program_kwargs)
+            self.record_program(program)
+            yield program
+
+    def generate_season(self, n_programs: int, **program_kwargs) -> list:
+        return list(self.generate(n_programs, **program_kwargs))
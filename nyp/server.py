@@ -1,25 +1,114 @@
+import json
+import os
 import pickle
 import random
+import threading
 from copy import deepcopy
+from time import perf_counter
+from typing import TYPE_CHECKING, Optional
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import cross_origin
-from sqlalchemy.orm import scoped_session, sessionmaker
-
-from nyp.config import APP_SECRET
-from nyp.markov import ChainEnsemble, ChainEnsembleScorer
+from sqlalchemy.orm import scoped_session
+
+from nyp.config import (
+    APP_SECRET,
+    MODEL_PATH,
+    MODEL_WARM_UP,
+    PREFETCH_PARAM_SETS,
+    PREFETCH_POOL_SIZE,
+    RESPONSE_CACHE_PATH,
+    RESPONSE_CACHE_SIZE,
+)
+from nyp.metrics import MetricsRegistry, process_resident_memory_bytes
 from nyp.models import Selection
-from nyp.util import engine
+from nyp.prefetch import ProgramPool
+from nyp.response_cache import ResponseCache, file_version, params_key
+from nyp.tracing import GenerationTrace, TraceAggregator
+from nyp.util import Session as session_factory
+from nyp.util import get_engine
+
+if TYPE_CHECKING:
+    # nyp.markov (with pandas) is imported by load_model, off the startup path
+    from nyp.markov import ChainEnsemble, ChainEnsembleScorer
 
 application = Flask(__name__)
 application.secret_key = APP_SECRET
 
-Session = scoped_session(sessionmaker(engine))
-
-
-# shared objects
-model: ChainEnsemble = pickle.load(open("data/model_v1.p", "rb"))
-scorer_template: ChainEnsembleScorer = ChainEnsembleScorer(model)
+Session = scoped_session(session_factory)
+
+# metrics exposed at /metrics; per-step generation timings are aggregated separately
+metrics = MetricsRegistry()
+generation_traces = TraceAggregator()
+metrics.add_collector(lambda: generation_traces.metrics)
+
+TIMED_ENDPOINTS = ("/generate", "/rand_compare")
+request_seconds = {
+    endpoint: metrics.histogram(
+        "nyp_request_seconds",
+        "Wall time of API requests",
+        labels={"endpoint": endpoint},
+    )
+    for endpoint in TIMED_ENDPOINTS
+}
+phase_seconds = {
+    (endpoint, phase): metrics.histogram(
+        "nyp_request_phase_seconds",
+        "Wall time of API requests by phase (generation or database hydration)",
+        labels={"endpoint": endpoint, "phase": phase},
+    )
+    for endpoint in TIMED_ENDPOINTS
+    for phase in ("generate", "hydrate")
+}
+generation_failures = metrics.counter(
+    "nyp_generation_failures_total", "Program generations that raised an error"
+)
+request_errors = metrics.counter(
+    "nyp_request_errors_total", "Requests that raised an unhandled exception"
+)
+bulk_programs = metrics.counter("nyp_bulk_programs_total", "Programs streamed by /bulk")
+bulk_disconnects = metrics.counter(
+    "nyp_bulk_disconnects_total", "/bulk streams closed before every program was sent"
+)
+model_load_seconds = metrics.gauge(
+    "nyp_model_load_seconds", "Time to unpickle the model and build the scorer"
+)
+model_file_bytes = metrics.gauge("nyp_model_file_bytes", "Size of the model pickle")
+metrics.gauge(
+    "nyp_model_ready",
+    "1 once the model is loaded and programs can be generated",
+    function=lambda: float(scorer_template is not None),
+)
+metrics.gauge(
+    "nyp_process_resident_memory_bytes",
+    "Resident memory of this server process",
+    function=process_resident_memory_bytes,
+)
+for stat, documentation in (
+    ("entries", "Score vectors held in the shared score cache"),
+    ("hits", "Score cache lookups served from the cache"),
+    ("misses", "Score cache lookups that computed a new score vector"),
+    ("hit_rate", "Share of score cache lookups served from the cache"),
+    ("nbytes", "Memory held by cached score vectors"),
+    ("max_bytes", "Memory the score cache may hold before evicting"),
+):
+    metrics.gauge(
+        f"nyp_score_cache_{stat}",
+        documentation,
+        function=lambda stat=stat: score_cache_stats()[stat],
+    )
+
+# shared objects, loaded by load_model on first use (or by the warm-up thread)
+model: Optional["ChainEnsemble"] = None
+scorer_template: Optional["ChainEnsembleScorer"] = None
+# seeded requests are a pure function of their options and the model, so their
+# selections are cached under both
+model_version: Optional[str] = None
+model_load_error: Optional[str] = None
+_model_lock = threading.Lock()
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_PATH)
+metrics.add_collector(lambda: response_cache.metrics)
 
 # base
 DEFAULTS = {
@@ -44,27 +133,91 @@ FEATURES = [
     "percent_after_intermission_bin",
 ]
 
+MAX_BULK_PROGRAMS = 10000
 
-def make_scorer() -> ChainEnsembleScorer:
-    """get a copy of the clean, initialized scorer_template to avoid redundant computation
-    ???use a shallow copy so the model object tied to the scorer is not passed around unnecessarily"""
-    return deepcopy(scorer_template)
 
-
-def build_program(**kwargs):
-    scorer = make_scorer()
-
-    program = None
-    attempts = 1
-    while program is None:
+def load_model() -> "ChainEnsembleScorer":
+    """scorer_template, unpickling the model and building it if that hasn't happened
+    yet; threads arriving while it loads wait for it rather than loading it again"""
+    global model, scorer_template, model_version, model_load_error
+    if scorer_template is not None:
+        return scorer_template
+    with _model_lock:
+        if scorer_template is not None:
+            return scorer_template
+        start = perf_counter()
         try:
-            program = scorer.generate_program(**kwargs)
-        except ValueError as e:
-            if attempts >= 3:
-                raise e
-            print(f"retrying!!! attempt #{attempts}")
-        attempts += 1
-
+            from nyp.markov import ChainEnsembleScorer
+
+            # scoring only needs the model's tables and one row per selection
+            with open(MODEL_PATH, "rb") as fp:
+                loaded = pickle.load(fp).compact()
+            template = ChainEnsembleScorer(loaded)
+            model_load_seconds.set(perf_counter() - start)
+            model_file_bytes.set(os.path.getsize(MODEL_PATH))
+            version = file_version(MODEL_PATH)
+        except Exception as e:
+            model_load_error = f"{type(e).__name__}: {e}"
+            raise
+        model, model_version, model_load_error = loaded, version, None
+        # set last: a template means everything else is ready
+        scorer_template = template
+    return scorer_template
+
+
+def score_cache_stats() -> dict:
+    """SCORE_CACHE.stats(), or zeros until the model (and nyp.markov) is loaded"""
+    if scorer_template is None:
+        return dict.fromkeys(
+            ("entries", "hits", "misses", "hit_rate", "nbytes", "max_bytes"), 0
+        )
+    from nyp.markov import SCORE_CACHE
+
+    return SCORE_CACHE.stats()
+
+
+def start_warm_up() -> threading.Thread:
+    """load the model on a background thread, so the server can listen (and answer
+    /ready and /metrics) meanwhile"""
+    thread = threading.Thread(target=load_model, name="model-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def make_scorer() -> "ChainEnsembleScorer":
+    """get a clean copy of scorer_template to avoid redundant computation; the copy
+    shares the template's model and encoded catalogue rather than duplicating them"""
+    return load_model().copy()
+
+
+def observe_phase(phase: str, seconds: float) -> None:
+    """record a phase timing against the current request's endpoint, if it is timed"""
+    histogram = phase_seconds.get((request.path, phase))
+    if histogram is not None:
+        histogram.observe(seconds)
+
+
+def generate_selection_ids(scorer: "ChainEnsembleScorer" = None, **kwargs) -> list:
+    """generate a program, with a fresh scorer unless one is passed in; dead ends are
+    handled inside the scorer (see the fallback counters in /metrics), so there is no
+    need to retry"""
+    if scorer is None:
+        scorer = make_scorer()
+
+    trace = GenerationTrace()
+    try:
+        program = scorer.generate_program(trace=trace, **kwargs)
+    except Exception:
+        generation_failures.inc()
+        raise
+    generation_traces.record(trace)
+
+    return program
+
+
+def hydrate_program(program: list) -> list:
+    """look up each selection id's database record, in program order"""
+    get_engine()  # binds the session factory on first use
     q = Session.query(Selection)
 
     program_order = 0
@@ -79,35 +232,125 @@ def build_program(**kwargs):
     return final_program
 
 
-def make_random_params():
-    # TODO: move to instance method on scorer? or maybe on optimizer class
-    # scorer.make_random_params(features, max_single_weight, total_weight)
-
-    features = FEATURES.copy()
-    random.shuffle(features)
-
-    weights = {}
-    available_weight = 100
-
-    for feature in features:
-        if available_weight <= 1:
-            continue
-        weight_max = 65 if available_weight >= 65 else available_weight
-        weight = random.randrange(1, weight_max, 1)
-        weights[feature] = weight
-        available_weight -= weight
+def build_program(**kwargs):
+    start = perf_counter()
+    program = generate_selection_ids(**kwargs)
+    generated = perf_counter()
+    final_program = hydrate_program(program)
+    observe_phase("generate", generated - start)
+    observe_phase("hydrate", perf_counter() - generated)
+    return final_program
 
-    weighted_average_exponent = random.randrange(10, 30, 1) / 10
-    case_weight_exponent = random.randrange(10, 30, 1) / 10
-    break_weight = random.randrange(1, 20, 1)
 
-    return {
-        "feature_weights": weights,
-        "weighted_average_exponent": weighted_average_exponent,
-        "case_weight_exponent": case_weight_exponent,
-        "break_weight": break_weight,
-        "random_state": None,
-    }
+def make_random_params():
+    from nyp.calibration import random_params
+
+    return {**random_params(FEATURES), "random_state": None}
+
+
+def sample_param(spec, rng: random.Random):
+    """draw a value from a parameter spec: {"uniform": [low, high]},
+    {"randint": [low, high]} or {"choice": [...]}; dicts of specs are sampled
+    recursively and anything else is used as is"""
+    if isinstance(spec, dict):
+        if len(spec) == 1 and "uniform" in spec:
+            return rng.uniform(*spec["uniform"])
+        if len(spec) == 1 and "randint" in spec:
+            return rng.randint(*spec["randint"])
+        if len(spec) == 1 and "choice" in spec:
+            return rng.choice(spec["choice"])
+        return {k: sample_param(v, rng) for k, v in spec.items()}
+    return spec
+
+
+def parse_count(value) -> Optional[int]:
+    """a /bulk program count (an int, or a string of one), or None unless it's between
+    1 and MAX_BULK_PROGRAMS"""
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        return None
+    return value if 0 < value <= MAX_BULK_PROGRAMS else None
+
+
+def bulk_params(request_kwargs: dict, count: int, seed=None):
+    """yield the options for each of the `count` programs of a /bulk request; a
+    malformed spec raises TypeError, ValueError or IndexError, as does a random_state
+    that isn't a whole number"""
+    rng = random.Random(seed)
+    spec = request_kwargs.get("params") or {}
+    for i in range(count):
+        if request_kwargs.get("random_params"):
+            params = make_random_params()
+        else:
+            params = deepcopy(DEFAULTS)
+        params.update(sample_param(spec, rng))
+        # a fixed seed would repeat one program, so offset it for each program
+        random_state = params.get("random_state")
+        if random_state is not None:
+            if isinstance(random_state, bool) or not isinstance(random_state, int):
+                raise ValueError("random_state must be a whole number")
+            params["random_state"] = random_state + i
+        yield params
+
+
+def pooled_params(params: dict) -> dict:
+    """complete a configured hot parameter set with DEFAULTS, as /generate would"""
+    return {**deepcopy(DEFAULTS), **params}
+
+
+# unseeded requests for hot parameter sets are served from programs pregenerated on a
+# background thread, which starts with the first request; the pool only ever holds
+# this process's model's programs, so it's keyed on the options alone
+prefetch_pool: Optional[ProgramPool] = None
+if PREFETCH_POOL_SIZE > 0:
+    prefetch_pool = ProgramPool(
+        lambda params: hydrate_program(generate_selection_ids(**params)),
+        [pooled_params({})] + [pooled_params(p) for p in PREFETCH_PARAM_SETS],
+        key=lambda params: params_key(params, ""),
+        size=PREFETCH_POOL_SIZE,
+    )
+    metrics.add_collector(lambda: prefetch_pool.metrics)
+
+if MODEL_WARM_UP:
+    start_warm_up()
+
+
+@application.before_request
+def start_request_timer():
+    g.request_start = perf_counter()
+    if prefetch_pool is not None:
+        prefetch_pool.start()
+
+
+@application.after_request
+def observe_request_time(response):
+    histogram = request_seconds.get(request.path)
+    if histogram is not None and "request_start" in g:
+        histogram.observe(perf_counter() - g.request_start)
+    return response
+
+
+@application.teardown_request
+def count_request_errors(exception=None):
+    if exception is not None:
+        request_errors.inc()
+
+
+@application.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(
+        metrics.render_prometheus(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@application.route("/ready", methods=["GET"])
+def ready():
+    """200 once the model is loaded and programs can be generated, 503 until then (with
+    the error, if loading failed)"""
+    if scorer_template is not None:
+        return jsonify({"ready": True, "model_version": model_version})
+    return jsonify({"ready": False, "error": model_load_error}), 503
 
 
 @application.route("/rand_compare", methods=["GET"])
@@ -121,6 +364,60 @@ def rand_compare_2_programs():
     return jsonify(programs)
 
 
+@application.route("/bulk", methods=["GET", "POST"])
+@cross_origin()
+def bulk():
+    """
+    Stream `count` programs as newline-delimited json, one {"selections", "options"}
+    object per line, sent as each program is generated
+
+    - params: /generate options, where any value may instead be a distribution to
+        draw from per program (see sample_param)
+    - random_params: start from make_random_params rather than DEFAULTS
+    - hydrate: include full selection records rather than ids (default true)
+    - seed: seeds the parameter draws
+    """
+    request_kwargs = request.get_json(silent=True) or {}
+    count = parse_count(request_kwargs.get("count", 1))
+    if count is None:
+        return (
+            jsonify(
+                {"error": f"count must be a whole number from 1 to {MAX_BULK_PROGRAMS}"}
+            ),
+            400,
+        )
+    hydrate = request_kwargs.get("hydrate", True)
+    # every program's options are drawn up front: once streaming starts, the 200 status
+    # has been sent and a bad spec could only cut the response short
+    try:
+        all_params = list(
+            bulk_params(request_kwargs, count, request_kwargs.get("seed"))
+        )
+    except (TypeError, ValueError, IndexError) as e:
+        return jsonify({"error": f"invalid params: {e}"}), 400
+
+    def stream():
+        # one scorer for the whole stream; it cleans up its own state between programs
+        scorer = make_scorer()
+        try:
+            for params in all_params:
+                try:
+                    program = generate_selection_ids(scorer, **params)
+                    if hydrate:
+                        program = hydrate_program(program)
+                except Exception as e:
+                    yield json.dumps({"error": str(e), "options": params}) + "\n"
+                    return
+                yield json.dumps({"selections": program, "options": params}) + "\n"
+                bulk_programs.inc()
+        except GeneratorExit:
+            # the server closes this generator early when the client disconnects
+            bulk_disconnects.inc()
+            raise
+
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
+
+
 @application.route("/generate", methods=["GET"])
 @cross_origin()
 def generate():
@@ -131,9 +428,26 @@ def generate():
         for k, v in request_kwargs.items():
             program_kwargs[k] = v
 
-    program = {"selections": build_program(**program_kwargs), "options": program_kwargs}
-
-    return jsonify([program])
+    cache_key = None
+    if program_kwargs.get("random_state") is not None:
+        load_model()  # for model_version
+        cache_key = params_key(program_kwargs, model_version)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            # only the selections are cached: requests sharing a key may still differ
+            # in options that don't matter (e.g. unused weights), which are echoed back
+            return jsonify(
+                [{"selections": json.loads(cached), "options": program_kwargs}]
+            )
+
+    selections = None
+    if cache_key is None and prefetch_pool is not None:
+        selections = prefetch_pool.get(program_kwargs)
+    if selections is None:
+        selections = build_program(**program_kwargs)
+    if cache_key is not None:
+        response_cache.put(cache_key, json.dumps(selections))
+    return jsonify([{"selections": selections, "options": program_kwargs}])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,221 @@
+from typing import Dict, List, Optional
+
+from nyp.metrics import DEFAULT_COUNT_BUCKETS, Counter, Histogram, render_prometheus
+
+# reasons ChainEnsembleScorer.next_idx can fall back to a chain's backoff table
+FALLBACK_REASONS = ("unseen_state", "no_successor")
+
+# how ChainEnsembleScorer.next_idx can draw a selection
+SAMPLERS = ("exact", "alias")
+
+# share of probability mass left out of top_k / top_p truncated draws
+TRUNCATED_MASS_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0)
+
+
+class StepTrace:
+    """timings (seconds) and counters for a single `ChainEnsembleScorer.next_idx` call"""
+
+    __slots__ = (
+        "chain_seconds",
+        "summarize_seconds",
+        "filter_seconds",
+        "sample_seconds",
+        "total_seconds",
+        "n_scorable",
+        "selection_id",
+        "is_break",
+        "fallback",
+        "sampler",
+        "n_rejected",
+        "truncated_mass",
+    )
+
+    def __init__(self):
+        self.chain_seconds: Dict[str, float] = {}
+        self.summarize_seconds: float = 0.0
+        self.filter_seconds: float = 0.0
+        self.sample_seconds: float = 0.0
+        self.total_seconds: float = 0.0
+        self.n_scorable: int = 0
+        self.selection_id: Optional[int] = None
+        self.is_break: bool = False
+        self.fallback: Optional[str] = None
+        self.sampler: str = "exact"
+        self.n_rejected: int = 0
+        self.truncated_mass: Optional[float] = None
+
+    def __repr__(self):
+        return (
+            f"<StepTrace {self.selection_id}: {self.n_scorable} scorable, "
+            f"{self.total_seconds * 1000:.2f}ms>"
+        )
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class GenerationTrace:
+    """per-step record of one `ChainEnsembleScorer.generate_program` call"""
+
+    def __init__(self):
+        self.steps: List[StepTrace] = []
+        self.total_seconds: float = 0.0
+
+    def __repr__(self):
+        return (
+            f"<GenerationTrace: {len(self.steps)} steps, "
+            f"{self.total_seconds * 1000:.2f}ms>"
+        )
+
+    def new_step(self) -> StepTrace:
+        step = StepTrace()
+        self.steps.append(step)
+        return step
+
+    @property
+    def n_steps(self) -> int:
+        return len(self.steps)
+
+    @property
+    def n_fallbacks(self) -> int:
+        return sum(1 for s in self.steps if s.fallback is not None)
+
+    @property
+    def break_drawn(self) -> bool:
+        return bool(self.steps) and self.steps[-1].is_break
+
+    def stage_totals(self) -> Dict[str, float]:
+        """seconds spent in each stage, summed over all steps"""
+        totals: Dict[str, float] = {
+            "summarize": 0.0,
+            "filter": 0.0,
+            "sample": 0.0,
+        }
+        for step in self.steps:
+            for chain, seconds in step.chain_seconds.items():
+                key = "chain:" + chain
+                totals[key] = totals.get(key, 0.0) + seconds
+            totals["summarize"] += step.summarize_seconds
+            totals["filter"] += step.filter_seconds
+            totals["sample"] += step.sample_seconds
+        return totals
+
+    def to_dict(self) -> dict:
+        return {
+            "total_seconds": self.total_seconds,
+            "n_steps": self.n_steps,
+            "break_drawn": self.break_drawn,
+            "n_fallbacks": self.n_fallbacks,
+            "steps": [s.to_dict() for s in self.steps],
+        }
+
+
+class TraceAggregator:
+    """accumulate generation traces into histograms for export"""
+
+    def __init__(self, prefix: str = "nyp_generate"):
+        self.prefix = prefix
+        self.program_seconds = Histogram(
+            f"{prefix}_program_seconds", "Wall time of generate_program"
+        )
+        self.program_steps = Histogram(
+            f"{prefix}_program_steps",
+            "Steps (selections plus the final BREAK) per program",
+            buckets=DEFAULT_COUNT_BUCKETS,
+        )
+        self.step_seconds = self.stage_histogram("step")
+        self.n_scorable = Histogram(
+            f"{prefix}_scorable_selections",
+            "Selections left with a nonzero score at each step",
+            buckets=DEFAULT_COUNT_BUCKETS,
+        )
+        self.stage_seconds: Dict[str, Histogram] = {
+            stage: self.stage_histogram(stage)
+            for stage in ("summarize", "filter", "sample")
+        }
+        self.chain_seconds: Dict[str, Histogram] = {}
+        self.fallbacks: Dict[str, Counter] = {
+            reason: Counter(
+                f"{prefix}_fallbacks_total",
+                "Steps that fell back to backoff probabilities at a dead end",
+                labels={"reason": reason},
+            )
+            for reason in FALLBACK_REASONS
+        }
+        self.sampled: Dict[str, Counter] = {
+            sampler: Counter(
+                f"{prefix}_sampled_steps_total",
+                "Steps drawn by each sampler",
+                labels={"sampler": sampler},
+            )
+            for sampler in SAMPLERS
+        }
+        self.truncated_mass = Histogram(
+            f"{prefix}_truncated_mass",
+            "Share of probability mass left out of top_k/top_p truncated steps",
+            buckets=TRUNCATED_MASS_BUCKETS,
+        )
+        self.alias_rejections = Counter(
+            f"{prefix}_alias_rejections_total",
+            "Alias table draws rejected as unavailable or thinned by scrubbing",
+        )
+
+    def __repr__(self):
+        return f"<TraceAggregator: {self.program_seconds.count} programs>"
+
+    def stage_histogram(self, stage: str, chain: str = None) -> Histogram:
+        labels = {"stage": stage}
+        if chain is not None:
+            labels["chain"] = chain
+        return Histogram(
+            f"{self.prefix}_step_stage_seconds",
+            "Wall time per generation step, by stage",
+            labels=labels,
+        )
+
+    def record(self, trace: GenerationTrace) -> None:
+        self.program_seconds.observe(trace.total_seconds)
+        self.program_steps.observe(trace.n_steps)
+        for step in trace.steps:
+            self.step_seconds.observe(step.total_seconds)
+            # alias draws never count the scorable rows
+            if step.sampler == "exact":
+                self.n_scorable.observe(step.n_scorable)
+            self.stage_seconds["summarize"].observe(step.summarize_seconds)
+            self.stage_seconds["filter"].observe(step.filter_seconds)
+            self.stage_seconds["sample"].observe(step.sample_seconds)
+            if step.fallback is not None:
+                self.fallbacks[step.fallback].inc()
+            self.sampled[step.sampler].inc()
+            if step.truncated_mass is not None:
+                self.truncated_mass.observe(step.truncated_mass)
+            if step.n_rejected:
+                self.alias_rejections.inc(step.n_rejected)
+            for chain, seconds in step.chain_seconds.items():
+                if chain not in self.chain_seconds:
+                    self.chain_seconds[chain] = self.stage_histogram("score", chain)
+                self.chain_seconds[chain].observe(seconds)
+
+    @property
+    def histograms(self) -> List[Histogram]:
+        return [
+            self.program_seconds,
+            self.program_steps,
+            self.step_seconds,
+            self.n_scorable,
+            self.truncated_mass,
+            *self.stage_seconds.values(),
+            *self.chain_seconds.values(),
+        ]
+
+    @property
+    def metrics(self) -> list:
+        return (
+            self.histograms
+            + list(self.fallbacks.values())
+            + list(self.sampled.values())
+            + [self.alias_rejections]
+        )
+
+    def render_prometheus(self) -> str:
+        return render_prometheus(self.metrics)
@@ -1,18 +1,34 @@
 from contextlib import contextmanager
+from functools import lru_cache
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from nyp.config import MYSQL_CON
 
-engine = create_engine(MYSQL_CON)
+# bound to the engine when it's created, so importing this module doesn't connect
+Session = sessionmaker()
 
-Session = sessionmaker(engine)
+
+@lru_cache(maxsize=None)
+def get_engine():
+    """the MYSQL_CON engine, created on first use"""
+    engine = create_engine(MYSQL_CON)
+    Session.configure(bind=engine)
+    return engine
+
+
+def __getattr__(name: str):
+    # `from nyp.util import engine` still works, creating the engine at that point
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @contextmanager
 def wrapped_session():
     """Provide a transactional scope around a series of operations."""
+    get_engine()
     s = Session()
     try:
         yield s
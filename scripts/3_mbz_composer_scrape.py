@@ -1,4 +1,5 @@
-from nyp.models import Base, Composer, MBZComposerSearch
+from nyp.matching import ComposerNameIndex
+from nyp.models import Base, Composer, find_mbz_composer
 from nyp.util import Session, engine, wrapped_session
 
 Base.metadata.bind = engine
@@ -10,13 +11,17 @@ composer_ids = (
     .all()
 )
 
+# match offline against stored MBZ artists and manual ids where possible
+with wrapped_session() as s:
+    index = ComposerNameIndex.from_manual_file().add_cached_composers(s)
+
 for composer_id in composer_ids:
     with wrapped_session() as s:
         composer = s.query(Composer).get(composer_id)
-        search = MBZComposerSearch(composer=composer)
-        if search.best_match:
-            search.best_match.is_best_match = True
-            search.best_match.fill_additional_data(s)
-            s.add(search.best_match)
+        best_match = find_mbz_composer(s, composer, index)
+        if best_match:
+            best_match.is_best_match = True
+            s.add(best_match)
+            index.add(composer.name, best_match.mbz_id, "cache")
 
 engine.dispose()
@@ -2,7 +2,7 @@ import json
 from collections import namedtuple
 
 from nyp.models import Composer, MBZComposer
-from nyp.musicbrainz import MBZAPI
+from nyp.musicbrainz import MBZArtistExtras
 from nyp.util import engine, wrapped_session
 
 # export for manual lookups
@@ -22,14 +22,6 @@ with open("data/manual_musicbrainz_composer_ids.json", "r") as fp:
     ]
 
 
-class MBZArtistExtras(MBZAPI):
-    endpoint = "artist"
-
-    @property
-    def add_params(self):
-        return {"inc": "aliases+ratings+tags"}
-
-
 for row in composer_data:
 
     with wrapped_session() as s:
@@ -0,0 +1,58 @@
+"""
+Search generation options for the best held-out log-likelihood of real concerts
+
+    python -m scripts.calibrate --model data/model_v1.p --random 1000 \
+        --output data/calibration.csv
+
+Each fold's model is retrained from the pickled model's configuration and training
+data; --grid takes a json file of options to try (see nyp.calibration.grid_candidates).
+"""
+import argparse
+import json
+import pickle
+from multiprocessing import cpu_count
+from time import perf_counter
+
+from nyp.calibration import Calibrator, iter_candidates
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="data/model_v1.p")
+    parser.add_argument("--output", default="data/calibration.csv")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--random", type=int, default=0, help="random candidates")
+    parser.add_argument("--grid", help="json file of a grid of options")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-jobs", type=int, default=cpu_count())
+    parser.add_argument(
+        "--summary-function", default="rescaled_power_weight", dest="summary_function"
+    )
+    args = parser.parse_args()
+
+    with open(args.model, "rb") as fp:
+        model = pickle.load(fp)
+    grid = None
+    if args.grid:
+        with open(args.grid) as fp:
+            grid = json.load(fp)
+
+    calibrator = Calibrator.from_model(
+        model,
+        n_folds=args.folds,
+        seed=args.seed,
+        summary_function=args.summary_function,
+    )
+    candidates = list(
+        iter_candidates(calibrator.features, args.random, grid, args.seed)
+    )
+
+    start = perf_counter()
+    calibrator.prepare(args.n_jobs)
+    print(f"prepared {calibrator} in {perf_counter() - start:.1f}s")
+
+    start = perf_counter()
+    leaderboard = calibrator.search(candidates, n_jobs=args.n_jobs)
+    print(f"scored {len(candidates)} candidates in {perf_counter() - start:.1f}s")
+
+    calibrator.write_leaderboard(args.output)
+    print(leaderboard.head(10).to_string())
@@ -0,0 +1,25 @@
+"""
+Compact a pickled ChainEnsemble for serving, dropping its training data
+
+    python -m scripts.compact_model data/model_v1.p data/model_v1.compact.p
+"""
+import argparse
+import json
+import pickle
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("model")
+    parser.add_argument("output")
+    args = parser.parse_args()
+
+    with open(args.model, "rb") as fp:
+        model = pickle.load(fp)
+
+    before = model.memory_report()
+    model.compact()
+    after = model.memory_report()
+    print(json.dumps({"before": before, "after": after}, indent=2))
+
+    with open(args.output, "wb") as fp:
+        pickle.dump(model, fp, pickle.HIGHEST_PROTOCOL)
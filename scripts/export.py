@@ -3,6 +3,9 @@ import re
 from collections import namedtuple
 from typing import Optional
 
+import pandas as pd
+
+from nyp.markov import categorize_features
 from nyp.models import Composer
 
 INSTRUMENT_CATEGORIES = {"del": "me"}
@@ -95,6 +98,28 @@ def composer_birth_century(composer: Composer) -> Optional[str]:
     return "Other"
 
 
+# ids for constraints rather than features to model: nullable integers, NA for
+# intermissions, so FeatureConstraint values match them as ints
+ID_COLUMNS = ["composer_id"]
+
+
+def read_training_data(
+    path: str = "../data/train_export.txt.gz", features: Optional[list] = None
+) -> pd.DataFrame:
+    """load an export written by this script, with its feature columns (by default,
+    everything but the index, weight and ID_COLUMNS) as Categoricals ready for
+    ChainEnsemble"""
+    data = pd.read_csv(
+        path,
+        sep="\t",
+        index_col=["concert_id", "selection_id"],
+        dtype={c: "Int64" for c in ID_COLUMNS},
+    )
+    if features is None:
+        features = [c for c in data.columns if c not in ["weight"] + ID_COLUMNS]
+    return categorize_features(data, features)
+
+
 if __name__ == "__main__":
     from sqlalchemy import create_engine
     from sqlalchemy.orm import sessionmaker, joinedload
@@ -163,6 +188,7 @@ if __name__ == "__main__":
             "has_opus",
             "is_arrangement",
             "work_type",
+            "composer_id",
             "composer_country",
             "composer_birth_century",
             "composer_concert_selections",
@@ -186,6 +212,7 @@ if __name__ == "__main__":
                 "___INTERMISSION__",
                 "___INTERMISSION__",
                 "___INTERMISSION__",
+                None,  # composer_id, an integer column
                 "___INTERMISSION__",
                 "___INTERMISSION__",
                 "___INTERMISSION__",
@@ -203,6 +230,7 @@ if __name__ == "__main__":
                 matches_any(r.selection.work.title, OPUS_MARKERS),
                 matches_any(r.selection.work.title, [r"ARR\."]),
                 matches_which(r.selection.work.title, WORK_TYPES),
+                r.selection.work.composer.id,
                 coalesce_country(r.selection.work.composer),
                 composer_birth_century(r.selection.work.composer),
                 composer_concert_selection_counts[r.selection.work.composer.id],
@@ -222,8 +250,6 @@ if __name__ == "__main__":
         data_list.append(result)
         i += 1
 
-    import pandas as pd
-
     df = pd.DataFrame(data_list)
     df = df.set_index(["concert_id", "selection_id"])
     df.to_csv("../data/train_export.txt.gz", sep="\t", index=True, compression="gzip")